@@ -4,16 +4,67 @@ Versioning helper script
 """
 # Imports
 import hglib
+import json
+import os
 import re
+import shutil
 import sys
 import yaml
 from argparse import ArgumentParser
 from collections import OrderedDict
-from subprocess import check_output, CalledProcessError, STDOUT
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+from subprocess import check_output, CalledProcessError, DEVNULL, STDOUT
+
+# importlib.metadata requires Python 3.8
+try:
+    from importlib import metadata
+except ImportError:
+    metadata = None
 
 # Defaults
 default_version_file='/Version.yaml'
 default_package='immcantation'
+default_cache_file=os.path.join(os.path.expanduser('~'), '.cache', 'immcantation', 'versions.json')
+
+# Python packages and their distribution and module names
+python_packages = OrderedDict([('presto', 'presto'),
+                               ('changeo', 'changeo'),
+                               ('airr-py', 'airr')])
+
+# R packages and their names in R
+r_packages = OrderedDict([('alakazam', 'alakazam'),
+                          ('shazam', 'shazam'),
+                          ('tigger', 'tigger'),
+                          ('rdi', 'rdi'),
+                          ('scoper', 'scoper'),
+                          ('prestor', 'prestor'),
+                          ('airr-r', 'airr')])
+
+
+def secondWord(output):
+    """
+    Select the second word of the first non-empty line of command output
+
+    Arguments:
+      output : command output.
+
+    Returns:
+      str: second whitespace delimited word.
+    """
+    return next(x for x in output.splitlines() if x.strip()).split()[1]
+
+
+# Command line tools, with the executable, the command printing the version,
+# the output line index or a function selecting the text containing the version, and the version pattern
+version_probes = OrderedDict([('muscle', ('muscle', 'muscle -version', secondWord, r'(?<=v)([0-9.]+)')),
+                              ('vsearch', ('vsearch', 'vsearch --version', 0, r'(?<=v)([0-9.]+)')),
+                              ('cd-hit', ('cd-hit-est', 'cd-hit-est -h; exit 0', 0, r'(?<=CD-HIT version )([0-9.]+)')),
+                              ('blast', ('blastn', 'blastn -version', 1, r'(?<=blast )([0-9.]+)')),
+                              ('igblast', ('igblastn', 'igblastn -version', 1, r'(?<=igblast )([0-9.]+)')),
+                              ('phylip', ('drawtree', 'echo "NULL" | drawtree; exit 0', 0,
+                                          r'(?<=PHYLIP version )([0-9.]+)')),
+                              ('igphyml', ('igphyml', 'igphyml -h; exit 0', 1, r'(?<=IgPhyML )([0-9.]+)'))])
 
 # Set YAML loader to OrderedDict
 def dict_representer(dumper, data):  return dumper.represent_dict(data.iteritems())
@@ -53,155 +104,232 @@ def readVersions(version_file=default_version_file):
         return Version(yaml.load(handle, Loader=yaml.FullLoader))
 
 
-def inspectVersions(version_file=default_version_file):
+def probeCommand(command, line, pattern):
     """
-    Determine installed package versions
+    Run a command line version probe
 
     Arguments:
-      version_file : YAML file containing version information.
+      command : shell command printing the version.
+      line : index of the output line containing the version, or a function selecting
+             the text containing the version from the output.
+      pattern : regular expression matching the version number in the line.
 
     Returns:
-      dict: version strings.
+      str: version number or None.
     """
-    # Load versions object from version file
-    versions = readVersions(version_file=version_file)
-
-    # pRESTO
     try:
-        import presto
-        versions.packages['presto'] = presto.__version__
-    except ImportError:
-        versions.packages['presto'] = None
+        output = check_output(command, stderr=STDOUT, shell=True).decode('utf-8')
+        output = line(output) if callable(line) else output.split('\n')[line]
+        return re.search(pattern, output).group(0)
+    except (CalledProcessError, AttributeError, IndexError, StopIteration):
+        return None
+
+
+def probePython(module):
+    """
+    Determine the version of a Python package
+
+    The version is read from the installed distribution metadata, which avoids importing the package.
+    Without importlib.metadata, or if the distribution is not found, the package is imported.
 
-    # Change-O
+    Arguments:
+      module : distribution and module name.
+
+    Returns:
+      str: version number or None.
+    """
+    if metadata is not None:
+        try:
+            return metadata.version(module)
+        except metadata.PackageNotFoundError:
+            pass
     try:
-        import changeo
-        versions.packages['changeo'] = changeo.__version__
+        return import_module(module).__version__
     except ImportError:
-        versions.packages['changeo'] = None
+        return None
 
-    # Alakazam
-    try:
-        alakazam = check_output('Rscript -e \"cat(packageDescription(\'alakazam\', fields=\'Version\'))\"',
-                                stderr=STDOUT, shell=True)
-        versions.packages['alakazam'] = re.search(r'([0-9.]+)', alakazam.decode('utf-8')).group(0)
-    except (CalledProcessError, AttributeError):
-        versions.packages['alakazam'] = None
 
-    # SHazaM
-    try:
-        shazam = check_output('Rscript -e \"cat(packageDescription(\'shazam\', fields=\'Version\'))\"',
-                              stderr=STDOUT, shell=True)
-        versions.packages['shazam'] = re.search(r'([0-9.]+)', shazam.decode('utf-8')).group(0)
-    except (CalledProcessError, AttributeError):
-        versions.packages['shazam'] = None
+def probeR(executable, packages):
+    """
+    Determine the versions of R packages with a single Rscript call
 
-    # TIgGER
-    try:
-        tigger = check_output('Rscript -e \"cat(packageDescription(\'tigger\', fields=\'Version\'))\"',
-                              stderr=STDOUT, shell=True)
-        versions.packages['tigger'] = re.search(r'([0-9.]+)', tigger.decode('utf-8')).group(0)
-    except (CalledProcessError, AttributeError):
-        versions.packages['tigger'] = None
+    Arguments:
+      executable : path to the Rscript executable.
+      packages : dict of version file package names to R package names.
 
-    # RDI
+    Returns:
+      tuple: (dict of R library directories to modification times,
+              dict of version file package names to versions).
+    """
+    expr = 'cat(.libPaths(), sep="\\n"); cat("--\\n"); ' \
+           'for (p in c(%s)) cat(p, packageDescription(p, fields="Version"), "\\n")' % \
+           ', '.join('"%s"' % x for x in packages.values())
     try:
-        rdi = check_output('Rscript -e \"cat(packageDescription(\'rdi\', fields=\'Version\'))\"',
-                            stderr=STDOUT, shell=True)
-        versions.packages['rdi'] = re.search(r'([0-9.]+)', rdi.decode('utf-8')).group(0)
-    except (CalledProcessError, AttributeError):
-        versions.packages['rdi'] = None
+        output = check_output([executable, '-e', expr], stderr=DEVNULL).decode('utf-8')
+    except CalledProcessError:
+        return {}, {x: None for x in packages}
+    libs, __, rows = output.partition('--\n')
 
-    # SCOPer
-    try:
-        scoper = check_output('Rscript -e \"cat(packageDescription(\'scoper\', fields=\'Version\'))\"',
-                            stderr=STDOUT, shell=True)
-        versions.packages['scoper'] = re.search(r'([0-9.]+)', scoper.decode('utf-8')).group(0)
-    except (CalledProcessError, AttributeError):
-        versions.packages['scoper'] = None
+    # Record library directories, which change when packages are installed or removed
+    libs = {x: os.path.getmtime(x) for x in libs.split('\n') if os.path.isdir(x)}
 
-    # prestoR
-    try:
-        prestor = check_output('Rscript -e \"cat(packageDescription(\'prestor\', fields=\'Version\'))\"',
-                               stderr=STDOUT, shell=True)
-        versions.packages['prestor'] = re.search(r'([0-9.]+)', prestor.decode('utf-8')).group(0)
-    except (CalledProcessError, AttributeError):
-        versions.packages['prestor'] = None
+    # Parse package versions
+    installed = dict(x.split()[:2] for x in rows.split('\n') if len(x.split()) >= 2)
+    versions = {}
+    for package, r_package in packages.items():
+        match = re.search(r'([0-9.]+)', installed.get(r_package, ''))
+        versions[package] = match.group(0) if match else None
 
-    # MUSCLE
-    try:
-        muscle = check_output('muscle -version', stderr=STDOUT, shell=True)
-        muscle = muscle.decode('utf-8').split()[1]
-        versions.packages['muscle'] = re.search(r'(?<=v)([0-9.]+)', muscle).group(0)
-    except (CalledProcessError, AttributeError):
-        versions.packages['muscle'] = None
+    return libs, versions
 
-    # vsearch
-    try:
-        vsearch = check_output('vsearch --version', stderr=STDOUT, shell=True)
-        vsearch = vsearch.decode('utf-8').split('\n')[0]
-        versions.packages['vsearch'] = re.search(r'(?<=v)([0-9.]+)', vsearch).group(0)
-    except (CalledProcessError, AttributeError):
-        versions.packages['vsearch'] = None
 
-    # CD-HIT
-    try:
-        cdhit = check_output('cd-hit-est -h; exit 0', stderr=STDOUT, shell=True)
-        cdhit = cdhit.decode('utf-8').split('\n')[0]
-        versions.packages['cd-hit'] = re.search(r'(?<=CD-HIT version )([0-9.]+)', cdhit).group(0)
-    except (CalledProcessError, AttributeError):
-        versions.packages['cd-hit'] = None
+def readManifest(cache_file):
+    """
+    Read a version probe manifest
 
-    # BLAST
-    try:
-        blast = check_output('blastn -version', stderr=STDOUT, shell=True)
-        blast = blast.decode('utf-8').split('\n')[1]
-        versions.packages['blast'] = re.search(r'(?<=blast )([0-9.]+)', blast).group(0)
-    except (CalledProcessError, AttributeError):
-        versions.packages['blast'] = None
+    Arguments:
+      cache_file : JSON manifest file.
 
-    # IgBLAST
+    Returns:
+      dict: manifest entries, empty if the file does not exist or cannot be read.
+    """
     try:
-        igblast = check_output('igblastn -version', stderr=STDOUT, shell=True)
-        igblast = igblast.decode('utf-8').split('\n')[1]
-        versions.packages['igblast'] = re.search(r'(?<=igblast )([0-9.]+)', igblast).group(0)
-    except (CalledProcessError, AttributeError):
-        versions.packages['igblast'] = None
+        with open(cache_file, 'r') as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return {}
 
-    # PHYLIP
-    try:
-        phylip = check_output('echo "NULL" | drawtree; exit 0', stderr=STDOUT, shell=True)
-        phylip = phylip.decode('utf-8').split('\n')[0]
-        versions.packages['phylip'] =  re.search(r'(?<=PHYLIP version )([0-9.]+)', phylip).group(0)
-    except (CalledProcessError, AttributeError):
-        versions.packages['phylip'] = None
 
-    # IgPhyML
-    try:
-        igphyml = check_output('igphyml -h; exit 0', stderr=STDOUT, shell=True)
-        igphyml = igphyml.decode('utf-8').split('\n')[1]
-        versions.packages['igphyml'] = re.search(r'(?<=IgPhyML )([0-9.]+)', igphyml).group(0)
-    except (CalledProcessError, AttributeError):
-        versions.packages['igphyml'] = None
+def writeManifest(manifest, cache_file):
+    """
+    Write a version probe manifest, ignoring unwritable locations
 
-    # AIRR Python library
+    Arguments:
+      manifest : manifest entries.
+      cache_file : JSON manifest file.
+
+    Returns:
+      None
+    """
     try:
-        import airr
-        versions.packages['airr-py'] = airr.__version__
-    except ImportError:
-        versions.packages['airr-py'] = None
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+        tmp_file = '%s.%i' % (cache_file, os.getpid())
+        with open(tmp_file, 'w') as handle:
+            json.dump(manifest, handle, indent=2, sort_keys=True)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass
+
 
-    # AIRR R Library
+def isCurrent(entry, path):
+    """
+    Check whether a manifest entry matches an executable and its dependencies
+
+    Arguments:
+      entry : manifest entry or None.
+      path : path to the executable.
+
+    Returns:
+      bool: True if the executable and all recorded directories have the recorded modification times.
+    """
+    if entry is None or entry.get('path') != path or entry.get('mtime') != os.path.getmtime(path):
+        return False
     try:
-        airr_r = check_output('Rscript -e \"cat(packageDescription(\'airr\', fields=\'Version\'))\"',
-                               stderr=STDOUT, shell=True)
-        versions.packages['airr-r'] = re.search(r'([0-9.]+)', airr_r.decode('utf-8')).group(0)
-    except (CalledProcessError, AttributeError):
-        versions.packages['airr-r'] = None
+        return all(os.path.getmtime(x) == t for x, t in entry.get('libs', {}).items())
+    except OSError:
+        return False
+
+
+def inspectVersions(version_file=default_version_file, cache_file=default_cache_file, refresh=False):
+    """
+    Determine installed package versions
+
+    Command line tools are probed concurrently and R packages are queried with a single Rscript call.
+    Results are cached in a manifest keyed on the path and modification time of each executable.
+
+    Arguments:
+      version_file : YAML file containing version information.
+      cache_file : JSON manifest of probed versions. If None, versions are not cached.
+      refresh : if True, ignore the cached versions.
+
+    Returns:
+      dict: version strings.
+    """
+    # Load versions object from version file
+    versions = readVersions(version_file=version_file)
+
+    # Load manifest
+    manifest = readManifest(cache_file) if cache_file is not None and not refresh else {}
+    probed = {}
+
+    with ThreadPoolExecutor(max_workers=len(version_probes) + 1) as pool:
+        # Start probes of executables without a current manifest entry
+        futures = {}
+        for package, (executable, command, line, pattern) in version_probes.items():
+            path = shutil.which(executable)
+            if path is None:
+                versions.packages[package] = None
+            elif isCurrent(manifest.get(package), path):
+                versions.packages[package] = manifest[package]['version']
+            else:
+                futures[package] = (path, pool.submit(probeCommand, command, line, pattern))
+
+        # Start R package probe
+        rscript = shutil.which('Rscript')
+        if rscript is None:
+            versions.packages.update({x: None for x in r_packages})
+        elif isCurrent(manifest.get('R'), rscript):
+            versions.packages.update(manifest['R']['versions'])
+        else:
+            futures['R'] = (rscript, pool.submit(probeR, rscript, r_packages))
+
+        # Python packages
+        for package, module in python_packages.items():
+            versions.packages[package] = probePython(module)
+
+        # Collect probe results
+        for package, (path, future) in futures.items():
+            probed[package] = {'path': path, 'mtime': os.path.getmtime(path)}
+            if package == 'R':
+                probed[package]['libs'], probed[package]['versions'] = future.result()
+                versions.packages.update(probed[package]['versions'])
+            else:
+                probed[package]['version'] = versions.packages[package] = future.result()
+
+    # Update manifest
+    if cache_file is not None and probed:
+        manifest.update(probed)
+        writeManifest(manifest, cache_file)
 
     return versions
 
 
+def buildTagIndex(client):
+    """
+    Index the version strings in the tags of a mercurial repository
+
+    A tag is indexed under every substring that getChangeset would match as a version: preceded by the start of
+    the tag, whitespace, v or V, and followed by whitespace, a hyphen or the end of the tag.
+
+    Arguments:
+      client : hglib client of the repository.
+
+    Returns:
+      dict: version strings to the changeset of the first tag containing them.
+    """
+    index = {}
+    for name, rev, node, __ in client.tags():
+        name = name.decode('utf-8')
+        changeset = '%i:%s' % (rev, node.decode('utf-8'))
+        starts = [0] + [i + 1 for i, x in enumerate(name) if x.isspace() or x in 'vV']
+        ends = [i for i, x in enumerate(name) if x.isspace() or x == '-'] + [len(name)]
+        for i in starts:
+            for j in ends:
+                if j > i:  index.setdefault(name[i:j], changeset)
+
+    return index
+
+
 def updateChangeset(package, repo, version_file):
     """
     Print version for package
@@ -216,23 +344,25 @@ def updateChangeset(package, repo, version_file):
     """
     # Get version and changeset
     version = getVersion(package, version_file=version_file)
-    changeset = getChangeset(version, repo=repo)
+    client = hglib.open(repo)
+    changeset = getChangeset(version, repo=repo, client=client)
 
     # Update repo
     if changeset is not None:
-        client = hglib.open(repo)
         client.update(changeset)
+    client.close()
 
     return(changeset)
 
 
-def getChangeset(version, repo):
+def getChangeset(version, repo, client=None):
     """
     Print version for package
 
     Arguments:
       version : Version string to search in tags for.
       repo : Path to mercurial repository.
+      client : open hglib client of the repository. If None, the repository is opened.
 
     Returns:
       str: changeset.
@@ -241,24 +371,72 @@ def getChangeset(version, repo):
         print(None)
         return None
 
-    # Build regex
-    v = re.compile(r'(^|[\svV])' + version + r'([\s-]|$)')
-
-    # Open repo and retrieve tags
-    client = hglib.open(repo)
-    tags = client.tags()
-
-    # Check for version number in tags
-    changeset = None
-    for x in tags:
-        if v.search(x[0].decode('utf-8')):
-            changeset = '%i:%s' % (x[1], x[2].decode('utf-8'))
-            break
+    # Open repo and check for version number in tags
+    if client is None:
+        with hglib.open(repo) as client:
+            changeset = buildTagIndex(client).get(str(version))
+    else:
+        changeset = buildTagIndex(client).get(str(version))
     print(changeset)
 
     return changeset
 
 
+def batchChangesets(repo_dir, packages=None, update=False, version_file=default_version_file):
+    """
+    Resolve and print the tagged changesets of several packages
+
+    Arguments:
+      repo_dir : directory containing the mercurial repositories of the packages, named by package.
+      packages : package names. If None, immcantation and the release packages in the version file,
+                 skipping packages without a repository.
+      update : if True, update each repository to its resolved changeset.
+      version_file : YAML file containing version information.
+
+    Returns:
+      list: (package, version, changeset, status) tuples, or None if a package could not be resolved.
+    """
+    # Read versions once
+    versions = readVersions(version_file)
+    required = packages is not None
+    if packages is None:
+        packages = [default_package] + list(versions.sections['release'])
+
+    # Resolve changesets, opening each repository once
+    rows = []
+    failed = False
+    for package in packages:
+        version = versions.packages.get(package)
+        repo = os.path.join(repo_dir, package)
+        changeset = None
+        if version is None:
+            status = 'no version'
+            failed = True
+        elif not os.path.isdir(os.path.join(repo, '.hg')):
+            status = 'no repository'
+            failed = failed or required
+        else:
+            with hglib.open(repo) as client:
+                changeset = buildTagIndex(client).get(str(version))
+                if changeset is None:
+                    status = 'unresolved'
+                    failed = True
+                elif update:
+                    client.update(changeset)
+                    status = 'updated'
+                else:
+                    status = 'resolved'
+        rows.append((package, version, changeset, status))
+
+    # Report resolution table
+    table = [('PACKAGE', 'VERSION', 'CHANGESET', 'STATUS')] + rows
+    widths = [max(len(str(x[i])) for x in table) for i in range(3)]
+    for row in table:
+        print('  '.join(str(x).ljust(w) for x, w in zip(row, widths)) + '  ' + row[3])
+
+    return None if failed else rows
+
+
 def getVersion(package=default_package, version_file=default_version_file):
     """
     Print version for package
@@ -277,18 +455,20 @@ def getVersion(package=default_package, version_file=default_version_file):
     return(p)
 
 
-def reportVersions(version_file=default_version_file):
+def reportVersions(version_file=default_version_file, cache_file=default_cache_file, refresh=False):
     """
     Report all versions
 
     Arguments:
       version_file : YAML file containing version information.
+      cache_file : JSON manifest of probed versions. If None, versions are not cached.
+      refresh : if True, ignore the cached versions.
 
     Returns:
       str : version.
     """
     # Fetch versions
-    versions = inspectVersions(version_file=version_file)
+    versions = inspectVersions(version_file=version_file, cache_file=cache_file, refresh=refresh)
 
     # Report immcantation version
     report = ['immcantation: %s' % versions.version] + \
@@ -345,12 +525,37 @@ def getArgParser():
                                default=default_version_file, help='YAML version file.')
     parser_update.set_defaults(main=updateChangeset)
 
+    # Resolve mercurial changesets of several packages
+    parser_batch = subparsers.add_parser('batch',
+                                         help='Resolve the tagged changesets of several packages from version file.',
+                                         description='Resolve the tagged changesets of several packages from '
+                                                     'version file and report a resolution table.')
+    parser_batch.add_argument('-d', action='store', dest='repo_dir', type=str, required=True,
+                              help='Directory containing the mercurial repositories of the packages, '
+                                   'named by package.')
+    parser_batch.add_argument('-n', nargs='+', action='store', dest='packages', type=str, default=None,
+                              help='Package names. Defaults to immcantation and the release packages in the '
+                                   'version file, skipping packages without a repository.')
+    parser_batch.add_argument('--update', action='store_true', dest='update',
+                              help='Update each repository to the resolved changeset.')
+    parser_batch.add_argument('-f', action='store', dest='version_file', type=str,
+                              default=default_version_file, help='YAML version file.')
+    parser_batch.set_defaults(main=batchChangesets)
+
     # Inspect installed applications
     parser_report = subparsers.add_parser('report',
                                           help='Retrieve version information from installed packages.',
                                           description='Retrieve version information from installed packages.')
     parser_report.add_argument('-f', action='store', dest='version_file', type=str,
                                default=default_version_file, help='YAML version file.')
+    parser_report.add_argument('-c', action='store', dest='cache_file', type=str,
+                               default=default_cache_file,
+                               help='JSON manifest caching the versions of installed tools, keyed on the path and '
+                                    'modification time of each executable.')
+    parser_report.add_argument('--nocache', action='store_const', dest='cache_file', const=None,
+                               help='Do not read or write the version manifest.')
+    parser_report.add_argument('--refresh', action='store_true', dest='refresh',
+                               help='Probe all tools and rewrite the version manifest.')
     parser_report.set_defaults(main=reportVersions)
 
     return(parser)
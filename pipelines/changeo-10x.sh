@@ -26,6 +26,12 @@
 #   -p  Number of subprocesses for multiprocessing tools.
 #       Defaults to the available processing units.
 #   -i  Specify to allow partial alignments.
+#   -c  Directory for caching IgBLAST results across runs.
+#       If unspecified, IgBLAST results are not cached.
+#   --from-step  Step number or name to restart from.
+#       Without this option, steps that are up to date from a previous run are skipped.
+#   --compress  Compression program for archived files. One of gzip, pigz or zstd.
+#   --compress-early  Compress intermediate files as soon as no later step reads them.
 #   -h  Display help.
 
 # Print usage
@@ -53,6 +59,9 @@ print_usage() {
     echo -e "  -p  Number of subprocesses for multiprocessing tools.\n" \
             "     Defaults to the available cores."
     echo -e "  -i  Specify to allow partial alignments."
+    echo -e "  -c  Directory for caching IgBLAST results across runs.\n" \
+            "     If unspecified, IgBLAST results are not cached."
+    print_step_usage
     echo -e "  -h  This message."
 }
 
@@ -69,10 +78,15 @@ OUTNAME_SET=false
 OUTDIR_SET=false
 FORMAT_SET=false
 NPROC_SET=false
+CACHE_SET=false
 PARTIAL=""
 
+# Load the step runner and remove its arguments
+source pipeline_steps.sh
+step_args "$@"; set -- "${STEP_ARGS[@]}"
+
 # Get commandline arguments
-while getopts "s:a:r:g:t:x:m:b:n:o:f:p:ih" OPT; do
+while getopts "s:a:r:g:t:x:m:b:n:o:f:p:ic:h" OPT; do
     case "$OPT" in
     s)  READS=$OPTARG
         READS_SET=true
@@ -112,6 +126,9 @@ while getopts "s:a:r:g:t:x:m:b:n:o:f:p:ih" OPT; do
         ;;
     i)  PARTIAL="--partial"
         ;;        
+    c)  CACHE_DIR=$OPTARG
+        CACHE_SET=true
+        ;;
     h)  print_usage
         exit
         ;;
@@ -189,6 +206,12 @@ else
     IGDATA=$(realpath ${IGDATA})
 fi
 
+# Set IgBLAST cache directory
+if ${CACHE_SET}; then
+    mkdir -p ${CACHE_DIR}
+    CACHE_DIR=$(realpath ${CACHE_DIR})
+fi
+
 # Set output name
 if ! ${OUTNAME_SET}; then
     OUTNAME=$(basename ${READS} | sed 's/\.[^.]*$//; s/_L[0-9]*_R[0-9]_[0-9]*//')
@@ -252,6 +275,9 @@ DC_ACT="set"
 # Create germlines parameters
 CG_GERM="full dmask"
 
+# IgBLAST cache size limit in megabytes
+CACHE_SIZE=10240
+
 # Make output directory
 mkdir -p ${OUTDIR}; cd ${OUTDIR}
 
@@ -282,110 +308,163 @@ echo -e "DIRECTORY: ${OUTDIR}"
 echo -e "CHANGEO VERSION: ${CHANGEO_VERSION}"
 echo -e "IGBLAST VERSION: ${IGBLAST_VERSION}"
 echo -e "\nSTART"
-STEP=0
+STEP_WIDTH=30
+STEP_VERSION="${CHANGEO_VERSION} ${IGBLAST_VERSION}"
+init_steps "${LOGDIR}/steps"
 
 # Convert to FASTA if needed
 BASE_NAME=$(basename ${READS})
 EXT_NAME=${BASE_NAME##*.}
 if [ "${EXT_NAME,,}" == "fastq" ] || [ "${EXT_NAME,,}" == "fq" ]; then
-    printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 30 "Convert to FASTA"
-    IG_FILE=$(fastq2fasta.py ${READS})
+    IG_FILE="${BASE_NAME%.*}.fasta"
+    if begin_step "Convert to FASTA" -i "${READS}" -o "${IG_FILE}"; then
+        fastq2fasta.py ${READS} -o ${IG_FILE} > /dev/null
+        end_step
+    fi
 else
     IG_FILE=${READS}
 fi
 
-# Run IgBLAST
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 30 "AssignGenes igblast"
-AssignGenes.py igblast -s ${IG_FILE} --organism ${ORGANISM} --loci ${LOCI} \
-    -b ${IGDATA} --format blast --nproc ${NPROC} \
-    --outname "${OUTNAME}" --outdir . \
-     >> $PIPELINE_LOG 2> $ERROR_LOG
+# Run IgBLAST or reuse cached results
 FMT7_FILE="${OUTNAME}_igblast.fmt7"
-#check_error
+if begin_step "AssignGenes igblast" -i "${IG_FILE}" -p "${ORGANISM} ${LOCI} ${IGDATA}" -o "${FMT7_FILE}"; then
+    CACHE_KEY=""
+    if ${CACHE_SET}; then
+        # Run without the cache if the key cannot be computed
+        if ! CACHE_KEY=$(igblast_cache.sh key -s ${IG_FILE} -b ${IGDATA} -g ${ORGANISM} -t ${LOCI} \
+                         -v "${IGBLAST_VERSION}" -x "AssignGenes.py igblast --format blast ${CHANGEO_VERSION}"); then
+            CACHE_KEY=""
+            echo -e "   CACHE> key failed, not using the cache\n" >> $PIPELINE_LOG
+        fi
+    fi
+    if [ -n "${CACHE_KEY}" ] && igblast_cache.sh get -d ${CACHE_DIR} -k ${CACHE_KEY} -o ${FMT7_FILE}; then
+        echo -e "   CACHE> ${CACHE_KEY}\n" >> $PIPELINE_LOG
+    else
+        AssignGenes.py igblast -s ${IG_FILE} --organism ${ORGANISM} --loci ${LOCI} \
+            -b ${IGDATA} --format blast --nproc ${NPROC} \
+            --outname "${OUTNAME}" --outdir . \
+             >> $PIPELINE_LOG 2> $ERROR_LOG
+        IGBLAST_STATUS=$?
+        if [ ${IGBLAST_STATUS} -ne 0 ]; then
+            # Abort on failure. Successful runs are not checked, as igblastn writes warnings to stderr.
+            [ -s $ERROR_LOG ] || echo "AssignGenes.py igblast exited with status ${IGBLAST_STATUS}" > $ERROR_LOG
+            check_error
+        fi
+        # Only cache complete output
+        if [ -n "${CACHE_KEY}" ] && tail -n 1 ${FMT7_FILE} | grep -q "^# BLAST processed [0-9]* queries"; then
+            igblast_cache.sh put -d ${CACHE_DIR} -k ${CACHE_KEY} -i ${FMT7_FILE} -m ${CACHE_SIZE}
+        fi
+    fi
+    end_step
+fi
 
 # Parse IgBLAST output
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 30 "MakeDb igblast"
-MakeDb.py igblast -i ${FMT7_FILE} -s ${IG_FILE} --10x ${A10X} -r ${REFDIR} \
-    --extended --failed ${PARTIAL} --outname "${OUTNAME}" --format ${FORMAT} \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
 DB_PASS="${OUTNAME}_db-pass.${EXT}"
 DB_FAIL="${OUTNAME}_db-fail.${EXT}"
-check_error
+if begin_step "MakeDb igblast" -i "${FMT7_FILE} ${IG_FILE} ${A10X}" -p "${REFDIR} ${PARTIAL} ${FORMAT}" \
+    -o "${DB_PASS}"; then
+    MakeDb.py igblast -i ${FMT7_FILE} -s ${IG_FILE} --10x ${A10X} -r ${REFDIR} \
+        --extended --failed ${PARTIAL} --outname "${OUTNAME}" --format ${FORMAT} \
+        >> $PIPELINE_LOG 2> $ERROR_LOG
+    check_error
+    end_step
+fi
 
 # Split by chain and productivity
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 30 "ParseDb select"
-ParseDb.py select -d ${DB_PASS} -f ${LOCUS_FIELD} -u IGH TRB TRD \
-    -o "${OUTNAME}_heavy.${EXT}" \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
-ParseDb.py select -d ${DB_PASS} -f ${LOCUS_FIELD} -u IGK IGL TRA TRG \
-    -o "${OUTNAME}_light.${EXT}" \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
 HEAVY_ALL="${OUTNAME}_heavy.${EXT}"
 LIGHT_ALL="${OUTNAME}_light.${EXT}"
+if begin_step "ParseDb select" -i "${DB_PASS}" -o "${HEAVY_ALL} ${LIGHT_ALL}"; then
+    ParseDb.py select -d ${DB_PASS} -f ${LOCUS_FIELD} -u IGH TRB TRD \
+        -o "${OUTNAME}_heavy.${EXT}" \
+        >> $PIPELINE_LOG 2> $ERROR_LOG
+    ParseDb.py select -d ${DB_PASS} -f ${LOCUS_FIELD} -u IGK IGL TRA TRG \
+        -o "${OUTNAME}_light.${EXT}" \
+        >> $PIPELINE_LOG 2> $ERROR_LOG
+    end_step
+fi
 
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 30 "ParseDb split"
-ParseDb.py split -d "${OUTNAME}_heavy.${EXT}" -f ${PROD_FIELD} \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
-ParseDb.py split -d "${OUTNAME}_light.${EXT}" -f ${PROD_FIELD} \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
 HEAVY_PROD="${OUTNAME}_heavy_${PROD_FIELD}-T.${EXT}"
 LIGHT_PROD="${OUTNAME}_light_${PROD_FIELD}-T.${EXT}"
 HEAVY_NON="${OUTNAME}_heavy_${PROD_FIELD}-F.${EXT}"
 LIGHT_NON="${OUTNAME}_light_${PROD_FIELD}-F.${EXT}"
+if begin_step "ParseDb split" -i "${HEAVY_ALL} ${LIGHT_ALL}" -o "${HEAVY_PROD}"; then
+    ParseDb.py split -d "${OUTNAME}_heavy.${EXT}" -f ${PROD_FIELD} \
+        >> $PIPELINE_LOG 2> $ERROR_LOG
+    ParseDb.py split -d "${OUTNAME}_light.${EXT}" -f ${PROD_FIELD} \
+        >> $PIPELINE_LOG 2> $ERROR_LOG
+    end_step
+fi
 
 # Assign clones
 if $CLONE; then
     if [ "$DIST" == "auto" ]; then
-        printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 30 "Detect cloning threshold"
-        shazam-threshold -d ${HEAVY_PROD} -m density -n "${OUTNAME}" \
-        -f ${FORMAT} -p ${NPROC} \
-        > /dev/null 2> $ERROR_LOG
-        check_error
-        DIST=$(tail -n1 "${OUTNAME}_threshold-values.tab" | cut -f2)
+        THRESHOLD_FILE="${OUTNAME}_threshold-values.tab"
+        if begin_step "Detect cloning threshold" -i "${HEAVY_PROD}" -o "${THRESHOLD_FILE}"; then
+            shazam-threshold -d ${HEAVY_PROD} -m density -n "${OUTNAME}" \
+            -f ${FORMAT} -p ${NPROC} \
+            > /dev/null 2> $ERROR_LOG
+            check_error
+            end_step
+        fi
+        DIST=$(tail -n1 "${THRESHOLD_FILE}" | cut -f2)
     else
-        printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 30 "Calculating distances"
-        shazam-threshold -d ${HEAVY_PROD} -m none -n "${OUTNAME}" \
-        -f ${FORMAT} -p ${NPROC} \
-         &> /dev/null
+        if begin_step "Calculating distances"; then
+            shazam-threshold -d ${HEAVY_PROD} -m none -n "${OUTNAME}" \
+            -f ${FORMAT} -p ${NPROC} \
+             &> /dev/null
+            end_step
+        fi
     fi
 
-    printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 30 "DefineClones"
-    DefineClones.py -d ${HEAVY_PROD} --model ${MODEL} \
-        --dist ${DIST} --mode ${DC_MODE} --act ${DC_ACT} --nproc ${NPROC} \
-        --outname "${OUTNAME}_heavy" --log "${LOGDIR}/clone.log" --format ${FORMAT} \
-        >> $PIPELINE_LOG 2> $ERROR_LOG
     CLONE_FILE="${OUTNAME}_heavy_clone-pass.${EXT}"
-    check_error
+    if begin_step "DefineClones" -i "${HEAVY_PROD}" -p "${MODEL} ${DIST} ${DC_MODE} ${DC_ACT}" \
+        -o "${CLONE_FILE}"; then
+        DefineClones.py -d ${HEAVY_PROD} --model ${MODEL} \
+            --dist ${DIST} --mode ${DC_MODE} --act ${DC_ACT} --nproc ${NPROC} \
+            --outname "${OUTNAME}_heavy" --log "${LOGDIR}/clone.log" --format ${FORMAT} \
+            >> $PIPELINE_LOG 2> $ERROR_LOG
+        check_error
+        end_step
+    fi
 
     if [ -f "${LIGHT_PROD}" ]; then
-        printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 30 "VL clone correction"
-        light_cluster.py -d ${CLONE_FILE} -e ${LIGHT_PROD} \
-            -o "${OUTNAME}_heavy_clone-light.${EXT}" --format ${FORMAT} --doublets count \
-            > /dev/null 2> $ERROR_LOG
+        if begin_step "VL clone correction" -i "${CLONE_FILE} ${LIGHT_PROD}" \
+            -o "${OUTNAME}_heavy_clone-light.${EXT}"; then
+            light_cluster.py -d ${CLONE_FILE} -e ${LIGHT_PROD} \
+                -o "${OUTNAME}_heavy_clone-light.${EXT}" --format ${FORMAT} --doublets count \
+                > /dev/null 2> $ERROR_LOG
+            end_step
+        fi
         CLONE_FILE="${OUTNAME}_heavy_clone-light.${EXT}"
-    else
-        printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 30 "VL correction skipped"
+    elif begin_step "VL correction skipped"; then
+        end_step
     fi
 
-    printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 30 "CreateGermlines"
-    CreateGermlines.py -d ${CLONE_FILE} --cloned -r ${REFDIR} -g ${CG_GERM} \
-        --outname "${OUTNAME}_heavy" --log "${LOGDIR}/germline.log" --format ${FORMAT} \
-        >> $PIPELINE_LOG 2> $ERROR_LOG
+    if begin_step "CreateGermlines" -i "${CLONE_FILE}" -p "${REFDIR} ${CG_GERM}" \
+        -o "${OUTNAME}_heavy_germ-pass.${EXT}"; then
+        CreateGermlines.py -d ${CLONE_FILE} --cloned -r ${REFDIR} -g ${CG_GERM} \
+            --outname "${OUTNAME}_heavy" --log "${LOGDIR}/germline.log" --format ${FORMAT} \
+            >> $PIPELINE_LOG 2> $ERROR_LOG
+        check_error
+        end_step
+    fi
     HEAVY_PROD="${OUTNAME}_heavy_germ-pass.${EXT}"
-	check_error
 fi
 
 # Zip or delete intermediate files
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 30 "Compressing files"
-TEMP_FILES=$(ls *.tsv *.tab 2> /dev/null | grep -v "${HEAVY_PROD}\|${LIGHT_PROD}\|${HEAVY_NON}\|${LIGHT_NON}")
-if [[ ! -z $TEMP_FILES ]]; then
-    if $ZIP_FILES; then
-        tar -zcf temp_files.tar.gz $TEMP_FILES
-    fi
-    if $DELETE_FILES; then
-        rm $TEMP_FILES
+if begin_step "Compressing files"; then
+    TEMP_FILES=$(ls *.tsv *.tab 2> /dev/null | grep -v "${HEAVY_PROD}\|${LIGHT_PROD}\|${HEAVY_NON}\|${LIGHT_NON}")
+    if [[ ! -z $TEMP_FILES ]]; then
+        if $ZIP_FILES; then
+            archive_files temp_files $TEMP_FILES
+        fi
+        if $DELETE_FILES; then
+            rm -f $TEMP_FILES
+        fi
     fi
+    end_step
 fi
+finish_steps
 
 # End
 printf "DONE\n\n"
@@ -20,6 +20,10 @@
 #       Defaults to the available processing units.
 #   -a  Specify to clone the full data set.
 #       By default the data will be filtering to only productive/functional sequences.
+#   --from-step  Step number or name to restart from.
+#       Without this option, steps that are up to date from a previous run are skipped.
+#   --compress  Compression program for archived files. One of gzip, pigz or zstd.
+#   --compress-early  Compress intermediate files as soon as no later step reads them.
 #   -h  Display help.
 
 # Print usage
@@ -40,6 +44,7 @@ print_usage() {
             "     Defaults to the available cores."
     echo -e "  -a  Specify to clone the full data set.\n" \
             "     By default the data will be filtering to only productive/functional sequences."
+    print_step_usage
     echo -e "  -h  This message."
 }
 
@@ -54,6 +59,10 @@ FORMAT_SET=false
 NPROC_SET=false
 FUNCTIONAL=true
 
+# Load the step runner and remove its arguments
+source pipeline_steps.sh
+step_args "$@"; set -- "${STEP_ARGS[@]}"
+
 # Get commandline arguments
 while getopts "d:x:m:r:n:o:f:p:ah" OPT; do
     case "$OPT" in
@@ -209,68 +218,81 @@ echo -e "IDENTIFIER: ${OUTNAME}"
 echo -e "DIRECTORY: ${OUTDIR}"
 echo -e "CHANGEO VERSION: ${CHANGEO_VERSION}"
 echo -e "\nSTART"
-STEP=0
+STEP_VERSION=${CHANGEO_VERSION}
+init_steps "${LOGDIR}/steps"
 
 if $FUNCTIONAL; then
-    printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ParseDb select"
-    ParseDb.py select -d ${DB} -f ${PROD_FIELD} -u T TRUE \
-        --outname "${OUTNAME}" --outdir . \
-        >> $PIPELINE_LOG 2> $ERROR_LOG
-    check_error
     SELECT_PASS="${OUTNAME}_parse-select.${EXT}"
+    if begin_step "ParseDb select" -i "${DB}" -o "${SELECT_PASS}"; then
+        ParseDb.py select -d ${DB} -f ${PROD_FIELD} -u T TRUE \
+            --outname "${OUTNAME}" --outdir . \
+            >> $PIPELINE_LOG 2> $ERROR_LOG
+        check_error
+        end_step
+    fi
     LAST_FILE=$SELECT_PASS
 else
     LAST_FILE=${DB}
 fi
 
 # Assign clones
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "DefineClones ${DC_COMMAND}"
-DefineClones.py ${DC_COMMAND} -d ${LAST_FILE} --model ${MODEL} \
-    --dist ${DIST} --mode ${DC_MODE} --act ${DC_ACT} --nproc ${NPROC} \
-    --outname "${OUTNAME}" --outdir . --format ${FORMAT} --log "${LOGDIR}/clone.log" \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
-check_error
 CLONE_PASS="${OUTNAME}_clone-pass.${EXT}"
+if begin_step "DefineClones ${DC_COMMAND}" -i "${LAST_FILE}" -p "${MODEL} ${DIST} ${DC_MODE} ${DC_ACT}" \
+    -o "${CLONE_PASS}"; then
+    DefineClones.py ${DC_COMMAND} -d ${LAST_FILE} --model ${MODEL} \
+        --dist ${DIST} --mode ${DC_MODE} --act ${DC_ACT} --nproc ${NPROC} \
+        --outname "${OUTNAME}" --outdir . --format ${FORMAT} --log "${LOGDIR}/clone.log" \
+        >> $PIPELINE_LOG 2> $ERROR_LOG
+    check_error
+    end_step
+fi
 LAST_FILE=$CLONE_PASS
 
 # Create germlines
 if $GERMLINES; then
-    printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "CreateGermlines"
-    CreateGermlines.py -d ${LAST_FILE} -r ${REFDIR} -g ${CG_GERM} \
-        --cloned --outname "${OUTNAME}" --format ${FORMAT} \
-        >> $PIPELINE_LOG 2> $ERROR_LOG
-	check_error
-	GERM_PASS="${OUTNAME}_germ-pass.${EXT}"
-	LAST_FILE=$GERM_PASS
+    GERM_PASS="${OUTNAME}_germ-pass.${EXT}"
+    if begin_step "CreateGermlines" -i "${LAST_FILE}" -p "${REFDIR} ${CG_GERM}" -o "${GERM_PASS}"; then
+        CreateGermlines.py -d ${LAST_FILE} -r ${REFDIR} -g ${CG_GERM} \
+            --cloned --outname "${OUTNAME}" --format ${FORMAT} \
+            >> $PIPELINE_LOG 2> $ERROR_LOG
+        check_error
+        end_step
+    fi
+    LAST_FILE=$GERM_PASS
 fi
 
 # Process log files
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ParseLog"
-ParseLog.py -l "${LOGDIR}/clone.log" -f VALLELE DALLELE JALLELE JUNCLEN SEQUENCES CLONES \
-    > /dev/null 2> $ERROR_LOG &
-wait
+if begin_step "ParseLog"; then
+    ParseLog.py -l "${LOGDIR}/clone.log" -f VALLELE DALLELE JALLELE JUNCLEN SEQUENCES CLONES \
+        > /dev/null 2> $ERROR_LOG &
+    wait
+    end_step
+fi
 
 # Zip or delete log files
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "Compressing files"
-LOG_FILES=$(ls ${LOGDIR}/*.log | grep -v "pipeline")
-if [[ ! -z $LOG_FILES ]]; then
-    if $ZIP_FILES; then
-        tar -zcf log_files.tar.gz $LOG_FILES
-    fi
-    if $DELETE_FILES; then
-        rm $LOG_FILES
-    fi
-fi
-# Zip or delete intermediate files
-TEMP_FILES=$(ls ${SELECT_PASS} ${CLONE_PASS} ${GERM_PASS}  2> /dev/null | grep -v "${LAST_FILE}\|$(basename ${DB})")
-if [[ ! -z $TEMP_FILES ]]; then
-    if $ZIP_FILES; then
-        tar -zcf temp_files.tar.gz $TEMP_FILES
+if begin_step "Compressing files"; then
+    LOG_FILES=$(ls ${LOGDIR}/*.log | grep -v "pipeline")
+    if [[ ! -z $LOG_FILES ]]; then
+        if $ZIP_FILES; then
+            archive_files log_files $LOG_FILES
+        fi
+        if $DELETE_FILES; then
+            rm -f $LOG_FILES
+        fi
     fi
-    if $DELETE_FILES; then
-        rm $TEMP_FILES
+    # Zip or delete intermediate files
+    TEMP_FILES=$(ls ${SELECT_PASS} ${CLONE_PASS} ${GERM_PASS}  2> /dev/null | grep -v "${LAST_FILE}\|$(basename ${DB})")
+    if [[ ! -z $TEMP_FILES ]]; then
+        if $ZIP_FILES; then
+            archive_files temp_files $TEMP_FILES
+        fi
+        if $DELETE_FILES; then
+            rm -f $TEMP_FILES
+        fi
     fi
+    end_step
 fi
+finish_steps
 
 # End
 printf "DONE\n\n"
@@ -22,6 +22,12 @@
 #       Defaults to the available processing units.
 #   -k  Specify to filter the output to only productive/functional sequences.
 #   -i  Specify to allow partial alignments.
+#   -c  Directory for caching IgBLAST results across runs.
+#       If unspecified, IgBLAST results are not cached.
+#   --from-step  Step number or name to restart from.
+#       Without this option, steps that are up to date from a previous run are skipped.
+#   --compress  Compression program for archived files. One of gzip, pigz or zstd.
+#   --compress-early  Compress intermediate files as soon as no later step reads them.
 #   -h  Display help.
 
 # Print usage
@@ -44,6 +50,9 @@ print_usage() {
             "     Defaults to the available cores."
     echo -e "  -k  Specify to filter the output to only productive/functional sequences."
     echo -e "  -i  Specify to allow partial alignments."
+    echo -e "  -c  Directory for caching IgBLAST results across runs.\n" \
+            "     If unspecified, IgBLAST results are not cached."
+    print_step_usage
     echo -e "  -h  This message."
 }
 
@@ -57,11 +66,16 @@ OUTNAME_SET=false
 OUTDIR_SET=false
 FORMAT_SET=false
 NPROC_SET=false
+CACHE_SET=false
 FUNCTIONAL=false
 PARTIAL=""
 
+# Load the step runner and remove its arguments
+source pipeline_steps.sh
+step_args "$@"; set -- "${STEP_ARGS[@]}"
+
 # Get commandline arguments
-while getopts "s:r:g:t:b:n:o:f:p:kih" OPT; do
+while getopts "s:r:g:t:b:n:o:f:p:kic:h" OPT; do
     case "$OPT" in
     s)  READS=$OPTARG
         READS_SET=true
@@ -94,6 +108,9 @@ while getopts "s:r:g:t:b:n:o:f:p:kih" OPT; do
         ;;
     i)  PARTIAL="--partial"
         ;;        
+    c)  CACHE_DIR=$OPTARG
+        CACHE_SET=true
+        ;;
     h)  print_usage
         exit
         ;;
@@ -154,6 +171,12 @@ else
     IGDATA=$(realpath ${IGDATA})
 fi
 
+# Set IgBLAST cache directory
+if ${CACHE_SET}; then
+    mkdir -p ${CACHE_DIR}
+    CACHE_DIR=$(realpath ${CACHE_DIR})
+fi
+
 # Set output name
 if ! ${OUTNAME_SET}; then
     OUTNAME=$(basename ${READS} | sed 's/\.[^.]*$//; s/_L[0-9]*_R[0-9]_[0-9]*//')
@@ -207,6 +230,9 @@ GERMLINES=false
 # Create germlines parameters
 CG_GERM="dmask"
 
+# IgBLAST cache size limit in megabytes
+CACHE_SIZE=10240
+
 # Make output directory
 mkdir -p ${OUTDIR}; cd ${OUTDIR}
 
@@ -237,69 +263,107 @@ echo -e "DIRECTORY: ${OUTDIR}"
 echo -e "CHANGEO VERSION: ${CHANGEO_VERSION}"
 echo -e "IGBLAST VERSION: ${IGBLAST_VERSION}"
 echo -e "\nSTART"
-STEP=0
+STEP_VERSION="${CHANGEO_VERSION} ${IGBLAST_VERSION}"
+init_steps "${LOGDIR}/steps"
 
 # Convert to FASTA if needed
 BASE_NAME=$(basename ${READS})
 EXT_NAME=${BASE_NAME##*.}
 if [ "${EXT_NAME,,}" == "fastq" ] || [ "${EXT_NAME,,}" == "fq" ]; then
-    printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "Converting to FASTA"
-    IG_FILE=$(fastq2fasta.py ${READS})
+    IG_FILE="${BASE_NAME%.*}.fasta"
+    if begin_step "Converting to FASTA" -i "${READS}" -o "${IG_FILE}"; then
+        fastq2fasta.py ${READS} -o ${IG_FILE} > /dev/null
+        end_step
+    fi
 else
     IG_FILE=${READS}
 fi
 
-# Run IgBLAST
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "IgBLAST"
-run_igblast.sh -s ${IG_FILE} -g ${SPECIES} -t ${RECEPTOR} -b ${IGDATA} -n ${NPROC} \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
+# Run IgBLAST or reuse cached results
 FMT7_FILE=$(basename ${IG_FILE})
 FMT7_FILE="${FMT7_FILE%.fasta}.fmt7"
-#check_error
+if begin_step "IgBLAST" -i "${IG_FILE}" -p "${SPECIES} ${RECEPTOR} ${IGDATA}" -o "${FMT7_FILE}"; then
+    CACHE_KEY=""
+    if ${CACHE_SET}; then
+        # Run without the cache if the key cannot be computed
+        if ! CACHE_KEY=$(igblast_cache.sh key -s ${IG_FILE} -b ${IGDATA} -g ${SPECIES} -t ${RECEPTOR} \
+                         -v "${IGBLAST_VERSION}" -x "run_igblast.sh"); then
+            CACHE_KEY=""
+            echo -e "   CACHE> key failed, not using the cache\n" >> $PIPELINE_LOG
+        fi
+    fi
+    if [ -n "${CACHE_KEY}" ] && igblast_cache.sh get -d ${CACHE_DIR} -k ${CACHE_KEY} -o ${FMT7_FILE}; then
+        echo -e "   CACHE> ${CACHE_KEY}\n" >> $PIPELINE_LOG
+    else
+        run_igblast.sh -s ${IG_FILE} -g ${SPECIES} -t ${RECEPTOR} -b ${IGDATA} -n ${NPROC} \
+            >> $PIPELINE_LOG 2> $ERROR_LOG
+        IGBLAST_STATUS=$?
+        if [ ${IGBLAST_STATUS} -ne 0 ]; then
+            # Abort on failure. Successful runs are not checked, as igblastn writes warnings to stderr.
+            [ -s $ERROR_LOG ] || echo "run_igblast.sh exited with status ${IGBLAST_STATUS}" > $ERROR_LOG
+            check_error
+        fi
+        # Only cache complete output
+        if [ -n "${CACHE_KEY}" ] && tail -n 1 ${FMT7_FILE} | grep -q "^# BLAST processed [0-9]* queries"; then
+            igblast_cache.sh put -d ${CACHE_DIR} -k ${CACHE_KEY} -i ${FMT7_FILE} -m ${CACHE_SIZE}
+        fi
+    fi
+    end_step
+fi
 
 # Parse IgBLAST output
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "MakeDb igblast"
+DB_PASS="${OUTNAME}_db-pass.${EXT}"
+DB_FAIL="${OUTNAME}_db-fail.${EXT}"
+LAST_FILE=$DB_PASS
+if begin_step "MakeDb igblast" -i "${FMT7_FILE} ${IG_FILE}" -p "${REFDIR} ${PARTIAL} ${FORMAT}" \
+    -o "${DB_PASS}"; then
     MakeDb.py igblast -i ${FMT7_FILE} -s  ${IG_FILE} -r ${REFDIR} \
-    --extended --failed ${PARTIAL} \
-    --outname "${OUTNAME}" --outdir . --format ${FORMAT} \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
-    DB_PASS="${OUTNAME}_db-pass.${EXT}"
-    DB_FAIL="${OUTNAME}_db-fail.${EXT}"
-    LAST_FILE=$DB_PASS
-check_error
+        --extended --failed ${PARTIAL} \
+        --outname "${OUTNAME}" --outdir . --format ${FORMAT} \
+        >> $PIPELINE_LOG 2> $ERROR_LOG
+    check_error
+    end_step
+fi
 
 # Create germlines
 if $GERMLINES; then
-    printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "CreateGermlines"
-    CreateGermlines.py -d ${LAST_FILE} -r ${REFDIR} -g ${CG_GERM} \
-        --outname "${OUTNAME}" --format ${FORMAT} \
-        >> $PIPELINE_LOG 2> $ERROR_LOG
-	check_error
-	GERM_PASS="${OUTNAME}_germ-pass.${EXT}"
-	LAST_FILE=$GERM_PASS
+    GERM_PASS="${OUTNAME}_germ-pass.${EXT}"
+    if begin_step "CreateGermlines" -i "${LAST_FILE}" -p "${REFDIR} ${CG_GERM}" -o "${GERM_PASS}"; then
+        CreateGermlines.py -d ${LAST_FILE} -r ${REFDIR} -g ${CG_GERM} \
+            --outname "${OUTNAME}" --format ${FORMAT} \
+            >> $PIPELINE_LOG 2> $ERROR_LOG
+        check_error
+        end_step
+    fi
+    LAST_FILE=$GERM_PASS
 fi
 
 if $FUNCTIONAL; then
-    printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ParseDb select"
-    ParseDb.py select -d ${LAST_FILE} -f ${PROD_FIELD} -u T TRUE \
-        --outname "${OUTNAME}" \
-        >> $PIPELINE_LOG 2> $ERROR_LOG
-    check_error
     SELECT_PASS="${OUTNAME}_parse-select.${EXT}"
+    if begin_step "ParseDb select" -i "${LAST_FILE}" -o "${SELECT_PASS}"; then
+        ParseDb.py select -d ${LAST_FILE} -f ${PROD_FIELD} -u T TRUE \
+            --outname "${OUTNAME}" \
+            >> $PIPELINE_LOG 2> $ERROR_LOG
+        check_error
+        end_step
+    fi
     LAST_FILE=$SELECT_PASS
 fi
 
 # Zip or delete intermediate files
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "Compressing files"
-TEMP_FILES=$(ls ${DB_PASS} ${DB_FAIL} ${GERM_PASS} ${SELECT_PASS} 2> /dev/null | grep -v "${LAST_FILE}\|$(basename ${READS})")
-if [[ ! -z $TEMP_FILES ]]; then
-    if $ZIP_FILES; then
-        tar -zcf temp_files.tar.gz $TEMP_FILES
-    fi
-    if $DELETE_FILES; then
-        rm $TEMP_FILES
+if begin_step "Compressing files"; then
+    TEMP_FILES=$(ls ${DB_PASS} ${DB_FAIL} ${GERM_PASS} ${SELECT_PASS} 2> /dev/null | grep -v "${LAST_FILE}\|$(basename ${READS})")
+    if [[ ! -z $TEMP_FILES ]]; then
+        if $ZIP_FILES; then
+            archive_files temp_files $TEMP_FILES
+        fi
+        if $DELETE_FILES; then
+            rm -f $TEMP_FILES
+        fi
     fi
+    end_step
 fi
+finish_steps
 
 # End
 printf "DONE\n\n"
@@ -1,7 +1,8 @@
 #!/usr/bin/env bash
 # Super script to preprocess fastq files for pRESTO.
 # Will blast reads against Phi-X174 genome. Reads with 
-# a hit will be filtered out
+# a hit will be filtered out. Only reads sharing a k-mer
+# with the Phi-X174 genome are sent to blastn.
 #
 # Author:  Susanna Marquez
 # Date:    2018.03.19
@@ -15,6 +16,8 @@
 #       Defaults to a directory matching the sample identifier in the current working directory.
 #   -p  Number of subprocesses for multiprocessing tools.
 #       Defaults to the available processing units.
+#   --from-step  Step number or name to restart from.
+#       Without this option, steps that are up to date from a previous run are skipped.
 #   -h  Display help
 
 # Print usage
@@ -29,6 +32,7 @@ print_usage() {
             "     Defaults to a directory matching the sample identifier in the current working directory."
     echo -e "  -p   Number of subprocesses for multiprocessing tools.\n" \
             "      Defaults to the available cores."
+    print_step_usage
     echo -e "  -h   This message."
 }
 
@@ -43,6 +47,10 @@ NPROC_SET=false
 # Define BLAST command
 BLAST="blastn"
 
+# Load the step runner and remove its arguments
+source pipeline_steps.sh
+step_args "$@"; set -- "${STEP_ARGS[@]}"
+
 # Get commandline arguments
 while getopts "s:r:n:o:p:h" OPT; do
     case "$OPT" in
@@ -96,6 +104,7 @@ fi
 if [ -e ${PHIXDIR} ]; then
     PHIXDIR=$(realpath ${PHIXDIR})
     PHIXDB=$(ls ${PHIXDIR}/*fna)
+    PHIX_KMERS="${PHIXDB%.fna}.kmers"
 else
     echo -e "Directory '${PHIXDIR}' not found." >&2
     exit 1
@@ -162,74 +171,81 @@ echo -e "BLASTN VERSION: ${BLASTN_VERSION}"
 echo -e "PHIX VERSION (DOWNLOAD DATE): ${PHIX_VERSION}"
 echo -e "LOGDIR: ${LOGDIR}"
 echo -e "\nSTART"
-STEP=0
-
-# Remove all-N sequence becase blastn crashes with all N sequences)
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "Removing all N sequences"
-echo -e "       START> awk" >> $PIPELINE_LOG
-NO_N_READS="${OUTNAME}_clean-missing.fastq"
-awk '{y= i++ % 4 ; L[y]=$0; if(y==3 && L[1] ~ /[^N]/) {printf("%s\n%s\n%s\n%s\n",L[0],L[1],L[2],L[3]);}}' ${READS} \
-    > ${NO_N_READS} 2> $ERROR_LOG
-
-# Set input file for alignment
-INPUT_SIZE=$((`wc -l < ${READS}`/4))
-OUTPUT_SIZE=$((`wc -l < ${NO_N_READS}`/4))
-REMOVED_SEQS=$((${INPUT_SIZE}-${OUTPUT_SIZE}))
-
-if [ ${REMOVED_SEQS} -gt 0 ]; then
-   CONVERT_FILE=${NO_N_READS}
-else
-   CONVERT_FILE=${READS}
-   rm $NO_N_READS
+STEP_VERSION=${BLASTN_VERSION}
+init_steps "${LOGDIR}/steps"
+
+# Build the k-mer index if the reference directory does not provide one
+if [ ! -f ${PHIX_KMERS} ]; then
+    PHIX_KMERS="${OUTNAME}_phix.kmers"
+    if begin_step "PhiX k-mer index" -i "${PHIXDB}" -o "${PHIX_KMERS}"; then
+        phix_kmers.py index -r ${PHIXDB} -o ${PHIX_KMERS} > /dev/null 2> $ERROR_LOG
+        check_error
+        end_step
+    fi
+fi
+
+# Remove all-N sequences (blastn crashes with all N sequences), convert headers
+# and screen reads for k-mers shared with the PhiX genome in a single pass
+KMER_FILE="${OUTNAME}_kmer-pass.fasta"
+if begin_step "Clean reads" -i "${READS} ${PHIX_KMERS}" -o "${KMER_FILE}"; then
+    echo -e "       START> phix_reads clean" >> $PIPELINE_LOG
+    CLEAN_COUNTS=($(phix_reads.py clean -s ${READS} -i ${PHIX_KMERS} -o ${KMER_FILE} 2> $ERROR_LOG))
+    check_error
+    INPUT_SIZE=${CLEAN_COUNTS[0]}
+    REMOVED_SEQS=${CLEAN_COUNTS[1]}
+    OUTPUT_SIZE=$((${INPUT_SIZE}-${REMOVED_SEQS}))
+    echo -e "  INPUT_SIZE> ${INPUT_SIZE}" >> $PIPELINE_LOG
+    echo -e " OUTPUT_SIZE> ${OUTPUT_SIZE}" >> $PIPELINE_LOG
+    echo -e "REMOVED_SEQS> ${REMOVED_SEQS}" >> $PIPELINE_LOG
+    echo -e "        HITS> ${CLEAN_COUNTS[2]}" >> $PIPELINE_LOG
+    echo -e "      MISSES> $((${OUTPUT_SIZE}-${CLEAN_COUNTS[2]}))" >> $PIPELINE_LOG
+    echo -e "  READS_FILE> ${READS}" >> $PIPELINE_LOG
+    echo -e "      OUTPUT> ${KMER_FILE}\n" >> $PIPELINE_LOG
+    end_step
 fi
-   
-echo -e "  INPUT_SIZE> ${INPUT_SIZE}" >> $PIPELINE_LOG
-echo -e " OUTPUT_SIZE> ${OUTPUT_SIZE}" >> $PIPELINE_LOG
-echo -e "REMOVED_SEQS> ${REMOVED_SEQS}" >> $PIPELINE_LOG
-echo -e "  READS_FILE> ${READS}\n" >> $PIPELINE_LOG
-
-# Convert headers to presto format
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ConvertHeaders"
-ConvertHeaders.py illumina -s ${CONVERT_FILE} --outdir ${OUTDIR} --outname ${OUTNAME} --fasta \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
-FASTA_FILE="${OUTNAME}_convert-pass.fasta"
-check_error
 
 # Run blastn
 BLAST_CMD="${BLAST} \
-     -query ${FASTA_FILE} \
+     -query ${KMER_FILE} \
      -db ${PHIXDB} \
      -outfmt '6 std qseq sseq btop' \
      -out ${OUTNAME}_phix.fmt6 \
      -num_threads ${NPROC}"
 
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "BLASTN"
-echo -e "   START> blastn" >> $PIPELINE_LOG
-echo -e "    FILE> $(basename ${FASTA_FILE}) \n" >> $PIPELINE_LOG
-echo -e "PROGRESS> [Running]" >> $PIPELINE_LOG
-eval ${BLAST_CMD} >> $PIPELINE_LOG 2> $ERROR_LOG
-echo -e "PROGRESS> [Done   ]\n" >> $PIPELINE_LOG
-echo -e "  OUTPUT> ${OUTNAME}_phix.fmt6" >> $PIPELINE_LOG
-echo -e "     END> blastn\n" >> $PIPELINE_LOG
-check_error
-
-# Add header, need ID column name for Splitseq
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "Add header"
-sed -i '1iID' "${OUTNAME}_phix.fmt6"
-ID_FILE="${OUTNAME}_phixhits.txt"
-sed -r '2,$ s/(^[^\|]*).*/\1/' "${OUTNAME}_phix.fmt6" > ${ID_FILE}
-
-# Filter input fasta/q to names not in the .fmt6 file
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "SplitSeq select"
-SplitSeq.py select -s ${READS} -f ID -t ${ID_FILE} --not --outdir ${OUTDIR} --outname ${OUTNAME} \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
-check_error
+# Without k-mer hits there is nothing to confirm and blastn is not run.
+if begin_step "BLASTN" -i "${KMER_FILE}" -p "${PHIXDB} ${PHIX_VERSION}" -o "${OUTNAME}_phix.fmt6"; then
+    echo -e "   START> blastn" >> $PIPELINE_LOG
+    echo -e "    FILE> $(basename ${KMER_FILE}) \n" >> $PIPELINE_LOG
+    echo -e "PROGRESS> [Running]" >> $PIPELINE_LOG
+    if [ -s ${KMER_FILE} ]; then
+        eval ${BLAST_CMD} >> $PIPELINE_LOG 2> $ERROR_LOG
+    else
+        : > ${OUTNAME}_phix.fmt6
+    fi
+    echo -e "PROGRESS> [Done   ]\n" >> $PIPELINE_LOG
+    echo -e "  OUTPUT> ${OUTNAME}_phix.fmt6" >> $PIPELINE_LOG
+    echo -e "     END> blastn\n" >> $PIPELINE_LOG
+    check_error
+    end_step
+fi
 
-# Remove temporary files
-rm $FASTA_FILE
-if [ ${REMOVED_SEQS} -gt 0 ]; then
-   rm $NO_N_READS
+# Filter input fastq to reads without a blastn hit
+if begin_step "Filter PhiX reads" -i "${READS} ${OUTNAME}_phix.fmt6" -o "${OUTNAME}_selected.fastq"; then
+    echo -e "   START> phix_reads filter" >> $PIPELINE_LOG
+    FILTER_COUNTS=($(phix_reads.py filter -s ${READS} -b ${OUTNAME}_phix.fmt6 -o ${OUTNAME}_selected.fastq \
+        2> $ERROR_LOG))
+    check_error
+    echo -e "    SEQUENCES> ${FILTER_COUNTS[0]}" >> $PIPELINE_LOG
+    echo -e "         PASS> ${FILTER_COUNTS[1]}" >> $PIPELINE_LOG
+    echo -e "         FAIL> $((${FILTER_COUNTS[0]}-${FILTER_COUNTS[1]}))" >> $PIPELINE_LOG
+    echo -e "       OUTPUT> ${OUTNAME}_selected.fastq" >> $PIPELINE_LOG
+    echo -e "          END> phix_reads filter\n" >> $PIPELINE_LOG
+    end_step
 fi
+finish_steps
+
+# Remove temporary files
+rm -f $KMER_FILE
 
 # End
 printf "DONE\n\n"
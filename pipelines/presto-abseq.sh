@@ -24,6 +24,14 @@
 #       Defaults to illumina.
 #   -p  Number of subprocesses for multiprocessing tools.
 #       Defaults to the available processing units.
+#   -t  Directory for the intermediate files of record-streaming steps, such as a RAM disk.
+#       Files are deleted as soon as the next step has read them. Defaults to the output directory.
+#       Steps are still resumed after a failure, but --from-step must start from a step
+#       whose inputs were not deleted.
+#   --from-step  Step number or name to restart from.
+#       Without this option, steps that are up to date from a previous run are skipped.
+#   --compress  Compression program for archived files. One of gzip, pigz or zstd.
+#   --compress-early  Compress intermediate files as soon as no later step reads them.
 #   -h  Display help.
 
 # Print usage
@@ -50,6 +58,11 @@ print_usage() {
             "     Defaults to illumina."
     echo -e "  -p  Number of subprocesses for multiprocessing tools.\n" \
             "     Defaults to the available cores."
+    echo -e "  -t  Directory for the intermediate files of record-streaming steps, such as a RAM disk.\n" \
+            "     Files are deleted as soon as the next step has read them. Defaults to the output directory.\n" \
+            "     Steps are still resumed after a failure, but --from-step must start from a step\n" \
+            "     whose inputs were not deleted."
+    print_step_usage
     echo -e "  -h  This message."
 }
 
@@ -65,9 +78,14 @@ OUTNAME_SET=false
 OUTDIR_SET=false
 NPROC_SET=false
 COORD_SET=false
+STREAM_SET=false
+
+# Load the step runner and remove its arguments
+source pipeline_steps.sh
+step_args "$@"; set -- "${STEP_ARGS[@]}"
 
 # Get commandline arguments
-while getopts "1:2:j:v:c:r:y:n:o:x:p:h" OPT; do
+while getopts "1:2:j:v:c:r:y:n:o:x:p:t:h" OPT; do
     case "$OPT" in
     1)  R1_READS=$OPTARG
         R1_READS_SET=true
@@ -102,6 +120,9 @@ while getopts "1:2:j:v:c:r:y:n:o:x:p:h" OPT; do
     p)  NPROC=$OPTARG
         NPROC_SET=true
         ;;
+    t)  STREAM_DIR=$OPTARG
+        STREAM_SET=true
+        ;;
     h)  print_usage
         exit
         ;;
@@ -156,6 +177,17 @@ else
     fi
 fi
 
+# Check streaming intermediate directory
+if ${STREAM_SET}; then
+    if ! [ -d ${STREAM_DIR} ] || ! [ -w ${STREAM_DIR} ]; then
+        echo -e "Intermediate file directory '${STREAM_DIR}' is not a writable directory." >&2
+        exit 1
+    fi
+    STREAM_DIR="$(realpath ${STREAM_DIR})/presto-abseq-${OUTNAME}"
+else
+    STREAM_DIR="."
+fi
+
 # Check R1 reads
 if [ -e ${R1_READS} ]; then
     R1_READS=$(realpath ${R1_READS})
@@ -277,6 +309,22 @@ mkdir -p ${REPORTDIR}
 echo '' > $PIPELINE_LOG
 echo '' > $ERROR_LOG
 
+# Release intermediate files once no later step reads them
+#
+# Files in the streaming directory are deleted. Other files are compressed with --compress-early.
+# Deleted files are recorded by the step runner, so a rerun after a failure still resumes at the
+# failed step.
+release_files() {
+    for F in "$@"; do
+        if ${STREAM_SET} && [ "$(dirname $F)" == "${STREAM_DIR}" ]; then
+            [ -f $F ] && step_release $F
+            rm -f $F
+        else
+            compress_early $F
+        fi
+    done
+}
+
 # Check for errors
 check_error() {
     if [ -s $ERROR_LOG ]; then
@@ -292,20 +340,24 @@ echo -e "IDENTIFIER: ${OUTNAME}"
 echo -e "DIRECTORY: ${OUTDIR}"
 echo -e "PRESTO VERSION: ${PRESTO_VERSION}"
 echo -e "\nSTART"
-STEP=0
+STEP_VERSION=${PRESTO_VERSION}
+init_steps "${LOGDIR}/steps"
+mkdir -p ${STREAM_DIR}
 
 # Remove low quality reads
 if $FILTER_LOWQUAL; then
-    printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "FilterSeq quality"
-    FilterSeq.py quality -s $R1_READS -q $FS_QUAL --nproc $NPROC \
-        --outname "${OUTNAME}-R1" --outdir . --log "${LOGDIR}/quality-1.log" \
-        >> $PIPELINE_LOG  2> $ERROR_LOG
-    FilterSeq.py quality -s $R2_READS -q $FS_QUAL --nproc $NPROC \
-        --outname "${OUTNAME}-R2" --outdir . --log "${LOGDIR}/quality-2.log"  \
-        >> $PIPELINE_LOG  2> $ERROR_LOG
-    MPR1_FILE="${OUTNAME}-R1_quality-pass.fastq"
-    MPR2_FILE="${OUTNAME}-R2_quality-pass.fastq"
-    check_error
+    MPR1_FILE="${STREAM_DIR}/${OUTNAME}-R1_quality-pass.fastq"
+    MPR2_FILE="${STREAM_DIR}/${OUTNAME}-R2_quality-pass.fastq"
+    if begin_step "FilterSeq quality" -i "$R1_READS $R2_READS" -p "$FS_QUAL" -o "$MPR1_FILE $MPR2_FILE"; then
+        begin_tasks 2 $NPROC
+        run_task "R1" FilterSeq.py quality -s $R1_READS -q $FS_QUAL --nproc $TASK_NPROC \
+            --outname "${OUTNAME}-R1" --outdir ${STREAM_DIR} --log "${LOGDIR}/quality-1.log"
+        run_task "R2" FilterSeq.py quality -s $R2_READS -q $FS_QUAL --nproc $TASK_NPROC \
+            --outname "${OUTNAME}-R2" --outdir ${STREAM_DIR} --log "${LOGDIR}/quality-2.log"
+        wait_tasks
+        check_error
+        end_step
+    fi
 else
     MPR1_FILE=$R1_READS
     MPR2_FILE=$R2_READS
@@ -313,37 +365,52 @@ fi
 
 
 # Identify primers and UID 
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "MaskPrimers score"
-MaskPrimers.py score -s $MPR1_FILE -p $R1_PRIMERS --mode cut \
-    --start 0 --maxerror $MP_R1_MAXERR --nproc $NPROC \
-    --log "${LOGDIR}/primers-1.log" --outname "${OUTNAME}-R1" --outdir . \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
-MaskPrimers.py score -s $MPR2_FILE -p $R2_PRIMERS --mode cut \
-    --start $MP_UIDLEN --barcode --maxerror $MP_R2_MAXERR --nproc $NPROC \
-    --log "${LOGDIR}/primers-2.log" --outname "${OUTNAME}-R2" --outdir . \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
-check_error
+PSR1_FILE="${STREAM_DIR}/${OUTNAME}-R1_primers-pass.fastq"
+PSR2_FILE="${STREAM_DIR}/${OUTNAME}-R2_primers-pass.fastq"
+if begin_step "MaskPrimers score" -i "$MPR1_FILE $MPR2_FILE $R1_PRIMERS $R2_PRIMERS" \
+    -p "$MP_UIDLEN $MP_R1_MAXERR $MP_R2_MAXERR" -o "$PSR1_FILE $PSR2_FILE"; then
+    begin_tasks 2 $NPROC
+    run_task "R1" MaskPrimers.py score -s $MPR1_FILE -p $R1_PRIMERS --mode cut \
+        --start 0 --maxerror $MP_R1_MAXERR --nproc $TASK_NPROC \
+        --log "${LOGDIR}/primers-1.log" --outname "${OUTNAME}-R1" --outdir ${STREAM_DIR}
+    run_task "R2" MaskPrimers.py score -s $MPR2_FILE -p $R2_PRIMERS --mode cut \
+        --start $MP_UIDLEN --barcode --maxerror $MP_R2_MAXERR --nproc $TASK_NPROC \
+        --log "${LOGDIR}/primers-2.log" --outname "${OUTNAME}-R2" --outdir ${STREAM_DIR}
+    wait_tasks
+    check_error
+    end_step
+fi
+release_files $MPR1_FILE $MPR2_FILE
 
 
 # Assign UIDs to read 1 sequences
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "PairSeq"
-PairSeq.py -1 "${OUTNAME}-R1_primers-pass.fastq" -2 "${OUTNAME}-R2_primers-pass.fastq" \
-    --2f BARCODE --coord $COORD >> $PIPELINE_LOG 2> $ERROR_LOG
-check_error
+if begin_step "PairSeq" -i "$PSR1_FILE $PSR2_FILE" -p "$COORD" \
+    -o "${OUTNAME}-R1_primers-pass_pair-pass.fastq ${OUTNAME}-R2_primers-pass_pair-pass.fastq"; then
+    PairSeq.py -1 $PSR1_FILE -2 $PSR2_FILE \
+        --2f BARCODE --coord $COORD --outdir . >> $PIPELINE_LOG 2> $ERROR_LOG
+    check_error
+    end_step
+fi
+release_files $PSR1_FILE $PSR2_FILE
 
 
 # Multiple align UID read groups
 if $ALIGN_SETS; then
-    printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "AlignSets muscle"
-	AlignSets.py muscle -s "${OUTNAME}-R1_primers-pass_pair-pass.fastq" --exec $MUSCLE_EXEC \
-	    --nproc $NPROC --log "${LOGDIR}/align-1.log" --outname "${OUTNAME}-R1" \
-	    >> $PIPELINE_LOG 2> $ERROR_LOG
-	AlignSets.py muscle -s "${OUTNAME}-R2_primers-pass_pair-pass.fastq" --exec $MUSCLE_EXEC \
-	    --nproc $NPROC --log "${LOGDIR}/align-2.log" --outname "${OUTNAME}-R2" \
-	    >> $PIPELINE_LOG 2> $ERROR_LOG
 	BCR1_FILE="${OUTNAME}-R1_align-pass.fastq"
 	BCR2_FILE="${OUTNAME}-R2_align-pass.fastq"
-	check_error
+    if begin_step "AlignSets muscle" \
+        -i "${OUTNAME}-R1_primers-pass_pair-pass.fastq ${OUTNAME}-R2_primers-pass_pair-pass.fastq" \
+        -o "$BCR1_FILE $BCR2_FILE"; then
+	    begin_tasks 2 $NPROC
+	    run_task "R1" AlignSets.py muscle -s "${OUTNAME}-R1_primers-pass_pair-pass.fastq" --exec $MUSCLE_EXEC \
+	        --nproc $TASK_NPROC --log "${LOGDIR}/align-1.log" --outname "${OUTNAME}-R1"
+	    run_task "R2" AlignSets.py muscle -s "${OUTNAME}-R2_primers-pass_pair-pass.fastq" --exec $MUSCLE_EXEC \
+	        --nproc $TASK_NPROC --log "${LOGDIR}/align-2.log" --outname "${OUTNAME}-R2"
+	    wait_tasks
+	    check_error
+	    end_step
+	fi
+	release_files "${OUTNAME}-R1_primers-pass_pair-pass.fastq" "${OUTNAME}-R2_primers-pass_pair-pass.fastq"
 else
 	BCR1_FILE="${OUTNAME}-R1_primers-pass_pair-pass.fastq"
 	BCR2_FILE="${OUTNAME}-R2_primers-pass_pair-pass.fastq"
@@ -351,190 +418,215 @@ fi
 
 
 # Build UID consensus sequences
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "BuildConsensus"
-if $BC_ERR_FLAG; then
+if begin_step "BuildConsensus" -i "$BCR1_FILE $BCR2_FILE" \
+    -p "$BC_PRCONS_FLAG $BC_ERR_FLAG $BC_QUAL $BC_MINCOUNT $BC_MAXERR $BC_PRCONS $BC_MAXGAP" \
+    -o "${OUTNAME}-R1_consensus-pass.fastq ${OUTNAME}-R2_consensus-pass.fastq"; then
+    BC_R1_ARGS=""
+    BC_ARGS="-n $BC_MINCOUNT -q $BC_QUAL --maxgap $BC_MAXGAP"
     if $BC_PRCONS_FLAG; then
-        BuildConsensus.py -s $BCR1_FILE --bf BARCODE --pf PRIMER --prcons $BC_PRCONS \
-            -n $BC_MINCOUNT -q $BC_QUAL --maxerror $BC_MAXERR --maxgap $BC_MAXGAP \
-            --nproc $NPROC --log "${LOGDIR}/consensus-1.log" \
-            --outname "${OUTNAME}-R1" >> $PIPELINE_LOG 2> $ERROR_LOG
-    else
-        BuildConsensus.py -s $BCR1_FILE --bf BARCODE --pf PRIMER \
-            -n $BC_MINCOUNT -q $BC_QUAL --maxerror $BC_MAXERR --maxgap $BC_MAXGAP \
-            --nproc $NPROC --log "${LOGDIR}/consensus-1.log" \
-            --outname "${OUTNAME}-R1" >> $PIPELINE_LOG 2> $ERROR_LOG
+        BC_R1_ARGS="--prcons $BC_PRCONS"
     fi
-
-	BuildConsensus.py -s $BCR2_FILE --bf BARCODE --pf PRIMER \
-	    -n $BC_MINCOUNT -q $BC_QUAL --maxerror $BC_MAXERR --maxgap $BC_MAXGAP \
-	    --nproc $NPROC --log "${LOGDIR}/consensus-2.log" \
-	    --outname "${OUTNAME}-R2" >> $PIPELINE_LOG 2> $ERROR_LOG
-else
-    if $BC_PRCONS_FLAG; then
-        BuildConsensus.py -s $BCR1_FILE --bf BARCODE --pf PRIMER --prcons $BC_PRCONS \
-            -n $BC_MINCOUNT -q $BC_QUAL --maxgap $BC_MAXGAP \
-            --nproc $NPROC --log "${LOGDIR}/consensus-1.log" \
-            --outname "${OUTNAME}-R1" >> $PIPELINE_LOG 2> $ERROR_LOG
-    else
-        BuildConsensus.py -s $BCR1_FILE --bf BARCODE --pf PRIMER \
-            -n $BC_MINCOUNT -q $BC_QUAL --maxgap $BC_MAXGAP \
-            --nproc $NPROC --log "${LOGDIR}/consensus-1.log" \
-            --outname "${OUTNAME}-R1" >> $PIPELINE_LOG 2> $ERROR_LOG
+    if $BC_ERR_FLAG; then
+        BC_ARGS+=" --maxerror $BC_MAXERR"
     fi
 
-	BuildConsensus.py -s $BCR2_FILE --bf BARCODE --pf PRIMER \
-    	-n $BC_MINCOUNT -q $BC_QUAL --maxgap $BC_MAXGAP \
-    	--nproc $NPROC --log "${LOGDIR}/consensus-2.log" \
-    	--outname "${OUTNAME}-R2" >> $PIPELINE_LOG 2> $ERROR_LOG
+    begin_tasks 2 $NPROC
+    run_task "R1" BuildConsensus.py -s $BCR1_FILE --bf BARCODE --pf PRIMER $BC_R1_ARGS $BC_ARGS \
+        --nproc $TASK_NPROC --log "${LOGDIR}/consensus-1.log" --outname "${OUTNAME}-R1"
+    run_task "R2" BuildConsensus.py -s $BCR2_FILE --bf BARCODE --pf PRIMER $BC_ARGS \
+        --nproc $TASK_NPROC --log "${LOGDIR}/consensus-2.log" --outname "${OUTNAME}-R2"
+    wait_tasks
+    check_error
+    end_step
 fi
-check_error
+release_files $BCR1_FILE $BCR2_FILE
 
 
 # Syncronize read files
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "PairSeq"
-PairSeq.py -1 "${OUTNAME}-R1_consensus-pass.fastq" -2 "${OUTNAME}-R2_consensus-pass.fastq" \
-    --coord presto >> $PIPELINE_LOG 2> $ERROR_LOG
-check_error
+if begin_step "PairSeq" -i "${OUTNAME}-R1_consensus-pass.fastq ${OUTNAME}-R2_consensus-pass.fastq" \
+    -o "${OUTNAME}-R1_consensus-pass_pair-pass.fastq ${OUTNAME}-R2_consensus-pass_pair-pass.fastq"; then
+    PairSeq.py -1 "${OUTNAME}-R1_consensus-pass.fastq" -2 "${OUTNAME}-R2_consensus-pass.fastq" \
+        --coord presto >> $PIPELINE_LOG 2> $ERROR_LOG
+    check_error
+    end_step
+fi
+release_files "${OUTNAME}-R1_consensus-pass.fastq" "${OUTNAME}-R2_consensus-pass.fastq"
 
 
 # Assemble paired ends via mate-pair alignment
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "AssemblePairs sequential"
 if $BC_PRCONS_FLAG; then
     PRFIELD="PRCONS"
 else
     PRFIELD="PRIMER"
 fi
-
-AssemblePairs.py sequential -1 "${OUTNAME}-R2_consensus-pass_pair-pass.fastq" \
-    -2 "${OUTNAME}-R1_consensus-pass_pair-pass.fastq" -r $VREF_SEQ \
-    --coord presto --rc tail --1f CONSCOUNT --2f $PRFIELD CONSCOUNT \
-    --minlen $AP_MINLEN --maxerror $AP_MAXERR --alpha $AP_ALPHA --scanrev \
-    --minident $AP_MINIDENT --evalue $AP_EVALUE --maxhits $AP_MAXHITS --aligner blastn \
-    --nproc $NPROC --log "${LOGDIR}/assemble.log" \
-    --outname "${OUTNAME}" >> $PIPELINE_LOG 2> $ERROR_LOG
-PH_FILE="${OUTNAME}_assemble-pass.fastq"
-check_error
+PH_FILE="${STREAM_DIR}/${OUTNAME}_assemble-pass.fastq"
+
+if begin_step "AssemblePairs sequential" \
+    -i "${OUTNAME}-R2_consensus-pass_pair-pass.fastq ${OUTNAME}-R1_consensus-pass_pair-pass.fastq $VREF_SEQ" \
+    -p "$PRFIELD $AP_MINLEN $AP_MAXERR $AP_ALPHA $AP_MINIDENT $AP_EVALUE $AP_MAXHITS" -o "$PH_FILE"; then
+    AssemblePairs.py sequential -1 "${OUTNAME}-R2_consensus-pass_pair-pass.fastq" \
+        -2 "${OUTNAME}-R1_consensus-pass_pair-pass.fastq" -r $VREF_SEQ \
+        --coord presto --rc tail --1f CONSCOUNT --2f $PRFIELD CONSCOUNT \
+        --minlen $AP_MINLEN --maxerror $AP_MAXERR --alpha $AP_ALPHA --scanrev \
+        --minident $AP_MINIDENT --evalue $AP_EVALUE --maxhits $AP_MAXHITS --aligner blastn \
+        --nproc $NPROC --log "${LOGDIR}/assemble.log" \
+        --outname "${OUTNAME}" --outdir ${STREAM_DIR} >> $PIPELINE_LOG 2> $ERROR_LOG
+    check_error
+    end_step
+fi
+release_files "${OUTNAME}-R1_consensus-pass_pair-pass.fastq" "${OUTNAME}-R2_consensus-pass_pair-pass.fastq"
 
 
 # Mask low quality positions
 if $MASK_LOWQUAL; then
-    printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "FilterSeq maskqual"
-    FilterSeq.py maskqual -s $PH_FILE -q $FS_MASK --nproc $NPROC \
-        --outname "${OUTNAME}-MQ" --log "${LOGDIR}/maskqual.log" \
-        >> $PIPELINE_LOG 2> $ERROR_LOG
-    PH_FILE="${OUTNAME}-MQ_maskqual-pass.fastq"
-    check_error
+    if begin_step "FilterSeq maskqual" -i "$PH_FILE" -p "$FS_MASK" \
+        -o "${STREAM_DIR}/${OUTNAME}-MQ_maskqual-pass.fastq"; then
+        FilterSeq.py maskqual -s $PH_FILE -q $FS_MASK --nproc $NPROC \
+            --outname "${OUTNAME}-MQ" --outdir ${STREAM_DIR} --log "${LOGDIR}/maskqual.log" \
+            >> $PIPELINE_LOG 2> $ERROR_LOG
+        check_error
+        end_step
+    fi
+    release_files $PH_FILE
+    PH_FILE="${STREAM_DIR}/${OUTNAME}-MQ_maskqual-pass.fastq"
 fi
 
 
 if $ALIGN_CREGION; then
     # Annotate with internal C-region
-    printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "MaskPrimers align"
     CREGION_FIELD="CREGION"
-    MaskPrimers.py align -s $PH_FILE -p $CREGION_SEQ \
-        --maxlen $CREGION_MAXLEN --maxerror $CREGION_MAXERR \
-        --mode tag --revpr --skiprc --pf $CREGION_FIELD \
-        --log "${LOGDIR}/cregion.log" --outname "${OUTNAME}-CR" --nproc $NPROC \
-        >> $PIPELINE_LOG 2> $ERROR_LOG
-    PH_FILE="${OUTNAME}-CR_primers-pass.fastq"
-    check_error
+    if begin_step "MaskPrimers align" -i "$PH_FILE $CREGION_SEQ" -p "$CREGION_MAXLEN $CREGION_MAXERR" \
+        -o "${STREAM_DIR}/${OUTNAME}-CR_primers-pass.fastq"; then
+        MaskPrimers.py align -s $PH_FILE -p $CREGION_SEQ \
+            --maxlen $CREGION_MAXLEN --maxerror $CREGION_MAXERR \
+            --mode tag --revpr --skiprc --pf $CREGION_FIELD \
+            --log "${LOGDIR}/cregion.log" --outname "${OUTNAME}-CR" --outdir ${STREAM_DIR} --nproc $NPROC \
+            >> $PIPELINE_LOG 2> $ERROR_LOG
+        check_error
+        end_step
+    fi
+    release_files $PH_FILE
+    PH_FILE="${STREAM_DIR}/${OUTNAME}-CR_primers-pass.fastq"
 else
     CREGION_FIELD=""
 fi
 
 
 # Rewrite header with minimum of CONSCOUNT
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ParseHeaders collapse"
-ParseHeaders.py collapse -s $PH_FILE -f CONSCOUNT --act min \
-    --outname "${OUTNAME}-final" > /dev/null 2> $ERROR_LOG
-mv "${OUTNAME}-final_reheader.fastq" "${OUTNAME}-final_total.fastq"
-check_error
+if begin_step "ParseHeaders collapse" -i "$PH_FILE" -o "${OUTNAME}-final_total.fastq"; then
+    ParseHeaders.py collapse -s $PH_FILE -f CONSCOUNT --act min \
+        --outname "${OUTNAME}-final" --outdir . > /dev/null 2> $ERROR_LOG
+    mv "${OUTNAME}-final_reheader.fastq" "${OUTNAME}-final_total.fastq"
+    check_error
+    end_step
+fi
+release_files $PH_FILE
 
 
 # Remove duplicate sequences
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "CollapseSeq"
-if $CS_KEEP; then
-    CollapseSeq.py -s "${OUTNAME}-final_total.fastq" -n $CS_MISS \
-    --uf PRCONS $CREGION_FIELD --cf CONSCOUNT --act sum --inner \
-    --keepmiss --outname "${OUTNAME}-final" >> $PIPELINE_LOG 2> $ERROR_LOG
-else
-    CollapseSeq.py -s "${OUTNAME}-final_total.fastq" -n $CS_MISS \
-    --uf PRCONS $CREGION_FIELD --cf CONSCOUNT --act sum --inner \
-    --outname "${OUTNAME}-final" >> $PIPELINE_LOG 2> $ERROR_LOG
+if begin_step "CollapseSeq" -i "${OUTNAME}-final_total.fastq" -p "$CS_KEEP $CS_MISS $CREGION_FIELD" \
+    -o "${OUTNAME}-final_collapse-unique.fastq"; then
+    if $CS_KEEP; then
+        CollapseSeq.py -s "${OUTNAME}-final_total.fastq" -n $CS_MISS \
+        --uf PRCONS $CREGION_FIELD --cf CONSCOUNT --act sum --inner \
+        --keepmiss --outname "${OUTNAME}-final" >> $PIPELINE_LOG 2> $ERROR_LOG
+    else
+        CollapseSeq.py -s "${OUTNAME}-final_total.fastq" -n $CS_MISS \
+        --uf PRCONS $CREGION_FIELD --cf CONSCOUNT --act sum --inner \
+        --outname "${OUTNAME}-final" >> $PIPELINE_LOG 2> $ERROR_LOG
+    fi
+    check_error
+    end_step
 fi
-check_error
 
 
 # Filter to sequences with at least 2 supporting sources
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "SplitSeq group"
-SplitSeq.py group -s "${OUTNAME}-final_collapse-unique.fastq" -f CONSCOUNT --num 2 \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
-check_error
+if begin_step "SplitSeq group" -i "${OUTNAME}-final_collapse-unique.fastq" \
+    -o "${OUTNAME}-final_collapse-unique_atleast-2.fastq"; then
+    SplitSeq.py group -s "${OUTNAME}-final_collapse-unique.fastq" -f CONSCOUNT --num 2 \
+        >> $PIPELINE_LOG 2> $ERROR_LOG
+    check_error
+    end_step
+fi
 
 
 # Create table of final repertoire
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ParseHeaders table"
-ParseHeaders.py table -s "${OUTNAME}-final_total.fastq" \
-    -f ID PRCONS $CREGION_FIELD CONSCOUNT --outname "final-total" \
-    --outdir ${LOGDIR} >> $PIPELINE_LOG 2> $ERROR_LOG
-ParseHeaders.py table -s "${OUTNAME}-final_collapse-unique.fastq" \
-    -f ID PRCONS $CREGION_FIELD CONSCOUNT DUPCOUNT --outname "final-unique" \
-    --outdir ${LOGDIR} >> $PIPELINE_LOG 2> $ERROR_LOG
-ParseHeaders.py table -s "${OUTNAME}-final_collapse-unique_atleast-2.fastq" \
-    -f ID PRCONS $CREGION_FIELD CONSCOUNT DUPCOUNT --outname "final-unique-atleast2" \
-    --outdir ${LOGDIR} >> $PIPELINE_LOG 2> $ERROR_LOG
-check_error
+if begin_step "ParseHeaders table"; then
+    begin_tasks 3 $NPROC
+    run_task "total" ParseHeaders.py table -s "${OUTNAME}-final_total.fastq" \
+        -f ID PRCONS $CREGION_FIELD CONSCOUNT --outname "final-total" \
+        --outdir ${LOGDIR}
+    run_task "unique" ParseHeaders.py table -s "${OUTNAME}-final_collapse-unique.fastq" \
+        -f ID PRCONS $CREGION_FIELD CONSCOUNT DUPCOUNT --outname "final-unique" \
+        --outdir ${LOGDIR}
+    run_task "atleast-2" ParseHeaders.py table -s "${OUTNAME}-final_collapse-unique_atleast-2.fastq" \
+        -f ID PRCONS $CREGION_FIELD CONSCOUNT DUPCOUNT --outname "final-unique-atleast2" \
+        --outdir ${LOGDIR}
+    wait_tasks
+    check_error
+    end_step
+fi
 
 
 # Process log files
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ParseLog"
-if $FILTER_LOWQUAL; then
-    ParseLog.py -l "${LOGDIR}/quality-1.log" "${LOGDIR}/quality-2.log" -f ID QUALITY \
-        --outdir ${LOGDIR} > /dev/null &
-fi
-ParseLog.py -l "${LOGDIR}/primers-1.log" "${LOGDIR}/primers-2.log" -f ID BARCODE PRIMER ERROR \
-    --outdir ${LOGDIR} > /dev/null  2> $ERROR_LOG &
-ParseLog.py -l "${LOGDIR}/consensus-1.log" "${LOGDIR}/consensus-2.log" \
-    -f BARCODE SEQCOUNT CONSCOUNT PRIMER PRCONS PRCOUNT PRFREQ ERROR \
-    --outdir ${LOGDIR} > /dev/null  2> $ERROR_LOG &
-ParseLog.py -l "${LOGDIR}/assemble.log" \
-    -f ID REFID LENGTH OVERLAP GAP ERROR PVALUE EVALUE1 EVALUE2 IDENTITY FIELDS1 FIELDS2 \
-    --outdir ${LOGDIR} > /dev/null  2> $ERROR_LOG &
-if $MASK_LOWQUAL; then
-    ParseLog.py -l "${LOGDIR}/maskqual.log" -f ID MASKED \
-        --outdir ${LOGDIR} > /dev/null  2> $ERROR_LOG &
-fi
-if $ALIGN_CREGION; then
-    ParseLog.py -l "${LOGDIR}/cregion.log" -f ID PRIMER ERROR \
-        --outdir ${LOGDIR} > /dev/null  2> $ERROR_LOG &
+if begin_step "ParseLog"; then
+    begin_tasks 6 $NPROC
+    if $FILTER_LOWQUAL; then
+        run_task "quality" ParseLog.py -l "${LOGDIR}/quality-1.log" "${LOGDIR}/quality-2.log" -f ID QUALITY \
+            --outdir ${LOGDIR}
+    fi
+    run_task "primers" ParseLog.py -l "${LOGDIR}/primers-1.log" "${LOGDIR}/primers-2.log" \
+        -f ID BARCODE PRIMER ERROR --outdir ${LOGDIR}
+    run_task "consensus" ParseLog.py -l "${LOGDIR}/consensus-1.log" "${LOGDIR}/consensus-2.log" \
+        -f BARCODE SEQCOUNT CONSCOUNT PRIMER PRCONS PRCOUNT PRFREQ ERROR \
+        --outdir ${LOGDIR}
+    run_task "assemble" ParseLog.py -l "${LOGDIR}/assemble.log" \
+        -f ID REFID LENGTH OVERLAP GAP ERROR PVALUE EVALUE1 EVALUE2 IDENTITY FIELDS1 FIELDS2 \
+        --outdir ${LOGDIR}
+    if $MASK_LOWQUAL; then
+        run_task "maskqual" ParseLog.py -l "${LOGDIR}/maskqual.log" -f ID MASKED \
+            --outdir ${LOGDIR}
+    fi
+    if $ALIGN_CREGION; then
+        run_task "cregion" ParseLog.py -l "${LOGDIR}/cregion.log" -f ID PRIMER ERROR \
+            --outdir ${LOGDIR}
+    fi
+    wait_tasks
+    check_error
+    end_step
 fi
-wait
-check_error
 
 # Generate pRESTO report
-if $REPORT; then
-    printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "Generating report"
+if $REPORT && begin_step "Generating report"; then
     REPORT_SCRIPT="report_abseq3(\"${LOGDIR}\", sample=\"${OUTNAME}\", output_dir=\"${REPORTDIR}\", config=\"${YAML}\", quiet=FALSE)"
     Rscript -e "library(prestor); ${REPORT_SCRIPT}" > ${REPORTDIR}/report.out 2> ${REPORTDIR}/report.err
+    end_step
 fi
 
 # Zip or delete intermediate and log files
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "Compressing files"
-LOG_FILES=$(ls ${LOGDIR}/*.log | grep -v "pipeline")
-FILTER_FILES="$(basename ${R1_READS})\|$(basename ${R2_READS})\|$(basename ${R1_PRIMERS})\|$(basename ${R2_PRIMERS})"
-FILTER_FILES+="\|final_total.fastq\|final_collapse-unique.fastq\|final_collapse-unique_atleast-2.fastq"
-TEMP_FILES=$(ls *.fastq  2>/dev/null | grep -v ${FILTER_FILES})
-if $ZIP_FILES; then
-    tar -zcf log_files.tar.gz $LOG_FILES
-    tar -zcf temp_files.tar.gz $TEMP_FILES
+if begin_step "Compressing files"; then
+    LOG_FILES=$(ls ${LOGDIR}/*.log | grep -v "pipeline")
+    FILTER_FILES="$(basename ${R1_READS})\|$(basename ${R2_READS})\|$(basename ${R1_PRIMERS})\|$(basename ${R2_PRIMERS})"
+    FILTER_FILES+="\|final_total.fastq\|final_collapse-unique.fastq\|final_collapse-unique_atleast-2.fastq"
+    TEMP_FILES=$(ls *.fastq  2>/dev/null | grep -v ${FILTER_FILES})
+    if $ZIP_FILES; then
+        archive_files log_files $LOG_FILES
+        archive_files temp_files $TEMP_FILES "${EARLY_FILES[@]}"
+    fi
+    if $DELETE_FILES; then
+        rm -f $TEMP_FILES
+        rm -f $LOG_FILES
+    fi
+    end_step
 fi
-if $DELETE_FILES; then
-    rm $TEMP_FILES
-    rm $LOG_FILES
+finish_steps
+
+# Remove the streaming intermediate directory
+if ${STREAM_SET}; then
+    rm -rf ${STREAM_DIR}
 fi
 
 
 # End
 printf "DONE\n\n"
 cd ../
-
@@ -23,6 +23,10 @@
 #       Defaults to illumina.
 #   -p  Number of subprocesses for multiprocessing tools.
 #       Defaults to the available processing units.
+#   --from-step  Step number or name to restart from.
+#       Without this option, steps that are up to date from a previous run are skipped.
+#   --compress  Compression program for archived files. One of gzip, pigz or zstd.
+#   --compress-early  Compress intermediate files as soon as no later step reads them.
 #   -h  Display help.
 
 # Print usage
@@ -48,6 +52,7 @@ print_usage() {
             "     Defaults to illumina."
     echo -e "  -p  Number of subprocesses for multiprocessing tools.\n" \
             "     Defaults to the available cores."
+    print_step_usage
     echo -e "  -h  This message."
 }
 
@@ -63,6 +68,10 @@ OUTDIR_SET=false
 NPROC_SET=false
 COORD_SET=false
 
+# Load the step runner and remove its arguments
+source pipeline_steps.sh
+step_args "$@"; set -- "${STEP_ARGS[@]}"
+
 # Get commandline arguments
 while getopts "1:2:j:v:r:f:n:o:x:p:h" OPT; do
     case "$OPT" in
@@ -229,79 +238,97 @@ echo -e "IDENTIFIER: ${OUTNAME}"
 echo -e "DIRECTORY: ${OUTDIR}"
 echo -e "PRESTO VERSION: ${PRESTO_VERSION}"
 echo -e "\nSTART"
-STEP=0
+STEP_VERSION=${PRESTO_VERSION}
+init_steps "${LOGDIR}/steps"
 
 # Assemble paired ends via mate-pair alignment
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "AssemblePairs sequential"
-AssemblePairs.py sequential -1 $R2_READS -2 $R1_READS -r $VREF_SEQ \
-    --coord $COORD --rc tail --minlen $AP_MINLEN --maxerror $AP_MAXERR --alpha $AP_ALPHA \
-    --scanrev --minident $AP_MINIDENT --evalue $AP_EVALUE --maxhits $AP_MAXHITS --aligner blastn \
-    --nproc $NPROC --log "${LOGDIR}/assemble.log" --outname "${OUTNAME}" --outdir . \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
-check_error
+if begin_step "AssemblePairs sequential" -i "$R1_READS $R2_READS $VREF_SEQ" \
+    -p "$COORD $AP_MINLEN $AP_MAXERR $AP_ALPHA $AP_MINIDENT $AP_EVALUE $AP_MAXHITS" \
+    -o "${OUTNAME}_assemble-pass.fastq"; then
+    AssemblePairs.py sequential -1 $R2_READS -2 $R1_READS -r $VREF_SEQ \
+        --coord $COORD --rc tail --minlen $AP_MINLEN --maxerror $AP_MAXERR --alpha $AP_ALPHA \
+        --scanrev --minident $AP_MINIDENT --evalue $AP_EVALUE --maxhits $AP_MAXHITS --aligner blastn \
+        --nproc $NPROC --log "${LOGDIR}/assemble.log" --outname "${OUTNAME}" --outdir . \
+        >> $PIPELINE_LOG 2> $ERROR_LOG
+    check_error
+    end_step
+fi
 
 # Remove low quality reads
 if $FILTER_LOWQUAL; then
-    printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "FilterSeq quality"
-    #OUTPREFIX="$(printf '%02d' $STEP)--${OUTNAME}"
-    FilterSeq.py quality -s "${OUTNAME}_assemble-pass.fastq" -q $FS_QUAL --nproc $NPROC \
-        --outname "${OUTNAME}" --log "${LOGDIR}/quality.log" \
-        >> $PIPELINE_LOG  2> $ERROR_LOG
     MP_FILE="${OUTNAME}_quality-pass.fastq"
-    check_error
+    if begin_step "FilterSeq quality" -i "${OUTNAME}_assemble-pass.fastq" -p "$FS_QUAL" -o "$MP_FILE"; then
+        #OUTPREFIX="$(printf '%02d' $STEP)--${OUTNAME}"
+        FilterSeq.py quality -s "${OUTNAME}_assemble-pass.fastq" -q $FS_QUAL --nproc $NPROC \
+            --outname "${OUTNAME}" --log "${LOGDIR}/quality.log" \
+            >> $PIPELINE_LOG  2> $ERROR_LOG
+        check_error
+        end_step
+    fi
 else
     MP_FILE="${OUTNAME}_assemble-pass.fastq"
 fi
 
 # Identify primers and UID
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "MaskPrimers score"
-MaskPrimers.py score -s $MP_FILE -p $R2_PRIMERS --mode cut \
-    --start $MP_UIDLEN --barcode --maxerror $MP_R2_MAXERR --nproc $NPROC \
-    --log "${LOGDIR}/primers-2.log" --outname "${OUTNAME}" \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
-MaskPrimers.py score -s "${OUTNAME}_primers-pass.fastq" -p $R1_PRIMERS --mode cut \
-    --start 0 --maxerror $MP_R1_MAXERR --revpr --nproc $NPROC \
-    --log "${LOGDIR}/primers-1.log" \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
-check_error
+if begin_step "MaskPrimers score" -i "$MP_FILE $R1_PRIMERS $R2_PRIMERS" \
+    -p "$MP_UIDLEN $MP_R1_MAXERR $MP_R2_MAXERR" -o "${OUTNAME}_primers-pass_primers-pass.fastq"; then
+    MaskPrimers.py score -s $MP_FILE -p $R2_PRIMERS --mode cut \
+        --start $MP_UIDLEN --barcode --maxerror $MP_R2_MAXERR --nproc $NPROC \
+        --log "${LOGDIR}/primers-2.log" --outname "${OUTNAME}" \
+        >> $PIPELINE_LOG 2> $ERROR_LOG
+    MaskPrimers.py score -s "${OUTNAME}_primers-pass.fastq" -p $R1_PRIMERS --mode cut \
+        --start 0 --maxerror $MP_R1_MAXERR --revpr --nproc $NPROC \
+        --log "${LOGDIR}/primers-1.log" \
+        >> $PIPELINE_LOG 2> $ERROR_LOG
+    check_error
+    end_step
+fi
 
 # Add sample annotation
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ParseHeaders"
-ParseHeaders.py add -s "${OUTNAME}_primers-pass_primers-pass.fastq" \
-    -f $SAMFIELD -u $OUTNAME --outname "${OUTNAME}"  > /dev/null 2> $ERROR_LOG &
-check_error
+if begin_step "ParseHeaders" -i "${OUTNAME}_primers-pass_primers-pass.fastq" -p "$SAMFIELD" \
+    -o "${OUTNAME}_reheader.fastq"; then
+    ParseHeaders.py add -s "${OUTNAME}_primers-pass_primers-pass.fastq" \
+        -f $SAMFIELD -u $OUTNAME --outname "${OUTNAME}"  > /dev/null 2> $ERROR_LOG &
+    wait
+    check_error
+    end_step
+fi
 
 # Process log files
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ParseLog"
-ParseLog.py -l "${LOGDIR}/assemble.log" \
-    -f ID REFID LENGTH OVERLAP GAP ERROR PVALUE EVALUE1 EVALUE2 IDENTITY FIELDS1 FIELDS2 \
-    --outdir ${LOGDIR} > /dev/null 2> $ERROR_LOG &
-if $FILTER_LOWQUAL; then
-    ParseLog.py -l "${LOGDIR}/quality.log" -f ID QUALITY --outdir ${LOGDIR} \
-         > /dev/null 2> $ERROR_LOG &
+if begin_step "ParseLog"; then
+    begin_tasks 3 $NPROC
+    run_task "assemble" ParseLog.py -l "${LOGDIR}/assemble.log" \
+        -f ID REFID LENGTH OVERLAP GAP ERROR PVALUE EVALUE1 EVALUE2 IDENTITY FIELDS1 FIELDS2 \
+        --outdir ${LOGDIR}
+    if $FILTER_LOWQUAL; then
+        run_task "quality" ParseLog.py -l "${LOGDIR}/quality.log" -f ID QUALITY --outdir ${LOGDIR}
+    fi
+    run_task "primers" ParseLog.py -l "${LOGDIR}/primers-1.log" "${LOGDIR}/primers-2.log" \
+        -f ID BARCODE PRIMER ERROR --outdir ${LOGDIR}
+    wait_tasks
+    check_error
+    end_step
 fi
-ParseLog.py -l "${LOGDIR}/primers-1.log" "${LOGDIR}/primers-2.log" -f ID BARCODE PRIMER ERROR \
-    --outdir ${LOGDIR} > /dev/null 2> $ERROR_LOG &
-wait
-check_error
 
 # Zip or delete intermediate and log files
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "Compressing files"
-LOG_FILES=$(ls ${LOGDIR}/*.log | grep -v "pipeline")
-FILTER_FILES="$(basename ${R1_READS})\|$(basename ${R2_READS})\|$(basename ${R1_PRIMERS})\|$(basename ${R2_PRIMERS})"
-FILTER_FILES+="\|reheader.fastq"
-TEMP_FILES=$(ls *.fastq | grep -v ${FILTER_FILES})
-if $ZIP_FILES; then
-    tar -zcf log_files.tar.gz $LOG_FILES
-    tar -zcf temp_files.tar.gz $TEMP_FILES
-fi
-if $DELETE_FILES; then
-    rm $TEMP_FILES
-    rm $LOG_FILES
+if begin_step "Compressing files"; then
+    LOG_FILES=$(ls ${LOGDIR}/*.log | grep -v "pipeline")
+    FILTER_FILES="$(basename ${R1_READS})\|$(basename ${R2_READS})\|$(basename ${R1_PRIMERS})\|$(basename ${R2_PRIMERS})"
+    FILTER_FILES+="\|reheader.fastq"
+    TEMP_FILES=$(ls *.fastq | grep -v ${FILTER_FILES})
+    if $ZIP_FILES; then
+        archive_files log_files $LOG_FILES
+        archive_files temp_files $TEMP_FILES
+    fi
+    if $DELETE_FILES; then
+        rm -f $TEMP_FILES
+        rm -f $LOG_FILES
+    fi
+    end_step
 fi
+finish_steps
 
 
 # End
 printf "DONE\n\n"
 cd ../
-
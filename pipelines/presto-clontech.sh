@@ -19,6 +19,10 @@
 #       Defaults to illumina.
 #   -p  Number of subprocesses for multiprocessing tools.
 #       Defaults to the available processing units.
+#   --from-step  Step number or name to restart from.
+#       Without this option, steps that are up to date from a previous run are skipped.
+#   --compress  Compression program for archived files. One of gzip, pigz or zstd.
+#   --compress-early  Compress intermediate files as soon as no later step reads them.
 #   -h  Display help.
 
 # Print usage
@@ -40,6 +44,7 @@ print_usage() {
             "     Defaults to illumina."
     echo -e "  -p  Number of subprocesses for multiprocessing tools.\n" \
             "     Defaults to the available cores."
+    print_step_usage
     echo -e "  -h  This message."
 }
 
@@ -53,6 +58,10 @@ OUTDIR_SET=false
 NPROC_SET=false
 COORD_SET=false
 
+# Load the step runner and remove its arguments
+source pipeline_steps.sh
+step_args "$@"; set -- "${STEP_ARGS[@]}"
+
 # Get commandline arguments
 while getopts "1:2:j:r:n:o:x:p:h" OPT; do
     case "$OPT" in
@@ -218,92 +227,113 @@ echo -e "IDENTIFIER: ${OUTNAME}"
 echo -e "DIRECTORY: ${OUTDIR}"
 echo -e "PRESTO VERSION: ${PRESTO_VERSION}"
 echo -e "\nSTART"
-STEP=0
+STEP_VERSION=${PRESTO_VERSION}
+init_steps "${LOGDIR}/steps"
 
 # Assemble paired ends via mate-pair alignment
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "AssemblePairs sequential"
-AssemblePairs.py sequential -1 $R2_READS -2 $R1_READS -r $VREF_SEQ \
-    --coord $COORD --rc tail --minlen $AP_MINLEN --maxerror $AP_MAXERR --alpha $AP_ALPHA \
-    --scanrev --minident $AP_MINIDENT --evalue $AP_EVALUE --maxhits $AP_MAXHITS --aligner blastn \
-    --nproc $NPROC --log "${LOGDIR}/assemble.log" --outname "${OUTNAME}" --outdir . \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
-check_error
+if begin_step "AssemblePairs sequential" -i "$R1_READS $R2_READS $VREF_SEQ" \
+    -p "$COORD $AP_MINLEN $AP_MAXERR $AP_ALPHA $AP_MINIDENT $AP_EVALUE $AP_MAXHITS" \
+    -o "${OUTNAME}_assemble-pass.fastq"; then
+    AssemblePairs.py sequential -1 $R2_READS -2 $R1_READS -r $VREF_SEQ \
+        --coord $COORD --rc tail --minlen $AP_MINLEN --maxerror $AP_MAXERR --alpha $AP_ALPHA \
+        --scanrev --minident $AP_MINIDENT --evalue $AP_EVALUE --maxhits $AP_MAXHITS --aligner blastn \
+        --nproc $NPROC --log "${LOGDIR}/assemble.log" --outname "${OUTNAME}" --outdir . \
+        >> $PIPELINE_LOG 2> $ERROR_LOG
+    check_error
+    end_step
+fi
 
 # Remove low quality reads
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "FilterSeq quality"
-FilterSeq.py quality -s "${OUTNAME}_assemble-pass.fastq" -q $FS_QUAL --nproc $NPROC \
-    --outname "${OUTNAME}" --log "${LOGDIR}/quality.log" \
-    >> $PIPELINE_LOG  2> $ERROR_LOG
 MP_FILE="${OUTNAME}_quality-pass.fastq"
-check_error
+if begin_step "FilterSeq quality" -i "${OUTNAME}_assemble-pass.fastq" -p "$FS_QUAL" -o "$MP_FILE"; then
+    FilterSeq.py quality -s "${OUTNAME}_assemble-pass.fastq" -q $FS_QUAL --nproc $NPROC \
+        --outname "${OUTNAME}" --log "${LOGDIR}/quality.log" \
+        >> $PIPELINE_LOG  2> $ERROR_LOG
+    check_error
+    end_step
+fi
 
 # Annotate C-region
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "MaskPrimers align"
-MaskPrimers.py align -s $MP_FILE -p $C_PRIMERS --mode cut --skiprc --revpr\
-    --maxlen $MP_MAXLEN --maxerror $MP_MAXERR --pf ${C_FIELD}  \
-    --nproc $NPROC --log "${LOGDIR}/cregion.log" --outname "${OUTNAME}" \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
 CS_FILE="${OUTNAME}_primers-pass.fastq"
-check_error
+if begin_step "MaskPrimers align" -i "$MP_FILE $C_PRIMERS" -p "$MP_MAXLEN $MP_MAXERR $C_FIELD" -o "$CS_FILE"; then
+    MaskPrimers.py align -s $MP_FILE -p $C_PRIMERS --mode cut --skiprc --revpr\
+        --maxlen $MP_MAXLEN --maxerror $MP_MAXERR --pf ${C_FIELD}  \
+        --nproc $NPROC --log "${LOGDIR}/cregion.log" --outname "${OUTNAME}" \
+        >> $PIPELINE_LOG 2> $ERROR_LOG
+    check_error
+    end_step
+fi
 
 # Remove duplicate sequences
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "CollapseSeq"
-if $CS_KEEP; then
-    CollapseSeq.py -s $CS_FILE -n $CS_MISS --inner --keepmiss --uf ${C_FIELD} \
-        --outname "${OUTNAME}-final" >> $PIPELINE_LOG 2> $ERROR_LOG
-else
-    CollapseSeq.py -s $CS_FILE -n $CS_MISS --inner --uf ${C_FIELD} \
-        --outname "${OUTNAME}-final" >> $PIPELINE_LOG 2> $ERROR_LOG
+if begin_step "CollapseSeq" -i "$CS_FILE" -p "$CS_KEEP $CS_MISS $C_FIELD" \
+    -o "${OUTNAME}-final_collapse-unique.fastq"; then
+    if $CS_KEEP; then
+        CollapseSeq.py -s $CS_FILE -n $CS_MISS --inner --keepmiss --uf ${C_FIELD} \
+            --outname "${OUTNAME}-final" >> $PIPELINE_LOG 2> $ERROR_LOG
+    else
+        CollapseSeq.py -s $CS_FILE -n $CS_MISS --inner --uf ${C_FIELD} \
+            --outname "${OUTNAME}-final" >> $PIPELINE_LOG 2> $ERROR_LOG
+    fi
+    check_error
+    end_step
 fi
-check_error
 
 # Filter to sequences with at least 2 supporting sources
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "SplitSeq group"
-SplitSeq.py group -s "${OUTNAME}-final_collapse-unique.fastq" -f DUPCOUNT --num 2 \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
-check_error
+if begin_step "SplitSeq group" -i "${OUTNAME}-final_collapse-unique.fastq" \
+    -o "${OUTNAME}-final_collapse-unique_atleast-2.fastq"; then
+    SplitSeq.py group -s "${OUTNAME}-final_collapse-unique.fastq" -f DUPCOUNT --num 2 \
+        >> $PIPELINE_LOG 2> $ERROR_LOG
+    check_error
+    end_step
+fi
 
 # Create table of final repertoire
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ParseHeaders table"
-ParseHeaders.py table -s ${CS_FILE} -f ID ${C_FIELD} \
-    --outname "final-total" --outdir ${LOGDIR} >> $PIPELINE_LOG 2> $ERROR_LOG
-ParseHeaders.py table -s "${OUTNAME}-final_collapse-unique.fastq" -f ID ${C_FIELD} DUPCOUNT \
-    --outname "final-unique" --outdir ${LOGDIR} >> $PIPELINE_LOG 2> $ERROR_LOG
-ParseHeaders.py table -s "${OUTNAME}-final_collapse-unique_atleast-2.fastq" -f ID ${C_FIELD} DUPCOUNT \
-    --outname "final-unique-atleast2" --outdir ${LOGDIR} >> $PIPELINE_LOG 2> $ERROR_LOG
-check_error
+if begin_step "ParseHeaders table"; then
+    ParseHeaders.py table -s ${CS_FILE} -f ID ${C_FIELD} \
+        --outname "final-total" --outdir ${LOGDIR} >> $PIPELINE_LOG 2> $ERROR_LOG
+    ParseHeaders.py table -s "${OUTNAME}-final_collapse-unique.fastq" -f ID ${C_FIELD} DUPCOUNT \
+        --outname "final-unique" --outdir ${LOGDIR} >> $PIPELINE_LOG 2> $ERROR_LOG
+    ParseHeaders.py table -s "${OUTNAME}-final_collapse-unique_atleast-2.fastq" -f ID ${C_FIELD} DUPCOUNT \
+        --outname "final-unique-atleast2" --outdir ${LOGDIR} >> $PIPELINE_LOG 2> $ERROR_LOG
+    check_error
+    end_step
+fi
 
 # Process log files
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ParseLog"
-ParseLog.py -l "${LOGDIR}/assemble.log" \
-    -f ID REFID LENGTH OVERLAP GAP ERROR PVALUE EVALUE1 EVALUE2 IDENTITY \
-    --outdir ${LOGDIR} > /dev/null 2> $ERROR_LOG &
-if $FILTER_LOWQUAL; then
-    ParseLog.py -l "${LOGDIR}/quality.log" -f ID QUALITY --outdir ${LOGDIR} \
-         > /dev/null 2> $ERROR_LOG &
+if begin_step "ParseLog"; then
+    ParseLog.py -l "${LOGDIR}/assemble.log" \
+        -f ID REFID LENGTH OVERLAP GAP ERROR PVALUE EVALUE1 EVALUE2 IDENTITY \
+        --outdir ${LOGDIR} > /dev/null 2> $ERROR_LOG &
+    if $FILTER_LOWQUAL; then
+        ParseLog.py -l "${LOGDIR}/quality.log" -f ID QUALITY --outdir ${LOGDIR} \
+             > /dev/null 2> $ERROR_LOG &
+    fi
+    ParseLog.py -l "${LOGDIR}/cregion.log" -f ID PRSTART PRIMER ERROR \
+        --outdir ${LOGDIR} > /dev/null 2> $ERROR_LOG &
+    wait
+    check_error
+    end_step
 fi
-ParseLog.py -l "${LOGDIR}/cregion.log" -f ID PRSTART PRIMER ERROR \
-    --outdir ${LOGDIR} > /dev/null 2> $ERROR_LOG &
-wait
-check_error
 
 # Zip or delete intermediate and log files
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "Compressing files"
-LOG_FILES=$(ls ${LOGDIR}/*.log | grep -v "pipeline")
-FILTER_FILES="$(basename ${R1_READS})\|$(basename ${R2_READS})\|$(basename ${C_PRIMERS}))"
-FILTER_FILES+="\|final_collapse-unique.fastq\|final_collapse-unique_atleast-2.fastq"
-TEMP_FILES=$(ls *.fastq | grep -v ${FILTER_FILES})
-if $ZIP_FILES; then
-    tar -zcf log_files.tar.gz $LOG_FILES
-    tar -zcf temp_files.tar.gz $TEMP_FILES
-fi
-if $DELETE_FILES; then
-    rm $TEMP_FILES
-    rm $LOG_FILES
+if begin_step "Compressing files"; then
+    LOG_FILES=$(ls ${LOGDIR}/*.log | grep -v "pipeline")
+    FILTER_FILES="$(basename ${R1_READS})\|$(basename ${R2_READS})\|$(basename ${C_PRIMERS}))"
+    FILTER_FILES+="\|final_collapse-unique.fastq\|final_collapse-unique_atleast-2.fastq"
+    TEMP_FILES=$(ls *.fastq | grep -v ${FILTER_FILES})
+    if $ZIP_FILES; then
+        archive_files log_files $LOG_FILES
+        archive_files temp_files $TEMP_FILES
+    fi
+    if $DELETE_FILES; then
+        rm -f $TEMP_FILES
+        rm -f $LOG_FILES
+    fi
+    end_step
 fi
+finish_steps
 
 
 # End
 printf "DONE\n\n"
 cd ../
-
@@ -14,6 +14,10 @@
 #       Defaults to a directory matching the sample identifier in the current working directory.
 #   -p  Number of subprocesses for multiprocessing tools.
 #       Defaults to the available processing units.
+#   --from-step  Step number or name to restart from.
+#       Without this option, steps that are up to date from a previous run are skipped.
+#   --compress  Compression program for archived files. One of gzip, pigz or zstd.
+#   --compress-early  Compress intermediate files as soon as no later step reads them.
 #   -h  Display help.
 
 # Print usage
@@ -28,6 +32,7 @@ print_usage() {
             "     Defaults to a directory matching the sample identifier in the current working directory."
     echo -e "  -p  Number of subprocesses for multiprocessing tools.\n" \
             "     Defaults to the available cores."
+    print_step_usage
     echo -e "  -h  This message."
 }
 
@@ -38,6 +43,10 @@ OUTNAME_SET=false
 OUTDIR_SET=false
 NPROC_SET=false
 
+# Load the step runner and remove its arguments
+source pipeline_steps.sh
+step_args "$@"; set -- "${STEP_ARGS[@]}"
+
 # Get commandline arguments
 while getopts "s:c::n:o:p:h" OPT; do
     case "$OPT" in
@@ -168,150 +177,186 @@ echo -e "IDENTIFIER: ${OUTNAME}"
 echo -e "DIRECTORY: ${OUTDIR}"
 echo -e "PRESTO VERSION: ${PRESTO_VERSION}"
 echo -e "\nSTART"
-STEP=0
+STEP_VERSION=${PRESTO_VERSION}
+init_steps "${LOGDIR}/steps"
 
 # Multiple align UID read groups
 if $ALIGN_SETS; then
-    printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "AlignSets muscle"
-	AlignSets.py muscle -s $READS --exec $MUSCLE_EXEC \
-	    --nproc $NPROC --log "${LOGDIR}/align.log" --outname "${OUTNAME}" --outdir . \
-	    >> $PIPELINE_LOG 2> $ERROR_LOG
-
 	BC_FILE="${OUTNAME}_align-pass.fastq"
-	check_error
+    if begin_step "AlignSets muscle" -i "$READS" -o "$BC_FILE"; then
+	    AlignSets.py muscle -s $READS --exec $MUSCLE_EXEC \
+	        --nproc $NPROC --log "${LOGDIR}/align.log" --outname "${OUTNAME}" --outdir . \
+	        >> $PIPELINE_LOG 2> $ERROR_LOG
+	    check_error
+	    end_step
+	fi
 else
 	BC_FILE=$READS
 fi
 
 if $BC_PRCONS_FLAG; then
-	printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ParseHeaders expand"
-    ParseHeaders.py expand -s $BC_FILE -f PRIMER \
-        --outname "${OUTNAME}" --outdir . >> $PIPELINE_LOG 2> $ERROR_LOG
+	if begin_step "ParseHeaders expand" -i "$BC_FILE" -o "${OUTNAME}_reheader.fastq"; then
+        ParseHeaders.py expand -s $BC_FILE -f PRIMER \
+            --outname "${OUTNAME}" --outdir . >> $PIPELINE_LOG 2> $ERROR_LOG
+        check_error
+        end_step
+    fi
 
-	printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ParseHeaders rename"
-    ParseHeaders.py rename -s "${OUTNAME}_reheader.fastq" -f PRIMER1 PRIMER2 \
-        -k FPRIMER RPRIMER >> $PIPELINE_LOG 2> $ERROR_LOG
+	if begin_step "ParseHeaders rename" -i "${OUTNAME}_reheader.fastq" -o "${OUTNAME}_reheader_reheader.fastq"; then
+        ParseHeaders.py rename -s "${OUTNAME}_reheader.fastq" -f PRIMER1 PRIMER2 \
+            -k FPRIMER RPRIMER >> $PIPELINE_LOG 2> $ERROR_LOG
+        check_error
+        end_step
+    fi
 
     BC_FILE="${OUTNAME}_reheader_reheader.fastq"
-    check_error
 fi
 
 # Build UID consensus sequences
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "BuildConsensus"
-if $BC_PRCONS_FLAG; then
-    BuildConsensus.py -s $BC_FILE --bf BARCODE --pf RPRIMER --prcons $BC_PRCONS \
-        -n $BC_MINCOUNT -q $BC_QUAL --maxgap $BC_MAXGAP $BC_ERROR \
-        --nproc $NPROC --log "${LOGDIR}/consensus.log" \
-        --outname "${OUTNAME}" >> $PIPELINE_LOG 2> $ERROR_LOG
-else
-    BuildConsensus.py -s $BC_FILE --bf BARCODE \
-        -n $BC_MINCOUNT -q $BC_QUAL --maxgap $BC_MAXGAP $BC_ERROR \
-        --nproc $NPROC --log "${LOGDIR}/consensus.log" \
-        --outname "${OUTNAME}" --outdir . >> $PIPELINE_LOG 2> $ERROR_LOG
+if begin_step "BuildConsensus" -i "$BC_FILE" \
+    -p "$BC_PRCONS_FLAG $BC_PRCONS $BC_MINCOUNT $BC_QUAL $BC_MAXGAP $BC_ERROR" \
+    -o "${OUTNAME}_consensus-pass.fastq"; then
+    if $BC_PRCONS_FLAG; then
+        BuildConsensus.py -s $BC_FILE --bf BARCODE --pf RPRIMER --prcons $BC_PRCONS \
+            -n $BC_MINCOUNT -q $BC_QUAL --maxgap $BC_MAXGAP $BC_ERROR \
+            --nproc $NPROC --log "${LOGDIR}/consensus.log" \
+            --outname "${OUTNAME}" >> $PIPELINE_LOG 2> $ERROR_LOG
+    else
+        BuildConsensus.py -s $BC_FILE --bf BARCODE \
+            -n $BC_MINCOUNT -q $BC_QUAL --maxgap $BC_MAXGAP $BC_ERROR \
+            --nproc $NPROC --log "${LOGDIR}/consensus.log" \
+            --outname "${OUTNAME}" --outdir . >> $PIPELINE_LOG 2> $ERROR_LOG
+    fi
+    check_error
+    end_step
 fi
-check_error
 
 # Mask low quality positions
 if $MASK_LOWQUAL; then
-    printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "FilterSeq maskqual"
-    FilterSeq.py maskqual -s "${OUTNAME}_consensus-pass.fastq" -q $FS_MASK --nproc $NPROC \
-        --outname "${OUTNAME}" --log "${LOGDIR}/maskqual.log" \
-        >> $PIPELINE_LOG 2> $ERROR_LOG
-
     PH_FILE="${OUTNAME}_maskqual-pass.fastq"
-    check_error
+    if begin_step "FilterSeq maskqual" -i "${OUTNAME}_consensus-pass.fastq" -p "$FS_MASK" -o "$PH_FILE"; then
+        FilterSeq.py maskqual -s "${OUTNAME}_consensus-pass.fastq" -q $FS_MASK --nproc $NPROC \
+            --outname "${OUTNAME}" --log "${LOGDIR}/maskqual.log" \
+            >> $PIPELINE_LOG 2> $ERROR_LOG
+        check_error
+        end_step
+    fi
 else
     PH_FILE="${OUTNAME}_consensus-pass.fastq"
 fi
 
 if $ALIGN_CREGION; then
     # Annotate with internal C-region
-    printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "MaskPrimers align"
-    MaskPrimers.py align -s $PH_FILE -p $CREGION_SEQ \
-        --maxlen $CREGION_MAXLEN --maxerror $CREGION_MAXERR \
-        --mode tag --revpr --skiprc \
-        --log "${LOGDIR}/cregion.log" --outname "${OUTNAME}" --nproc $NPROC \
-        >> $PIPELINE_LOG 2> $ERROR_LOG
+    if begin_step "MaskPrimers align" -i "$PH_FILE $CREGION_SEQ" -p "$CREGION_MAXLEN $CREGION_MAXERR" \
+        -o "${OUTNAME}_primers-pass.fastq"; then
+        MaskPrimers.py align -s $PH_FILE -p $CREGION_SEQ \
+            --maxlen $CREGION_MAXLEN --maxerror $CREGION_MAXERR \
+            --mode tag --revpr --skiprc \
+            --log "${LOGDIR}/cregion.log" --outname "${OUTNAME}" --nproc $NPROC \
+            >> $PIPELINE_LOG 2> $ERROR_LOG
+        check_error
+        end_step
+    fi
 
     # Renamer primer field
-    printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ParseHeaders rename"
-    ParseHeaders.py rename -s "${OUTNAME}_primers-pass.fastq" -f PRIMER -k CREGION \
-        --outname "${OUTNAME}" > /dev/null 2> $ERROR_LOG
+    if begin_step "ParseHeaders rename" -i "${OUTNAME}_primers-pass.fastq" -o "${OUTNAME}_reheader.fastq"; then
+        ParseHeaders.py rename -s "${OUTNAME}_primers-pass.fastq" -f PRIMER -k CREGION \
+            --outname "${OUTNAME}" > /dev/null 2> $ERROR_LOG
+        check_error
+        end_step
+    fi
     PH_FILE="${OUTNAME}_reheader.fastq"
 
     CREGION_FIELD="CREGION"
-    check_error
 else
     CREGION_FIELD=""
 fi
 
 # Rewrite header with minimum of CONSCOUNT
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ParseHeaders collapse"
-ParseHeaders.py collapse -s $PH_FILE -f CONSCOUNT --act min \
-    --outname "${OUTNAME}-final" > /dev/null 2> $ERROR_LOG
-mv "${OUTNAME}-final_reheader.fastq" "${OUTNAME}-final_total.fastq"
-check_error
+if begin_step "ParseHeaders collapse" -i "$PH_FILE" -o "${OUTNAME}-final_total.fastq"; then
+    ParseHeaders.py collapse -s $PH_FILE -f CONSCOUNT --act min \
+        --outname "${OUTNAME}-final" > /dev/null 2> $ERROR_LOG
+    mv "${OUTNAME}-final_reheader.fastq" "${OUTNAME}-final_total.fastq"
+    check_error
+    end_step
+fi
 
 # Remove duplicate sequences
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "CollapseSeq"
-CollapseSeq.py -s "${OUTNAME}-final_total.fastq" -n $CS_MISS \
-    --uf PRCONS $CREGION_FIELD --cf CONSCOUNT --act sum --inner \
-    ${CS_KEEPMISS} --outname "${OUTNAME}-final" >> $PIPELINE_LOG 2> $ERROR_LOG
-check_error
+if begin_step "CollapseSeq" -i "${OUTNAME}-final_total.fastq" -p "$CS_MISS $CREGION_FIELD $CS_KEEPMISS" \
+    -o "${OUTNAME}-final_collapse-unique.fastq"; then
+    CollapseSeq.py -s "${OUTNAME}-final_total.fastq" -n $CS_MISS \
+        --uf PRCONS $CREGION_FIELD --cf CONSCOUNT --act sum --inner \
+        ${CS_KEEPMISS} --outname "${OUTNAME}-final" >> $PIPELINE_LOG 2> $ERROR_LOG
+    check_error
+    end_step
+fi
 
 # Filter to sequences with at least 2 supporting sources
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "SplitSeq group"
-SplitSeq.py group -s "${OUTNAME}-final_collapse-unique.fastq" -f CONSCOUNT --num 2 \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
-check_error
+if begin_step "SplitSeq group" -i "${OUTNAME}-final_collapse-unique.fastq" \
+    -o "${OUTNAME}-final_collapse-unique_atleast-2.fastq"; then
+    SplitSeq.py group -s "${OUTNAME}-final_collapse-unique.fastq" -f CONSCOUNT --num 2 \
+        >> $PIPELINE_LOG 2> $ERROR_LOG
+    check_error
+    end_step
+fi
 
 # Create table of final repertoire
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ParseHeaders table"
-ParseHeaders.py table -s "${OUTNAME}-final_total.fastq" \
-    -f ID PRCONS $CREGION_FIELD CONSCOUNT --outname "final-total" \
-    --outdir ${LOGDIR} >> $PIPELINE_LOG 2> $ERROR_LOG
-ParseHeaders.py table -s "${OUTNAME}-final_collapse-unique.fastq" \
-    -f ID PRCONS $CREGION_FIELD CONSCOUNT DUPCOUNT --outname "final-unique" \
-    --outdir ${LOGDIR} >> $PIPELINE_LOG 2> $ERROR_LOG
-ParseHeaders.py table -s "${OUTNAME}-final_collapse-unique_atleast-2.fastq" \
-    -f ID PRCONS $CREGION_FIELD CONSCOUNT DUPCOUNT --outname "final-unique-atleast2" \
-    --outdir ${LOGDIR} >> $PIPELINE_LOG 2> $ERROR_LOG
-check_error
+if begin_step "ParseHeaders table"; then
+    begin_tasks 3 $NPROC
+    run_task "total" ParseHeaders.py table -s "${OUTNAME}-final_total.fastq" \
+        -f ID PRCONS $CREGION_FIELD CONSCOUNT --outname "final-total" \
+        --outdir ${LOGDIR}
+    run_task "unique" ParseHeaders.py table -s "${OUTNAME}-final_collapse-unique.fastq" \
+        -f ID PRCONS $CREGION_FIELD CONSCOUNT DUPCOUNT --outname "final-unique" \
+        --outdir ${LOGDIR}
+    run_task "atleast-2" ParseHeaders.py table -s "${OUTNAME}-final_collapse-unique_atleast-2.fastq" \
+        -f ID PRCONS $CREGION_FIELD CONSCOUNT DUPCOUNT --outname "final-unique-atleast2" \
+        --outdir ${LOGDIR}
+    wait_tasks
+    check_error
+    end_step
+fi
 
 # Process log files
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ParseLog"
-if $ALIGN_SETS; then
-    ParseLog.py -l "${LOGDIR}/align.log" -f BARCODE SEQCOUNT \
-        --outdir ${LOGDIR} > /dev/null  2> $ERROR_LOG &
-fi
-ParseLog.py -l "${LOGDIR}/consensus.log" \
-    -f BARCODE SEQCOUNT CONSCOUNT PRIMER PRCONS PRCOUNT PRFREQ ERROR \
-    --outdir ${LOGDIR} > /dev/null  2> $ERROR_LOG &
-if $MASK_LOWQUAL; then
-    ParseLog.py -l "${LOGDIR}/maskqual.log" -f ID MASKED \
-        --outdir ${LOGDIR} > /dev/null  2> $ERROR_LOG &
-fi
-if $ALIGN_CREGION; then
-    ParseLog.py -l "${LOGDIR}/cregion.log" -f ID PRIMER ERROR \
-        --outdir ${LOGDIR} > /dev/null  2> $ERROR_LOG &
+if begin_step "ParseLog"; then
+    begin_tasks 4 $NPROC
+    if $ALIGN_SETS; then
+        run_task "align" ParseLog.py -l "${LOGDIR}/align.log" -f BARCODE SEQCOUNT \
+            --outdir ${LOGDIR}
+    fi
+    run_task "consensus" ParseLog.py -l "${LOGDIR}/consensus.log" \
+        -f BARCODE SEQCOUNT CONSCOUNT PRIMER PRCONS PRCOUNT PRFREQ ERROR \
+        --outdir ${LOGDIR}
+    if $MASK_LOWQUAL; then
+        run_task "maskqual" ParseLog.py -l "${LOGDIR}/maskqual.log" -f ID MASKED \
+            --outdir ${LOGDIR}
+    fi
+    if $ALIGN_CREGION; then
+        run_task "cregion" ParseLog.py -l "${LOGDIR}/cregion.log" -f ID PRIMER ERROR \
+            --outdir ${LOGDIR}
+    fi
+    wait_tasks
+    check_error
+    end_step
 fi
-wait
-check_error
 
 # Zip or delete intermediate and log files
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "Compressing files"
-LOG_FILES=$(ls ${LOGDIR}/*.log | grep -v "pipeline")
-FILTER_FILES="$(basename ${READS})"
-FILTER_FILES+="\|final_total.fastq\|final_collapse-unique.fastq\|final_collapse-unique_atleast-2.fastq"
-TEMP_FILES=$(ls *.fastq | grep -v ${FILTER_FILES})
-if $ZIP_FILES; then
-    tar -zcf log_files.tar.gz $LOG_FILES
-    tar -zcf temp_files.tar.gz $TEMP_FILES
-fi
-if $DELETE_FILES; then
-    rm $TEMP_FILES
-    rm $LOG_FILES
+if begin_step "Compressing files"; then
+    LOG_FILES=$(ls ${LOGDIR}/*.log | grep -v "pipeline")
+    FILTER_FILES="$(basename ${READS})"
+    FILTER_FILES+="\|final_total.fastq\|final_collapse-unique.fastq\|final_collapse-unique_atleast-2.fastq"
+    TEMP_FILES=$(ls *.fastq | grep -v ${FILTER_FILES})
+    if $ZIP_FILES; then
+        archive_files log_files $LOG_FILES
+        archive_files temp_files $TEMP_FILES
+    fi
+    if $DELETE_FILES; then
+        rm -f $TEMP_FILES
+        rm -f $LOG_FILES
+    fi
+    end_step
 fi
+finish_steps
 
 # End
 printf "DONE\n\n"
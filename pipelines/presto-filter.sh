@@ -15,6 +15,10 @@
 #       Defaults to illumina.
 #   -p  Number of subprocesses for multiprocessing tools.
 #       Defaults to the available processing units.
+#   --from-step  Step number or name to restart from.
+#       Without this option, steps that are up to date from a previous run are skipped.
+#   --compress  Compression program for archived files. One of gzip, pigz or zstd.
+#   --compress-early  Compress intermediate files as soon as no later step reads them.
 #   -h  Display help.
 
 # Print usage
@@ -30,6 +34,7 @@ print_usage() {
             "     Defaults to illumina."
     echo -e "  -p  Number of subprocesses for multiprocessing tools.\n" \
             "     Defaults to the available cores."
+    print_step_usage
     echo -e "  -h  This message."
 }
 
@@ -41,6 +46,10 @@ OUTDIR_SET=false
 NPROC_SET=false
 COORD_SET=false
 
+# Load the step runner and remove its arguments
+source pipeline_steps.sh
+step_args "$@"; set -- "${STEP_ARGS[@]}"
+
 # Get commandline arguments
 while getopts "s:y:n:o:x:p:h" OPT; do
     case "$OPT" in
@@ -160,15 +169,18 @@ echo -e "IDENTIFIER: ${OUTNAME}"
 echo -e "DIRECTORY: ${OUTDIR}"
 echo -e "PRESTO VERSION: ${PRESTO_VERSION}"
 echo -e "\nSTART"
-STEP=0
+STEP_VERSION=${PRESTO_VERSION}
+init_steps "${LOGDIR}/steps"
 
 # Remove low quality reads
 if $CONVERT_HEADERS; then
-    printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ConvertHeaders ${COORD}"
-    ConvertHeaders.py $COORD -s $READS --outname "${OUTNAME}" --outdir . \
-        >> $PIPELINE_LOG  2> $ERROR_LOG
     FS_FILE="${OUTNAME}_convert-pass.fastq"
-    check_error
+    if begin_step "ConvertHeaders ${COORD}" -i "$READS" -o "$FS_FILE"; then
+        ConvertHeaders.py $COORD -s $READS --outname "${OUTNAME}" --outdir . \
+            >> $PIPELINE_LOG  2> $ERROR_LOG
+        check_error
+        end_step
+    fi
 else
     FS_FILE=$READS
 fi
@@ -176,82 +188,95 @@ fi
 
 # Remove low quality reads
 if $FILTER_LOWQUAL; then
-    printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "FilterSeq quality"
-    FilterSeq.py quality -s $FS_FILE -q $FS_QUAL --nproc $NPROC \
-        --outname "${OUTNAME}" --outdir . --log "${LOGDIR}/quality.log" \
-        >> $PIPELINE_LOG  2> $ERROR_LOG
     CS_FILE="${OUTNAME}_quality-pass.fastq"
-    check_error
+    if begin_step "FilterSeq quality" -i "$FS_FILE" -p "$FS_QUAL" -o "$CS_FILE"; then
+        FilterSeq.py quality -s $FS_FILE -q $FS_QUAL --nproc $NPROC \
+            --outname "${OUTNAME}" --outdir . --log "${LOGDIR}/quality.log" \
+            >> $PIPELINE_LOG  2> $ERROR_LOG
+        check_error
+        end_step
+    fi
 else
     CS_FILE=$FS_FILE
 fi
 
 
 # Remove duplicate sequences
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "CollapseSeq"
-if $CS_KEEP; then
-    CollapseSeq.py -s $CS_FILE -n $CS_MISS --inner --keepmiss \
-    --outname "${OUTNAME}-final" >> $PIPELINE_LOG 2> $ERROR_LOG
-else
-    CollapseSeq.py -s $CS_FILE -n $CS_MISS --inner \
-    --outname "${OUTNAME}-final" >> $PIPELINE_LOG 2> $ERROR_LOG
+if begin_step "CollapseSeq" -i "$CS_FILE" -p "$CS_KEEP $CS_MISS" -o "${OUTNAME}-final_collapse-unique.fastq"; then
+    if $CS_KEEP; then
+        CollapseSeq.py -s $CS_FILE -n $CS_MISS --inner --keepmiss \
+        --outname "${OUTNAME}-final" >> $PIPELINE_LOG 2> $ERROR_LOG
+    else
+        CollapseSeq.py -s $CS_FILE -n $CS_MISS --inner \
+        --outname "${OUTNAME}-final" >> $PIPELINE_LOG 2> $ERROR_LOG
+    fi
+    check_error
+    end_step
 fi
-check_error
 
 
 # Filter to sequences with at least 2 supporting sources
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "SplitSeq group"
-SplitSeq.py group -s "${OUTNAME}-final_collapse-unique.fastq" -f DUPCOUNT --num 2 \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
-check_error
+if begin_step "SplitSeq group" -i "${OUTNAME}-final_collapse-unique.fastq" \
+    -o "${OUTNAME}-final_collapse-unique_atleast-2.fastq"; then
+    SplitSeq.py group -s "${OUTNAME}-final_collapse-unique.fastq" -f DUPCOUNT --num 2 \
+        >> $PIPELINE_LOG 2> $ERROR_LOG
+    check_error
+    end_step
+fi
 
 
 # Create table of final repertoire
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ParseHeaders table"
-ParseHeaders.py table -s "${OUTNAME}-final_collapse-unique.fastq" \
-    -f ID DUPCOUNT --outname "final-unique" \
-    --outdir ${LOGDIR} >> $PIPELINE_LOG 2> $ERROR_LOG
-ParseHeaders.py table -s "${OUTNAME}-final_collapse-unique_atleast-2.fastq" \
-    -f ID DUPCOUNT --outname "final-unique-atleast2" \
-    --outdir ${LOGDIR} >> $PIPELINE_LOG 2> $ERROR_LOG
-check_error
+if begin_step "ParseHeaders table"; then
+    ParseHeaders.py table -s "${OUTNAME}-final_collapse-unique.fastq" \
+        -f ID DUPCOUNT --outname "final-unique" \
+        --outdir ${LOGDIR} >> $PIPELINE_LOG 2> $ERROR_LOG
+    ParseHeaders.py table -s "${OUTNAME}-final_collapse-unique_atleast-2.fastq" \
+        -f ID DUPCOUNT --outname "final-unique-atleast2" \
+        --outdir ${LOGDIR} >> $PIPELINE_LOG 2> $ERROR_LOG
+    check_error
+    end_step
+fi
 
 
 # Process log files
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ParseLog"
-if $FILTER_LOWQUAL; then
-    ParseLog.py -l "${LOGDIR}/quality.log" -f ID QUALITY \
-        --outdir ${LOGDIR} > /dev/null &
+if begin_step "ParseLog"; then
+    if $FILTER_LOWQUAL; then
+        ParseLog.py -l "${LOGDIR}/quality.log" -f ID QUALITY \
+            --outdir ${LOGDIR} > /dev/null &
+    fi
+    wait
+    check_error
+    end_step
 fi
-wait
-check_error
 
 
 # Generate pRESTO report
-if $REPORT; then
-    printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "Generating report"
+if $REPORT && begin_step "Generating report"; then
     REPORT_SCRIPT="report_abseq3(\"${LOGDIR}\", sample=\"${OUTNAME}\", output_dir=\"${REPORTDIR}\", config=\"${YAML}\", quiet=FALSE)"
     Rscript -e "library(prestor); ${REPORT_SCRIPT}" > ${REPORTDIR}/report.out 2> ${REPORTDIR}/report.err
+    end_step
 fi
 
 
 # Zip or delete intermediate and log files
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "Compressing files"
-LOG_FILES=$(ls ${LOGDIR}/*.log | grep -v "pipeline")
-FILTER_FILES="$(basename ${READS})"
-FILTER_FILES+="\|final_total.fastq\|final_collapse-unique.fastq\|final_collapse-unique_atleast-2.fastq"
-TEMP_FILES=$(ls *.fastq  2>/dev/null | grep -v ${FILTER_FILES})
-if $ZIP_FILES; then
-    tar -zcf log_files.tar.gz $LOG_FILES
-    tar -zcf temp_files.tar.gz $TEMP_FILES
-fi
-if $DELETE_FILES; then
-    rm $TEMP_FILES
-    rm $LOG_FILES
+if begin_step "Compressing files"; then
+    LOG_FILES=$(ls ${LOGDIR}/*.log | grep -v "pipeline")
+    FILTER_FILES="$(basename ${READS})"
+    FILTER_FILES+="\|final_total.fastq\|final_collapse-unique.fastq\|final_collapse-unique_atleast-2.fastq"
+    TEMP_FILES=$(ls *.fastq  2>/dev/null | grep -v ${FILTER_FILES})
+    if $ZIP_FILES; then
+        archive_files log_files $LOG_FILES
+        archive_files temp_files $TEMP_FILES
+    fi
+    if $DELETE_FILES; then
+        rm -f $TEMP_FILES
+        rm -f $LOG_FILES
+    fi
+    end_step
 fi
+finish_steps
 
 
 # End
 printf "DONE\n\n"
 cd ../
-
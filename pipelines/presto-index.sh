@@ -15,6 +15,10 @@
 #       Defaults to 'output' in the current working directory.
 #   -p  Number of subprocesses for multiprocessing tools.
 #       Defaults to the available processing units.
+#   --from-step  Step number or name to restart from.
+#       Without this option, steps that are up to date from a previous run are skipped.
+#   --compress  Compression program for archived files. One of gzip, pigz or zstd.
+#   --compress-early  Compress intermediate files as soon as no later step reads them.
 #   -h  Display help.
 
 # Print usage
@@ -30,6 +34,7 @@ print_usage() {
             "     Defaults to 'output' in the current working directory."
     echo -e "  -p  Number of subprocesses for multiprocessing tools.\n" \
             "     Defaults to the available cores."
+    print_step_usage
     echo -e "  -h  This message."
 }
 
@@ -40,6 +45,10 @@ FIELD_SET=false
 OUTDIR_SET=false
 NPROC_SET=false
 
+# Load the step runner and remove its arguments
+source pipeline_steps.sh
+step_args "$@"; set -- "${STEP_ARGS[@]}"
+
 # Get commandline arguments
 while getopts ":x:z:f:o:p:h" OPT; do
     case "$OPT" in
@@ -141,69 +150,90 @@ PRESTO_VERSION=$(python3 -c "import presto; print('%s-%s' % (presto.__version__,
 echo -e "DIRECTORY: ${OUTDIR}"
 echo -e "PRESTO VERSION: ${PRESTO_VERSION}"
 echo -e "\nSTART"
-STEP=0
+STEP_VERSION=${PRESTO_VERSION}
+init_steps "${LOGDIR}/steps"
 
 # Cluster UMIs
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "Merging files"
-merge_fastq.py merged.fastq $READS
+if begin_step "Merging files" -i "$READS" -o "merged.fastq"; then
+    merge_fastq.py merged.fastq $READS --nproc $NPROC
+    end_step
+fi
 
 # Cluster UMIs
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ClusterSets barcode"
-ClusterSets.py barcode -s merged.fastq -f $BARCODE_FIELD -k CLUSTER --ident $UMI_IDENT --prefix UMI \
-    --nproc $NPROC --log "${LOGDIR}/cluster-barcode.log" --outdir . \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
-#check_error
+if begin_step "ClusterSets barcode" -i "merged.fastq" -p "$BARCODE_FIELD $UMI_IDENT" \
+    -o "merged_cluster-pass.fastq"; then
+    ClusterSets.py barcode -s merged.fastq -f $BARCODE_FIELD -k CLUSTER --ident $UMI_IDENT --prefix UMI \
+        --nproc $NPROC --log "${LOGDIR}/cluster-barcode.log" --outdir . \
+        >> $PIPELINE_LOG 2> $ERROR_LOG
+    #check_error
+    end_step
+fi
 
 # Cluster reads
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ClusterSets set"
-ClusterSets.py set -s merged_cluster-pass.fastq -f CLUSTER -k CLUSTER --ident $SEQ_IDENT --prefix SEQ \
-    --nproc $NPROC --log "${LOGDIR}/cluster-set.log" \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
-#check_error
+if begin_step "ClusterSets set" -i "merged_cluster-pass.fastq" -p "$SEQ_IDENT" \
+    -o "merged_cluster-pass_cluster-pass.fastq"; then
+    ClusterSets.py set -s merged_cluster-pass.fastq -f CLUSTER -k CLUSTER --ident $SEQ_IDENT --prefix SEQ \
+        --nproc $NPROC --log "${LOGDIR}/cluster-set.log" \
+        >> $PIPELINE_LOG 2> $ERROR_LOG
+    #check_error
+    end_step
+fi
 
 # Generate consensus cluster identifiers
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ParseHeaders collapse"
-ParseHeaders.py collapse -s merged_cluster-pass_cluster-pass.fastq -f CLUSTER --act cat \
-	>> $PIPELINE_LOG 2> $ERROR_LOG
-#check_error
+if begin_step "ParseHeaders collapse" -i "merged_cluster-pass_cluster-pass.fastq" \
+    -o "merged_cluster-pass_cluster-pass_reheader.fastq"; then
+    ParseHeaders.py collapse -s merged_cluster-pass_cluster-pass.fastq -f CLUSTER --act cat \
+	    >> $PIPELINE_LOG 2> $ERROR_LOG
+    #check_error
+    end_step
+fi
 	
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "UnifyHeaders consensus"
-UnifyHeaders.py consensus -s merged_cluster-pass_cluster-pass_reheader.fastq \
-	-f CLUSTER -k $FIELD --log "${LOGDIR}/unify.log" \
-    >> $PIPELINE_LOG 2> $ERROR_LOG
-#check_error
+if begin_step "UnifyHeaders consensus" -i "merged_cluster-pass_cluster-pass_reheader.fastq" -p "$FIELD" \
+    -o "merged_cluster-pass_cluster-pass_reheader_unify-pass.fastq"; then
+    UnifyHeaders.py consensus -s merged_cluster-pass_cluster-pass_reheader.fastq \
+	    -f CLUSTER -k $FIELD --log "${LOGDIR}/unify.log" \
+        >> $PIPELINE_LOG 2> $ERROR_LOG
+    #check_error
+    end_step
+fi
 
 # Split files
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "SplitSeq group"
-SplitSeq.py group -s merged_cluster-pass_cluster-pass_reheader_unify-pass.fastq \
-	-f $FIELD --outname final >> $PIPELINE_LOG 2> $ERROR_LOG
-#check_error
+if begin_step "SplitSeq group"; then
+    SplitSeq.py group -s merged_cluster-pass_cluster-pass_reheader_unify-pass.fastq \
+	    -f $FIELD --outname final >> $PIPELINE_LOG 2> $ERROR_LOG
+    #check_error
+    end_step
+fi
 
 # Process log files
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "ParseLog"
-ParseLog.py -l "${LOGDIR}/cluster-barcode.log" "${LOGDIR}/cluster-set.log" \
-    -f ID \
-    --outdir ${LOGDIR} > /dev/null 2> $ERROR_LOG &
-ParseLog.py -l "${LOGDIR}/unify.log" -f ID \
-    --outdir ${LOGDIR} > /dev/null 2> $ERROR_LOG &
-wait
-#check_error
+if begin_step "ParseLog"; then
+    ParseLog.py -l "${LOGDIR}/cluster-barcode.log" "${LOGDIR}/cluster-set.log" \
+        -f ID \
+        --outdir ${LOGDIR} > /dev/null 2> $ERROR_LOG &
+    ParseLog.py -l "${LOGDIR}/unify.log" -f ID \
+        --outdir ${LOGDIR} > /dev/null 2> $ERROR_LOG &
+    wait
+    #check_error
+    end_step
+fi
 
 # Zip or delete intermediate and log files
-printf "  %2d: %-*s $(date +'%H:%M %D')\n" $((++STEP)) 24 "Compressing files"
-LOG_FILES=$(ls ${LOGDIR}/*.log | grep -v "pipeline")
-FILTER_FILES="final_"
-TEMP_FILES=$(ls *.fastq | grep -v ${FILTER_FILES})
-if $ZIP_FILES; then
-    tar -zcf log_files.tar.gz $LOG_FILES
-    tar -zcf temp_files.tar.gz $TEMP_FILES
-fi
-if $DELETE_FILES; then
-    rm $TEMP_FILES
-    rm $LOG_FILES
+if begin_step "Compressing files"; then
+    LOG_FILES=$(ls ${LOGDIR}/*.log | grep -v "pipeline")
+    FILTER_FILES="final_"
+    TEMP_FILES=$(ls *.fastq | grep -v ${FILTER_FILES})
+    if $ZIP_FILES; then
+        archive_files log_files $LOG_FILES
+        archive_files temp_files $TEMP_FILES
+    fi
+    if $DELETE_FILES; then
+        rm -f $TEMP_FILES
+        rm -f $LOG_FILES
+    fi
+    end_step
 fi
+finish_steps
 
 # End
 printf "DONE\n\n"
 cd ../
-
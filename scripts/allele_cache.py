@@ -0,0 +1,69 @@
+"""
+Memoized allele and gene call parsing shared by the accessory scripts
+"""
+
+# Imports
+import sys
+from functools import lru_cache
+
+# Presto and changeo imports
+from changeo.Gene import parseAllele
+
+# Number of call strings and distinct call strings per column passed to parseAlleleColumn
+call_counts = {'total': 0, 'distinct': 0}
+
+
+@lru_cache(maxsize=None)
+def parseAlleleCached(alleles, regex, action='first'):
+    """
+    Extract alleles from strings, caching the result for each distinct call string
+
+    Arguments:
+      alleles (str): string with allele calls.
+      regex (re.Pattern): compiled regular expression for allele match.
+      action (str): action to perform for multiple alleles; one of ('first', 'set', 'list').
+
+    Returns:
+      str: String of the allele when action is 'first'.
+      tuple: Tuple of allele calls for 'set' or 'list' actions.
+    """
+    return parseAllele(alleles, regex, action=action)
+
+
+def parseAlleleColumn(calls, regex, action='first'):
+    """
+    Extract alleles from a column of call strings, parsing each distinct call string once
+
+    Arguments:
+      calls (pandas.Series): allele call strings.
+      regex (re.Pattern): compiled regular expression for allele match.
+      action (str): action to perform for multiple alleles; one of ('first', 'set', 'list').
+
+    Returns:
+      pandas.Series: parsed alleles with the index of calls.
+    """
+    distinct = calls.unique()
+    call_counts['total'] += len(calls)
+    call_counts['distinct'] += len(distinct)
+
+    return calls.map({x: parseAlleleCached(x, regex, action=action) for x in distinct})
+
+
+def reportCache(handle=None):
+    """
+    Prints the number of call strings, distinct call strings and parses of the allele parsing cache
+
+    Calls are deduplicated per column by parseAlleleColumn before they reach the cache, so the cache
+    only saves the parses repeated across columns and chunks.
+
+    Arguments:
+      handle (file): output handle. Defaults to the current standard output.
+    """
+    if handle is None:  handle = sys.stdout
+    info = parseAlleleCached.cache_info()
+    total = call_counts['total']
+    rate = 1 - info.misses / total if total else 0
+    handle.write('%12s> %i\n' % ('CALLS', total))
+    handle.write('%12s> %i\n' % ('DISTINCT', call_counts['distinct']))
+    handle.write('%12s> %i\n' % ('PARSED', info.misses))
+    handle.write('%12s> %.4f\n' % ('SAVED RATE', rate))
@@ -2,25 +2,218 @@
 """
 Clean IMGT germline fasta files for IgBLAST database build
 """
-from sys import argv
-from Bio import SeqIO
-from Bio.SeqRecord import SeqRecord
-
-# Get input and output file names
-in_file = argv[1]
-out_file = argv[2]
-
-# Load sequences into memory and process them
-name_set = set()
-seq_list = list()
-for rec in SeqIO.parse(in_file, 'fasta'):
-    name = rec.description.split('|')[1]
-    if name not in name_set:
-        name_set.add(name)
-        seq = SeqRecord(rec.seq.ungap('.').upper(), id=name, name=name, description=name)
-        seq_list.append(seq)
-
-# Overwrite file
-with open(out_file, 'w') as out_handle:
-    writer = SeqIO.FastaIO.FastaWriter(out_handle, wrap=None)
-    writer.write_file(seq_list)
+# Imports
+import hashlib
+import multiprocessing as mp
+import os
+import sys
+from argparse import ArgumentParser
+from tempfile import NamedTemporaryFile
+
+# Local imports
+from fastq_io import readFasta
+
+# Manifest columns
+manifest_fields = ['OUTPUT', 'INPUT_HASH', 'OUTPUT_HASH', 'RECORDS']
+
+
+def hashFile(path, block_size=1 << 20):
+    """
+    Computes the SHA-256 digest of a file
+
+    Arguments:
+      path (str): file path.
+      block_size (int): number of bytes to read at a time.
+
+    Returns:
+      str: hexadecimal digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def replaceFile(temp_file, out_file):
+    """
+    Moves a temporary file into place with default permissions
+
+    Arguments:
+      temp_file (str): temporary file name.
+      out_file (str): destination file name.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(temp_file, 0o666 & ~umask)
+    os.replace(temp_file, out_file)
+
+
+def cleanGermlines(in_file, out_file):
+    """
+    Ungaps, uppercases and deduplicates IMGT germline sequences by allele name
+
+    The output is written to a temporary file and moved into place, so in_file and out_file may be the same.
+
+    Arguments:
+      in_file (str): IMGT gapped germline FASTA file.
+      out_file (str): output FASTA file.
+
+    Returns:
+      int: number of records written.
+    """
+    name_set = set()
+    out_dir = os.path.dirname(os.path.abspath(out_file))
+    with open(in_file, 'r') as in_handle, \
+            NamedTemporaryFile('w', dir=out_dir, prefix='.clean_imgtdb.', delete=False) as out_handle:
+        try:
+            for header, seq in readFasta(in_handle):
+                name = header.split('|')[1]
+                if name not in name_set:
+                    name_set.add(name)
+                    out_handle.write('>%s\n%s\n' % (name, seq.replace('.', '').upper()))
+        except:
+            os.remove(out_handle.name)
+            raise
+    replaceFile(out_handle.name, out_file)
+
+    return len(name_set)
+
+
+def readManifest(manifest_file):
+    """
+    Reads a germline build manifest
+
+    Arguments:
+      manifest_file (str): manifest file name.
+
+    Returns:
+      dict: dictionary of {output file name: row dictionary}. Empty if the manifest does not exist.
+    """
+    manifest = {}
+    if not os.path.isfile(manifest_file):
+        return manifest
+    with open(manifest_file, 'r') as handle:
+        fields = handle.readline().rstrip('\n').split('\t')
+        for line in handle:
+            row = dict(zip(fields, line.rstrip('\n').split('\t')))
+            manifest[row['OUTPUT']] = row
+
+    return manifest
+
+
+def writeManifest(manifest_file, manifest):
+    """
+    Writes a germline build manifest
+
+    Arguments:
+      manifest_file (str): manifest file name.
+      manifest (dict): dictionary of {output file name: row dictionary}.
+    """
+    out_dir = os.path.dirname(os.path.abspath(manifest_file))
+    with NamedTemporaryFile('w', dir=out_dir, prefix='.manifest.', delete=False) as handle:
+        handle.write('\t'.join(manifest_fields) + '\n')
+        for key in sorted(manifest):
+            handle.write('\t'.join(str(manifest[key][f]) for f in manifest_fields) + '\n')
+    replaceFile(handle.name, manifest_file)
+
+
+def buildGermline(job):
+    """
+    Cleans a single germline file unless the manifest shows it is up to date
+
+    Arguments:
+      job (tuple): (input file, output file, manifest row or None).
+
+    Returns:
+      tuple: (manifest row, True if the output was rebuilt).
+    """
+    in_file, out_file, previous = job
+    in_hash = hashFile(in_file)
+    if previous is not None and previous['INPUT_HASH'] == in_hash and os.path.isfile(out_file) \
+            and previous['OUTPUT_HASH'] == hashFile(out_file):
+        return previous, False
+
+    count = cleanGermlines(in_file, out_file)
+    row = {'OUTPUT': os.path.basename(out_file), 'INPUT_HASH': in_hash, 'OUTPUT_HASH': hashFile(out_file),
+           'RECORDS': count}
+
+    return row, True
+
+
+def buildGermlines(in_files, out_dir, manifest_file=None, nproc=1, force=False):
+    """
+    Cleans multiple germline files in parallel, skipping files unchanged since the last build
+
+    Arguments:
+      in_files (list): IMGT gapped germline FASTA files. Outputs are named by input file name.
+      out_dir (str): output directory.
+      manifest_file (str): manifest of input and output content hashes. Defaults to manifest.tsv in out_dir.
+      nproc (int): number of worker processes.
+      force (bool): if True rebuild all outputs regardless of the manifest.
+
+    Returns:
+      list: output files that were rebuilt.
+    """
+    if manifest_file is None:
+        manifest_file = os.path.join(out_dir, 'manifest.tsv')
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Define jobs
+    manifest = readManifest(manifest_file) if not force else {}
+    jobs = []
+    for f in in_files:
+        out_name = os.path.basename(f)
+        jobs.append((f, os.path.join(out_dir, out_name), manifest.get(out_name, None)))
+
+    # Build germlines
+    if nproc > 1 and len(jobs) > 1:
+        with mp.Pool(min(nproc, len(jobs))) as pool:
+            results = pool.map(buildGermline, jobs, chunksize=1)
+    else:
+        results = [buildGermline(x) for x in jobs]
+
+    # Update manifest
+    for row, __ in results:
+        manifest[row['OUTPUT']] = row
+    writeManifest(manifest_file, manifest)
+
+    return [job[1] for job, (__, rebuilt) in zip(jobs, results) if rebuilt]
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and calls main
+    """
+    # Define arguments
+    parser = ArgumentParser()
+    parser.add_argument('files', nargs='+',
+                        help='Input and output file names. Without -o, a single input file followed by '
+                             'an output file. With -o, one or more input files.')
+    parser.add_argument('-o', dest='out_dir', default=None,
+                        help='Output directory for building multiple files. Output files are named by '
+                             'input file name and the paths of rebuilt files are printed.')
+    parser.add_argument('--manifest', dest='manifest_file', default=None,
+                        help='Manifest of input and output content hashes used to skip unchanged inputs. '
+                             'Defaults to manifest.tsv in the output directory.')
+    parser.add_argument('--nproc', dest='nproc', type=int, default=1,
+                        help='Number of files to process in parallel.')
+    parser.add_argument('--force', dest='force', action='store_true',
+                        help='Rebuild all files regardless of the manifest.')
+    args = parser.parse_args()
+
+    # Check that files exist
+    in_files = args.files if args.out_dir is not None else args.files[:1]
+    if args.out_dir is None and len(args.files) != 2:
+        parser.error('Specify a single input and output file, or input files with -o.')
+    for f in in_files:
+        if not os.path.isfile(f):  sys.exit('File %s does not exist.' % f)
+
+    # Clean germlines
+    if args.out_dir is None:
+        cleanGermlines(args.files[0], args.files[1])
+    else:
+        for f in buildGermlines(in_files, args.out_dir, manifest_file=args.manifest_file, nproc=args.nproc,
+                                force=args.force):
+            print(f)
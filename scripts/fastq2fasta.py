@@ -2,17 +2,66 @@
 """
 Converts FASTQ to FASTA
 """
+# Imports
+import sys
+from argparse import ArgumentParser
 from os import path
-from sys import argv
-from Bio import SeqIO
 
-in_file = argv[1]
-out_file = path.split(in_file)[1]
-out_file = '%s.fasta' % path.splitext(out_file)[0]
+# Local imports
+from fastq_io import FastqFormatError, openFile, readFastqBlocks
 
-with open(out_file, 'w') as out_handle:
-    records = SeqIO.parse(in_file, 'fastq')
-    writer = SeqIO.FastaIO.FastaWriter(out_handle, wrap=None)
-    writer.write_file(records)
 
-print(out_file)
\ No newline at end of file
+def convertFastq(in_handle, out_handle, name=''):
+    """
+    Converts FASTQ records to unwrapped FASTA records
+
+    Arguments:
+      in_handle (file): binary FASTQ input handle.
+      out_handle (file): binary FASTA output handle.
+      name (str): input name for error messages.
+
+    Returns:
+      int: number of records converted.
+    """
+    count = 0
+    for block in readFastqBlocks(in_handle, name=name):
+        out_handle.write(b''.join([b'>%s\n%s\n' % (h[1:].rstrip(), s.rstrip())
+                                   for h, s in zip(block[0::4], block[1::4])]))
+        count += len(block) // 4
+
+    return count
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and calls main
+    """
+    # Define arguments
+    parser = ArgumentParser()
+    parser.add_argument('in_file',
+                        help='Input FASTQ file. Gzip compressed files are detected automatically. '
+                             'Specify - to read from standard input.')
+    parser.add_argument('-o', dest='out_file', default=None,
+                        help='Output FASTA file. Specify - to write to standard output. '
+                             'Defaults to the input file name with a .fasta extension in the current directory, '
+                             'or standard output when reading from standard input.')
+    args = parser.parse_args()
+
+    # Set output file name
+    out_file = args.out_file
+    if out_file is None and args.in_file == '-':
+        out_file = '-'
+    elif out_file is None:
+        out_file = path.split(args.in_file)[1]
+        if out_file.endswith('.gz'):  out_file = out_file[:-3]
+        out_file = '%s.fasta' % path.splitext(out_file)[0]
+
+    # Convert
+    with openFile(args.in_file, 'rb') as in_handle, openFile(out_file, 'wb') as out_handle:
+        try:
+            convertFastq(in_handle, out_handle, name=args.in_file)
+        except FastqFormatError as e:
+            sys.exit(e)
+
+    # Report output file name
+    if out_file != '-':  print(out_file)
@@ -0,0 +1,160 @@
+"""
+Line oriented FASTA and FASTQ input and output shared by the accessory scripts
+"""
+
+# Imports
+import gzip
+import shutil
+import sys
+from contextlib import contextmanager
+from subprocess import Popen, PIPE
+
+# Default number of bytes to read per block
+default_block_size = 1 << 22
+
+
+class FastqFormatError(ValueError):
+    """
+    Exception raised when FASTQ record framing is invalid
+    """
+    pass
+
+
+def isGzip(path, mode='rb'):
+    """
+    Determines whether a file is gzip compressed
+
+    Arguments:
+      path (str): file path. '-' denotes standard input or output.
+      mode (str): file mode. Files opened for reading are checked for the gzip magic number,
+                  files opened for writing are checked for a .gz extension.
+
+    Returns:
+      bool: True if the file is gzip compressed.
+    """
+    if path == '-':
+        return False
+    elif 'r' in mode:
+        with open(path, 'rb') as handle:
+            return handle.read(2) == b'\x1f\x8b'
+    else:
+        return path.endswith('.gz')
+
+
+@contextmanager
+def openFile(path, mode='rb', nproc=1):
+    """
+    Opens a plain or gzip compressed file in binary mode
+
+    Gzip compression is detected from the file contents when reading and from the .gz extension when writing.
+    If nproc is greater than 1 and pigz is available, compression and decompression run in a pigz subprocess.
+
+    Arguments:
+      path (str): file path. '-' denotes standard input or output.
+      mode (str): one of 'rb' or 'wb'.
+      nproc (int): number of pigz threads.
+
+    Returns:
+      file: binary file handle.
+    """
+    gz = isGzip(path, mode)
+    pigz = shutil.which('pigz') if gz and nproc > 1 else None
+
+    if path == '-':
+        yield sys.stdin.buffer if 'r' in mode else sys.stdout.buffer
+        if 'w' in mode:  sys.stdout.buffer.flush()
+    elif pigz is not None and 'r' in mode:
+        proc = Popen([pigz, '-dc', '-p', str(nproc), path], stdout=PIPE)
+        try:
+            yield proc.stdout
+        finally:
+            proc.stdout.close()
+            if proc.wait() not in (0, -13):
+                sys.exit('Error decompressing %s with pigz.' % path)
+    elif pigz is not None:
+        with open(path, 'wb') as out_handle:
+            proc = Popen([pigz, '-c', '-p', str(nproc)], stdin=PIPE, stdout=out_handle)
+            try:
+                yield proc.stdin
+            finally:
+                proc.stdin.close()
+                if proc.wait() != 0:
+                    sys.exit('Error compressing %s with pigz.' % path)
+    elif gz:
+        with gzip.open(path, mode) as handle:
+            yield handle
+    else:
+        with open(path, mode) as handle:
+            yield handle
+
+
+def readFasta(handle):
+    """
+    Iterates over FASTA records
+
+    Arguments:
+      handle (file): text input handle.
+
+    Returns:
+      iter: iterator of (header, sequence) tuples without the leading >.
+    """
+    header, lines = None, []
+    for line in handle:
+        if line.startswith('>'):
+            if header is not None:
+                yield header, ''.join(lines)
+            header, lines = line[1:].rstrip(), []
+        elif header is not None:
+            lines.append(line.strip().replace(' ', ''))
+    if header is not None:
+        yield header, ''.join(lines)
+
+
+def readFastqBlocks(handle, name='', block_size=default_block_size):
+    """
+    Reads blocks of complete FASTQ records and validates their framing
+
+    Records must be four lines: a header starting with @, the sequence, a separator starting with +
+    and a quality string of the same length as the sequence.
+
+    Arguments:
+      handle (file): binary input handle.
+      name (str): input name for error messages.
+      block_size (int): approximate number of bytes to read per block.
+
+    Returns:
+      iter: iterator of lists of lines, each list containing a multiple of four lines.
+
+    Raises:
+      FastqFormatError: if a record is malformed or truncated.
+    """
+    carry = []
+    count = 0
+    while True:
+        lines = handle.readlines(block_size)
+        if not lines:
+            break
+        if carry:
+            lines = carry + lines
+        n = len(lines) - len(lines) % 4
+        block, carry = lines[:n], lines[n:]
+        if not block:
+            continue
+
+        # Terminate final line
+        if not block[-1].endswith(b'\n'):
+            block[-1] += b'\n'
+
+        # Check framing
+        headers, seqs, seps, quals = block[0::4], block[1::4], block[2::4], block[3::4]
+        if not all(x.startswith(b'@') for x in headers) or not all(x.startswith(b'+') for x in seps) or \
+                not all(len(s.rstrip()) == len(q.rstrip()) for s, q in zip(seqs, quals)):
+            for i, (h, s, p, q) in enumerate(zip(headers, seqs, seps, quals), start=count + 1):
+                if not h.startswith(b'@') or not p.startswith(b'+') or len(s.rstrip()) != len(q.rstrip()):
+                    raise FastqFormatError('Invalid FASTQ record %i in %s.' % (i, name))
+
+        count += len(headers)
+        yield block
+
+    if any(x.strip() for x in carry):
+        raise FastqFormatError('Truncated FASTQ record %i in %s.' % (count + 1, name))
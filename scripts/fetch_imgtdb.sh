@@ -6,24 +6,41 @@
 #
 # Arguments:
 #   -o = Output directory for downloaded files. Defaults to current directory.
+#   -n = Number of concurrent downloads. Defaults to 4.
+#   -u = Base URL or local mirror directory of IMGT/GENE-DB. Defaults to http://www.imgt.org/IMGT_GENE-DB.
+#   -f = Download and rewrite all files, ignoring saved ETags, content hashes and incomplete runs.
 #   -h = Display help.
 
 # Default argument values
 OUTDIR="."
+NPROC=4
+BASE_URL="http://www.imgt.org/IMGT_GENE-DB"
+FORCE=false
 
 # Print usage
 usage () {
     echo "Usage: `basename $0` [OPTIONS]"
     echo "  -o  Output directory for downloaded files. Defaults to current directory."
+    echo "  -n  Number of concurrent downloads. Defaults to 4."
+    echo "  -u  Base URL or local mirror directory of IMGT/GENE-DB."
+    echo "      Defaults to http://www.imgt.org/IMGT_GENE-DB. A mirror directory or file:// URL"
+    echo "      must contain the GENElect query pages under their query names, as saved by wget -x."
+    echo "  -f  Download and rewrite all files, ignoring saved ETags, content hashes and incomplete runs."
     echo "  -h  This message."
 }
 
 # Get commandline arguments
-while getopts "o:h" OPT; do
+while getopts "o:n:u:fh" OPT; do
     case "$OPT" in
     o)  OUTDIR=$OPTARG
         OUTDIR_SET=true
         ;;
+    n)  NPROC=$OPTARG
+        ;;
+    u)  BASE_URL=${OPTARG%/}
+        ;;
+    f)  FORCE=true
+        ;;
     h)  usage
         exit
         ;;
@@ -40,12 +57,162 @@ done
 REPERTOIRE="imgt"
 DATE=$(date +"%Y.%m.%d")
 
+# Download state. Each output file has a state file recording the run that last checked it,
+# the server ETag and the SHA-256 of the written file. The RUN file exists while a run is incomplete.
+STATE_DIR="${OUTDIR}/.fetch_imgtdb"
+RUN_FILE="${STATE_DIR}/RUN"
+mkdir -p $STATE_DIR
+if $FORCE; then
+    rm -f ${STATE_DIR}/*.state ${STATE_DIR}/*.status
+fi
+if [ -f $RUN_FILE ]; then
+    RUN=$(cat $RUN_FILE)
+    echo "Resuming incomplete download ${RUN}..."
+else
+    RUN="$(date +%Y%m%d%H%M%S)-$$"
+    echo $RUN > $RUN_FILE
+    rm -f ${STATE_DIR}/*.status
+fi
+
+# Compute SHA-256 digest of a file
+sha256 () {
+    if command -v sha256sum > /dev/null; then
+        sha256sum "$1" | cut -d ' ' -f 1
+    else
+        shasum -a 256 "$1" | cut -d ' ' -f 1
+    fi
+}
+
+# Fetch a GENElect query into a file
+#
+# Arguments:
+#   $1 = GENElect query string.
+#   $2 = Output file.
+#   $3 = ETag of the current output file. Sent as If-None-Match for http(s) URLs.
+#
+# Prints the response ETag, or NOT_MODIFIED if the server reports the page unchanged.
+# Returns non-zero if the download failed.
+fetchPage () {
+    local QUERY=$1
+    local OUT_FILE=$2
+    local OLD_ETAG=$3
+    local MIRROR HEADERS CODE
+
+    case "$BASE_URL" in
+    http://*|https://*|ftp://*)
+        HEADERS="${OUT_FILE}.headers"
+        if [ -n "$OLD_ETAG" ]; then
+            wget "${BASE_URL}/GENElect?${QUERY}" -O $OUT_FILE -q -S --header="If-None-Match: ${OLD_ETAG}" \
+                2> $HEADERS
+        else
+            wget "${BASE_URL}/GENElect?${QUERY}" -O $OUT_FILE -q -S 2> $HEADERS
+        fi
+        CODE=$(awk '/^ *HTTP\//{c=$2}END{print c}' $HEADERS)
+        if [ "$CODE" == "304" ]; then
+            echo "NOT_MODIFIED"
+        elif [ "$CODE" == "200" ] || [[ "$BASE_URL" == ftp://* && -s $OUT_FILE ]]; then
+            awk 'tolower($1)=="etag:"{sub(/^ *[^:]*: */, ""); sub(/\r$/, ""); e=$0}END{print e}' $HEADERS
+        else
+            rm -f $HEADERS
+            return 1
+        fi
+        rm -f $HEADERS
+        ;;
+    *)
+        MIRROR=${BASE_URL#file://}
+        cp "${MIRROR}/GENElect?${QUERY}" $OUT_FILE || return 1
+        echo ""
+        ;;
+    esac
+}
+
+# Download, extract and write a germline file unless it is unchanged
+#
+# Arguments:
+#   $1 = GENElect query string.
+#   $2 = Output FASTA file.
+#   $3 = sed expression for species name replacement.
+#
+# Writes one of updated, unchanged, resumed or failed to the status file.
+fetchGermline () {
+    local QUERY=$1
+    local FILE_NAME=$2
+    local REPLACE_VALUE=$3
+    local NAME=$(basename $FILE_NAME .fasta)
+    local STATE_FILE="${STATE_DIR}/${NAME}.state"
+    local STATUS_FILE="${STATE_DIR}/${NAME}.status"
+    local TMP_FILE="${FILE_NAME}.tmp"
+    local OLD_RUN="" OLD_ETAG="" OLD_HASH="" ETAG HASH STATUS
+
+    # Read state and check whether the current file is intact
+    if [ -f $STATE_FILE ]; then
+        read OLD_RUN OLD_ETAG OLD_HASH < $STATE_FILE
+        [ "$OLD_ETAG" == "-" ] && OLD_ETAG=""
+        if [ ! -f $FILE_NAME ] || [ "$(sha256 $FILE_NAME)" != "$OLD_HASH" ]; then
+            OLD_RUN=""
+            OLD_ETAG=""
+            OLD_HASH=""
+        fi
+    fi
+
+    # Skip files already checked by an incomplete run
+    if [ "$OLD_RUN" == "$RUN" ]; then
+        echo "resumed" > $STATUS_FILE
+        return 0
+    fi
+
+    # Download and extract
+    if ! ETAG=$(fetchPage "$QUERY" $TMP_FILE "$OLD_ETAG"); then
+        rm -f $TMP_FILE
+        echo "failed" > $STATUS_FILE
+        return 1
+    fi
+    if [ "$ETAG" == "NOT_MODIFIED" ]; then
+        ETAG=$OLD_ETAG
+        HASH=$OLD_HASH
+        STATUS="unchanged"
+    else
+        awk '/<pre>/{i++}/<\/pre>/{j++}{if(j==2){exit}}{if(i==2 && j==1 && $0!~"^<pre>"){print}}' $TMP_FILE \
+            > ${TMP_FILE}.fasta
+        # Make sed command work also for mac, see: https://stackoverflow.com/a/44864004
+        sed -i.bak "$REPLACE_VALUE" ${TMP_FILE}.fasta && rm ${TMP_FILE}.fasta.bak
+        HASH=$(sha256 ${TMP_FILE}.fasta)
+        if [ -f $FILE_NAME ] && [ "$HASH" == "$OLD_HASH" ]; then
+            rm ${TMP_FILE}.fasta
+            STATUS="unchanged"
+        else
+            mv ${TMP_FILE}.fasta $FILE_NAME
+            STATUS="updated"
+        fi
+    fi
+    rm -f $TMP_FILE
+
+    # Record state
+    echo -e "${RUN}\t${ETAG:--}\t${HASH}" > ${STATE_FILE}.tmp && mv ${STATE_FILE}.tmp $STATE_FILE
+    echo $STATUS > $STATUS_FILE
+}
+
+# Queue a download, waiting while NPROC downloads are running
+#
+# Arguments:
+#   $1 = GENElect query string.
+#   $2 = Output FASTA file.
+#   $3 = sed expression for species name replacement.
+FILES=()
+queueGermline () {
+    while [ $(jobs -rp | wc -l) -ge $NPROC ]; do
+        sleep 0.1
+    done
+    FILES+=("$2")
+    fetchGermline "$@" &
+}
+
 # Associative array (for BASH v3) where keys are species folder names and values are query strings
 SPECIES_QUERY=("human:Homo+sapiens"
                "mouse:Mus")
 # Associative array (for BASH v3) with species name replacements
 SPECIES_REPLACE=('human:s/Homo sapiens/Homo_sapiens/g'
-                 'mouse:s/Mus musculus/Mus_musculus/g')   
+                 'mouse:s/Mus musculus/Mus_musculus/g')
 
 # Counter for loop iteration, used for getting the right values of SPECIES_REPLACE
 COUNT=0
@@ -58,82 +225,35 @@ do
 	echo "Downloading ${KEY} repertoires into ${OUTDIR}..."
 
 	# Download VDJ
-	echo "|- VDJ regions"
     FILE_PATH="${OUTDIR}/${KEY}/vdj"
     mkdir -p $FILE_PATH
 
-    # VDJ Ig
-    echo "|---- Ig"
-    for CHAIN in IGHV IGHD IGHJ IGKV IGKJ IGLV IGLJ
+    # VDJ Ig and TCR
+    for CHAIN in IGHV IGHD IGHJ IGKV IGKJ IGLV IGLJ TRAV TRAJ TRBV TRBD TRBJ TRDV TRDD TRDJ TRGV TRGJ
     do
-        URL="http://www.imgt.org/IMGT_GENE-DB/GENElect?query=7.14+${CHAIN}&species=${VALUE}"
+        QUERY="query=7.14+${CHAIN}&species=${VALUE}"
         FILE_NAME="${FILE_PATH}/${REPERTOIRE}_${KEY}_${CHAIN}.fasta"
-        TMP_FILE="${FILE_NAME}.tmp"
-        #echo $URL
-        wget $URL -O $TMP_FILE -q
-        awk '/<pre>/{i++}/<\/pre>/{j++}{if(j==2){exit}}{if(i==2 && j==1 && $0!~"^<pre>"){print}}' $TMP_FILE > $FILE_NAME
-        # Make sed command work also for mac, see: https://stackoverflow.com/a/44864004
-        sed -i.bak "$REPLACE_VALUE" $FILE_NAME && rm $FILE_NAME.bak
-        rm $TMP_FILE
-    done
-
-    # VDJ TCR
-    echo "|---- TCR"
-    for CHAIN in TRAV TRAJ TRBV TRBD TRBJ TRDV TRDD TRDJ TRGV TRGJ
-    do
-        URL="http://www.imgt.org/IMGT_GENE-DB/GENElect?query=7.14+${CHAIN}&species=${VALUE}"
-        FILE_NAME="${FILE_PATH}/${REPERTOIRE}_${KEY}_${CHAIN}.fasta"
-        TMP_FILE="${FILE_NAME}.tmp"
-        #echo $URL
-        wget $URL -O $TMP_FILE -q
-        awk '/<pre>/{i++}/<\/pre>/{j++}{if(j==2){exit}}{if(i==2 && j==1 && $0!~"^<pre>"){print}}' $TMP_FILE > $FILE_NAME
-        sed -i.bak "$REPLACE_VALUE" $FILE_NAME && rm $FILE_NAME.bak
-        rm $TMP_FILE
+        queueGermline "$QUERY" $FILE_NAME "$REPLACE_VALUE"
     done
 
-
 	# Download leaders
-    echo "|- Spliced leader regions"
     FILE_PATH="${OUTDIR}/${KEY}/leader"
     mkdir -p $FILE_PATH
 
-    # Leader Ig
-    echo "|---- Ig"
-    for CHAIN in IGH IGK IGL
+    # Leader Ig and TCR
+    for CHAIN in IGH IGK IGL TRA TRB TRG TRD
     do
-        URL="http://www.imgt.org/IMGT_GENE-DB/GENElect?query=8.1+${CHAIN}V&species=${VALUE}&IMGTlabel=L-PART1+L-PART2"
+        QUERY="query=8.1+${CHAIN}V&species=${VALUE}&IMGTlabel=L-PART1+L-PART2"
         FILE_NAME="${FILE_PATH}/${REPERTOIRE}_${KEY}_${CHAIN}L.fasta"
-        TMP_FILE="${FILE_NAME}.tmp"
-        #echo $URL
-        wget $URL -O $TMP_FILE -q
-        awk '/<pre>/{i++}/<\/pre>/{j++}{if(j==2){exit}}{if(i==2 && j==1 && $0!~"^<pre>"){print}}' $TMP_FILE > $FILE_NAME
-        sed -i.bak "$REPLACE_VALUE" $FILE_NAME && rm $FILE_NAME.bak
-        rm $TMP_FILE
+        queueGermline "$QUERY" $FILE_NAME "$REPLACE_VALUE"
     done
 
-    # Leader TCR
-    echo "|---- TCR"
-    for CHAIN in TRA TRB TRG TRD
-    do
-        URL="http://www.imgt.org/IMGT_GENE-DB/GENElect?query=8.1+${CHAIN}V&species=${VALUE}&IMGTlabel=L-PART1+L-PART2"
-        FILE_NAME="${FILE_PATH}/${REPERTOIRE}_${KEY}_${CHAIN}L.fasta"
-        TMP_FILE="${FILE_NAME}.tmp"
-        #echo $URL
-        wget $URL -O $TMP_FILE -q
-        awk '/<pre>/{i++}/<\/pre>/{j++}{if(j==2){exit}}{if(i==2 && j==1 && $0!~"^<pre>"){print}}' $TMP_FILE > $FILE_NAME
-        sed -i.bak "$REPLACE_VALUE" $FILE_NAME && rm $FILE_NAME.bak
-        rm $TMP_FILE
-    done
-
-
 	# Download constant regions
-    echo "|- Spliced constant regions"
-    FILE_PATH="${OUTDIR}/${KEY}/constant/"
+    FILE_PATH="${OUTDIR}/${KEY}/constant"
     mkdir -p $FILE_PATH
 
-    # Constant Ig
-    echo "|---- Ig"
-    for CHAIN in IGHC IGKC IGLC
+    # Constant Ig and TCR
+    for CHAIN in IGHC IGKC IGLC TRAC TRBC TRGC TRDC
     do
         QUERY=14.1
         if [ "${KEY}" == "mouse" ] && ([ "$CHAIN" == "IGKC" ] || [ "$CHAIN" == "IGLC" ]); then
@@ -141,37 +261,35 @@ do
             QUERY=7.5
         fi
 
-        URL="http://www.imgt.org/IMGT_GENE-DB/GENElect?query=${QUERY}+${CHAIN}&species=${VALUE}"
+        QUERY="query=${QUERY}+${CHAIN}&species=${VALUE}"
         FILE_NAME="${FILE_PATH}/${REPERTOIRE}_${KEY}_${CHAIN}.fasta"
-        TMP_FILE="${FILE_NAME}.tmp"
-        #echo $URL
-        wget $URL -O $TMP_FILE -q
-        awk '/<pre>/{i++}/<\/pre>/{j++}{if(j==2){exit}}{if(i==2 && j==1 && $0!~"^<pre>"){print}}' $TMP_FILE > $FILE_NAME
-        sed -i.bak "$REPLACE_VALUE" $FILE_NAME && rm $FILE_NAME.bak
-        rm $TMP_FILE
+        queueGermline "$QUERY" $FILE_NAME "$REPLACE_VALUE"
     done
 
-    # Constant for TCR
-    echo "|---- TCR"
-    for CHAIN in TRAC TRBC TRGC TRDC
-    do
-        URL="http://www.imgt.org/IMGT_GENE-DB/GENElect?query=14.1+${CHAIN}&species=${VALUE}"
-        FILE_NAME="${FILE_PATH}/${REPERTOIRE}_${KEY}_${CHAIN}.fasta"
-        TMP_FILE="${FILE_NAME}.tmp"
-        #echo $URL
-        wget $URL -O $TMP_FILE -q
-        awk '/<pre>/{i++}/<\/pre>/{j++}{if(j==2){exit}}{if(i==2 && j==1 && $0!~"^<pre>"){print}}' $TMP_FILE > $FILE_NAME
-        sed -i.bak "$REPLACE_VALUE" $FILE_NAME && rm $FILE_NAME.bak
-        rm $TMP_FILE
-    done
-
-    echo ""
     ((COUNT++))
 done
+wait
+
+# Report download status
+FAILED=0
+echo ""
+for F in ${FILES[@]}
+do
+    STATUS=$(cat ${STATE_DIR}/$(basename $F .fasta).status 2> /dev/null || echo "failed")
+    [ "$STATUS" == "failed" ] && ((FAILED++))
+    printf "%10s  %s\n" $STATUS $F
+done
+echo ""
+
+if [ $FAILED -gt 0 ]; then
+    echo "${FAILED} downloads failed. Rerun to resume the download." >&2
+    exit 1
+fi
+rm -f $RUN_FILE ${STATE_DIR}/*.status
 
 # Write download info
 INFO_FILE=${OUTDIR}/IMGT.yaml
-echo -e "source:  http://www.imgt.org/IMGT_GENE-DB" > $INFO_FILE
+echo -e "source:  ${BASE_URL}" > $INFO_FILE
 echo -e "date:    ${DATE}" >> $INFO_FILE
 echo -e "species:" >> $INFO_FILE
 for Q in ${SPECIES_QUERY[@]}
@@ -1,5 +1,6 @@
 #!/usr/bin/env bash
 # Download PhiX174 nucleotide sequence from NCBI and build blastn indexed db
+# and the k-mer index used by preprocess-phix.sh to screen reads before blastn
 #
 # Author:  Susanna Marquez
 # Date:    2017.09.21
@@ -47,6 +48,9 @@ BLAST_DB="${OUTDIR}/GCF_000819615.1_ViralProj14015_genomic.fna"
 # Build blast database
 makeblastdb -in ${BLAST_DB} -parse_seqids -dbtype nucl
 
+# Build k-mer index
+phix_kmers.py index -r ${BLAST_DB} -o ${BLAST_DB%.fna}.kmers > /dev/null
+
 # Write download info
 INFO_FILE="${OUTDIR}/PhiX174.yaml"
 echo -e "source:  ftp://ftp.ncbi.nlm.nih.gov/genomes/all/GCF/000/819/615/GCF_000819615.1_ViralProj14015/GCF_000819615.1_ViralProj14015_genomic.fna.gz" > $INFO_FILE
@@ -0,0 +1,168 @@
+#!/usr/bin/env bash
+# Content-addressed cache of IgBLAST fmt7 output
+#
+# Commands:
+#   key  Print the cache key for a query file, germline database, auxiliary data and IgBLAST version.
+#        Without a query file, the key identifies only the reference data and IgBLAST version.
+#   get  Copy a cached result to an output file. Exits with status 1 on a cache miss.
+#   put  Store a result in the cache and evict the least recently used results above the size limit.
+#
+# Arguments:
+#   -s = FASTA query file. Optional. (key)
+#   -b = IGDATA directory, which contains the IgBLAST database, optional_file
+#        and internal_data directories. (key)
+#   -g = Species name. One of human or mouse. (key)
+#   -t = Receptor type. One of ig or tr. (key)
+#   -v = IgBLAST version. (key)
+#   -x = Additional string identifying the IgBLAST command and options. (key)
+#   -d = Cache directory. (get, put)
+#   -k = Cache key. (get, put)
+#   -i = fmt7 file to store. (put)
+#   -o = Output fmt7 file. (get)
+#   -m = Maximum cache size in megabytes. Defaults to 10240. (put)
+#   -h = Display help.
+
+# Default argument values
+MAX_SIZE=10240
+EXTRA=""
+
+# Print usage
+usage () {
+    echo -e "Usage: `basename $0` key|get|put [OPTIONS]"
+    echo -e "  key  Print the cache key for a query file, germline database, auxiliary data\n" \
+            "      and IgBLAST version. Requires -b, -g, -t and -v. Without -s, the key\n" \
+            "      identifies only the reference data and IgBLAST version."
+    echo -e "  get  Copy a cached result to an output file. Exits with status 1 on a cache miss.\n" \
+            "      Requires -d, -k and -o."
+    echo -e "  put  Store a result in the cache and evict the least recently used results\n" \
+            "      above the size limit. Requires -d, -k and -i."
+    echo -e "  -s  FASTA query file. Optional for key."
+    echo -e "  -b  IGDATA directory, which contains the IgBLAST database, optional_file\n" \
+            "     and internal_data directories."
+    echo -e "  -g  Species name. One of human or mouse."
+    echo -e "  -t  Receptor type. One of ig or tr."
+    echo -e "  -v  IgBLAST version."
+    echo -e "  -x  Additional string identifying the IgBLAST command and options."
+    echo -e "  -d  Cache directory."
+    echo -e "  -k  Cache key."
+    echo -e "  -i  fmt7 file to store."
+    echo -e "  -o  Output fmt7 file."
+    echo -e "  -m  Maximum cache size in megabytes. Defaults to 10240."
+    echo -e "  -h  This message."
+}
+
+# Get command
+CMD=$1
+if [ "$CMD" == "-h" ]; then
+    usage
+    exit
+elif [ "$CMD" != "key" ] && [ "$CMD" != "get" ] && [ "$CMD" != "put" ]; then
+    usage >&2
+    exit 1
+fi
+shift
+
+# Get commandline arguments
+while getopts "s:b:g:t:v:x:d:k:i:o:m:h" OPT; do
+    case "$OPT" in
+    s)  READFILE=$OPTARG
+        ;;
+    b)  IGDATA=$OPTARG
+        ;;
+    g)  SPECIES=$OPTARG
+        ;;
+    t)  RECEPTOR=$OPTARG
+        ;;
+    v)  VERSION=$OPTARG
+        ;;
+    x)  EXTRA=$OPTARG
+        ;;
+    d)  CACHE_DIR=$OPTARG
+        ;;
+    k)  KEY=$OPTARG
+        ;;
+    i)  INFILE=$OPTARG
+        ;;
+    o)  OUTFILE=$OPTARG
+        ;;
+    m)  MAX_SIZE=$OPTARG
+        ;;
+    h)  usage
+        exit
+        ;;
+    \?) echo "Invalid option: -$OPTARG" >&2
+        exit 1
+        ;;
+    :)  echo "Option -$OPTARG requires an argument" >&2
+        exit 1
+        ;;
+    esac
+done
+
+# Compute SHA-256 digests of files
+sha256 () {
+    if command -v sha256sum > /dev/null; then
+        sha256sum "$@"
+    else
+        shasum -a 256 "$@"
+    fi
+}
+
+# Print the cache key
+if [ "$CMD" == "key" ]; then
+    if [ -z "$IGDATA" ] || [ -z "$SPECIES" ] || [ -z "$RECEPTOR" ] || [ -z "$VERSION" ]; then
+        echo "The key command requires -b, -g, -t and -v" >&2
+        exit 1
+    fi
+    GERMLINE_FILES=$(ls ${IGDATA}/database/imgt_${SPECIES}_${RECEPTOR}_[vdj].* \
+                        ${IGDATA}/optional_file/${SPECIES}_gl.aux 2> /dev/null)
+    if [ -z "$GERMLINE_FILES" ]; then
+        echo "No germline database files found for ${SPECIES}_${RECEPTOR} in ${IGDATA}" >&2
+        exit 1
+    fi
+    INTERNAL_FILES=$(find ${IGDATA}/internal_data/${SPECIES} -type f 2> /dev/null | sort)
+    {
+        echo "version ${VERSION}"
+        echo "options ${EXTRA}"
+        [ -n "$READFILE" ] && sha256 ${READFILE} | cut -d ' ' -f 1
+        # File names are relative to IGDATA so the key does not depend on the installation path
+        sha256 ${GERMLINE_FILES} ${INTERNAL_FILES} | sed "s|${IGDATA}/||"
+    } | sha256 | cut -d ' ' -f 1
+    exit
+fi
+
+# Check cache arguments
+if [ -z "$CACHE_DIR" ] || [ -z "$KEY" ]; then
+    echo "The ${CMD} command requires -d and -k" >&2
+    exit 1
+fi
+CACHE_FILE="${CACHE_DIR}/${KEY}.fmt7"
+
+# Copy a cached result and mark it as recently used
+if [ "$CMD" == "get" ]; then
+    if [ -z "$OUTFILE" ]; then
+        echo "The get command requires -o" >&2
+        exit 1
+    fi
+    [ -f $CACHE_FILE ] || exit 1
+    touch $CACHE_FILE
+    cp $CACHE_FILE ${OUTFILE}.tmp && mv ${OUTFILE}.tmp $OUTFILE
+    exit
+fi
+
+# Store a result and evict least recently used results
+if [ -z "$INFILE" ] || [ ! -f "$INFILE" ]; then
+    echo "The put command requires an existing file for -i" >&2
+    exit 1
+fi
+mkdir -p $CACHE_DIR
+TMP_FILE=$(mktemp "${CACHE_DIR}/.${KEY}.XXXXXX")
+cp $INFILE $TMP_FILE && mv $TMP_FILE $CACHE_FILE
+
+TOTAL=$(du -sk ${CACHE_DIR} | cut -f 1)
+for F in $(ls -tr ${CACHE_DIR}/*.fmt7); do
+    [ $TOTAL -le $(( MAX_SIZE * 1024 )) ] && break
+    [ "$F" == "$CACHE_FILE" ] && continue
+    TOTAL=$(( TOTAL - $(du -k $F | cut -f 1) ))
+    rm -f $F
+done
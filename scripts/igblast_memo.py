@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Per-sequence store of IgBLAST fmt7 results shared across samples
+"""
+
+# Imports
+import hashlib
+import sqlite3
+import sys
+from argparse import ArgumentParser
+
+# Local imports
+from fastq_io import readFasta
+
+# Seconds to wait for other processes writing to the same store
+store_timeout = 600
+
+
+def hashSequence(seq):
+    """
+    Computes the store key of a sequence
+
+    Arguments:
+      seq (str): nucleotide sequence.
+
+    Returns:
+      str: hexadecimal SHA-1 digest of the uppercased sequence.
+    """
+    return hashlib.sha1(seq.upper().encode()).hexdigest()
+
+
+def openStore(store_file):
+    """
+    Opens or creates a sequence store
+
+    Arguments:
+      store_file (str): SQLite database file name.
+
+    Returns:
+      sqlite3.Connection: database connection.
+    """
+    db = sqlite3.connect(store_file, timeout=store_timeout)
+    db.execute('CREATE TABLE IF NOT EXISTS blocks (hash TEXT PRIMARY KEY, block TEXT NOT NULL)')
+
+    return db
+
+
+def readBlocks(handle):
+    """
+    Iterates over the per-query blocks of an IgBLAST fmt7 file
+
+    Arguments:
+      handle (file): fmt7 input handle.
+
+    Returns:
+      iter: iterator of (query title, block text) tuples. The trailing query count is skipped. A final block
+            without a following query count is skipped, as the output may have been truncated.
+    """
+    title, lines = None, []
+    for line in handle:
+        if line.startswith('# IGBLASTN') or line.startswith('# BLAST processed'):
+            if title is not None:
+                yield title, ''.join(lines)
+            title, lines = None, []
+        elif line.startswith('# Query: '):
+            title = line[9:].rstrip('\n')
+        lines.append(line)
+
+
+def renameBlock(block, key, title):
+    """
+    Replaces the sequence key used as the query name in a stored block
+
+    Arguments:
+      block (str): fmt7 block with the sequence key as the query name.
+      key (str): sequence key.
+      title (str): FASTA title of the query. The first word is used in the hit table.
+
+    Returns:
+      str: fmt7 block for the query.
+    """
+    query_id = title.split()[0]
+    lines = []
+    for line in block.splitlines(keepends=True):
+        if line.startswith('# Query: '):
+            line = '# Query: %s\n' % title
+        elif not line.startswith('#') and key in line:
+            line = '\t'.join(query_id if x == key else x for x in line.split('\t'))
+        lines.append(line)
+
+    return ''.join(lines)
+
+
+def splitQueries(in_file, store_file, out_file):
+    """
+    Writes the unique sequences that are not in the store, named by sequence key
+
+    Arguments:
+      in_file (str): FASTA query file.
+      store_file (str): store file name.
+      out_file (str): output FASTA file of unseen sequences.
+
+    Returns:
+      tuple: (number of queries, number of unseen sequences).
+    """
+    db = openStore(store_file)
+    seen = set()
+    count, unseen = 0, 0
+    with open(in_file, 'r') as in_handle, open(out_file, 'w') as out_handle:
+        for __, seq in readFasta(in_handle):
+            count += 1
+            key = hashSequence(seq)
+            if key in seen:
+                continue
+            seen.add(key)
+            if db.execute('SELECT 1 FROM blocks WHERE hash = ?', (key,)).fetchone() is None:
+                out_handle.write('>%s\n%s\n' % (key, seq))
+                unseen += 1
+    db.close()
+
+    return count, unseen
+
+
+def mergeQueries(in_file, store_file, fmt7_file, out_file):
+    """
+    Adds new IgBLAST results to the store and writes results for all queries in input order
+
+    Arguments:
+      in_file (str): FASTA query file.
+      store_file (str): store file name.
+      fmt7_file (str): IgBLAST output for the unseen sequences written by splitQueries. May be None.
+      out_file (str): output fmt7 file.
+
+    Returns:
+      int: number of queries written.
+    """
+    db = openStore(store_file)
+
+    # Store new results
+    if fmt7_file is not None:
+        with open(fmt7_file, 'r') as handle, db:
+            db.executemany('INSERT OR REPLACE INTO blocks VALUES (?, ?)', readBlocks(handle))
+
+    # Write results in input order
+    count = 0
+    with open(in_file, 'r') as in_handle, open(out_file, 'w') as out_handle:
+        for title, seq in readFasta(in_handle):
+            key = hashSequence(seq)
+            row = db.execute('SELECT block FROM blocks WHERE hash = ?', (key,)).fetchone()
+            if row is None:
+                db.close()
+                sys.exit('No IgBLAST result for query %s.' % title.split()[0])
+            out_handle.write(renameBlock(row[0], key, title))
+            count += 1
+        out_handle.write('# BLAST processed %i queries\n' % count)
+    db.close()
+
+    return count
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and calls main
+    """
+    # Define arguments
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    parser_split = subparsers.add_parser('split',
+                                         help='Write the unique query sequences that are not in the store.')
+    parser_split.add_argument('-s', dest='in_file', required=True, help='FASTA query file.')
+    parser_split.add_argument('-d', dest='store_file', required=True, help='Sequence store file.')
+    parser_split.add_argument('-o', dest='out_file', required=True,
+                              help='Output FASTA file of unseen sequences named by sequence hash.')
+    parser_merge = subparsers.add_parser('merge',
+                                         help='Store new IgBLAST results and write results for all queries.')
+    parser_merge.add_argument('-s', dest='in_file', required=True, help='FASTA query file.')
+    parser_merge.add_argument('-d', dest='store_file', required=True, help='Sequence store file.')
+    parser_merge.add_argument('-i', dest='fmt7_file', default=None,
+                              help='IgBLAST fmt7 output for the sequences written by split.')
+    parser_merge.add_argument('-o', dest='out_file', required=True, help='Output fmt7 file.')
+    args = parser.parse_args()
+
+    # Split or merge queries
+    if args.command == 'split':
+        count, unseen = splitQueries(args.in_file, args.store_file, args.out_file)
+        print('%i %i' % (count, unseen))
+    else:
+        mergeQueries(args.in_file, args.store_file, args.fmt7_file, args.out_file)
@@ -7,10 +7,12 @@
 # Arguments:
 #   -i = Input directory containing germlines in the form <species>/vdj/imgt_<species>_<chain><segment>.fasta
 #   -o = Output directory for the built database. Defaults to current directory.
+#   -n = Number of files to process in parallel. Defaults to 1.
 #   -h = Display help.
 
 # Default argument values
 OUTDIR="."
+NPROC=1
 
 # Print usage
 usage () {
@@ -18,11 +20,12 @@ usage () {
     echo -e "  -i  Input directory containing germlines in the form:"
     echo -e "      <species>/vdj/imgt_<species>_<chain><segment>.fasta."
     echo -e "  -o  Output directory for the built database."
+    echo -e "  -n  Number of files to process in parallel. Defaults to 1."
     echo -e "  -h  This message."
 }
 
 # Get commandline arguments
-while getopts "i:o:h" OPT; do
+while getopts "i:o:n:h" OPT; do
     case "$OPT" in
     i)  GERMDIR=$(realpath $OPTARG)
         GERMDIR_SET=true
@@ -30,6 +33,8 @@ while getopts "i:o:h" OPT; do
     o)  OUTDIR=$OPTARG
         OUTDIR_SET=true
         ;;
+    n)  NPROC=$OPTARG
+        ;;
     h)  usage
         exit
         ;;
@@ -70,14 +75,32 @@ do
     done
 done
 
-# Parse each created fasta file to create igblast database
+# Clean each created fasta file, skipping files unchanged since the last build
 cd ${TMPDIR}
+REBUILT=$(clean_imgtdb.py $(ls *.fasta) -o ${OUTDIR}/fasta --nproc ${NPROC}) || {
+    echo "clean_imgtdb.py failed" >&2
+    cd -; rm -rf $TMPDIR
+    exit 1
+}
+
+# Create igblast databases for rebuilt or missing files
+# Failed builds are removed, so the next run rebuilds them even if the fasta file is unchanged
+FAILED=0
 for F in $(ls *.fasta)
 do
-	clean_imgtdb.py ${F} ${OUTDIR}/fasta/${F}
-	makeblastdb -parse_seqids -dbtype nucl -in ${OUTDIR}/fasta/${F} \
-        -out ${OUTDIR}/database/${F%%.*}
+    DB="${OUTDIR}/database/${F%%.*}"
+    if echo "${REBUILT}" | grep -qxF "${OUTDIR}/fasta/${F}" || [ ! -f "${DB}.nsq" ]; then
+        if ! makeblastdb -parse_seqids -dbtype nucl -in ${OUTDIR}/fasta/${F} -out ${DB}; then
+            rm -f ${DB}.n*
+            ((FAILED++))
+        fi
+    fi
 done
 
 # Remove temporary fasta files
 cd -; rm -rf $TMPDIR
+
+if [ $FAILED -gt 0 ]; then
+    echo "makeblastdb failed for ${FAILED} databases" >&2
+    exit 1
+fi
@@ -5,12 +5,131 @@ Corrects IGH only cloning with IGK/L annotations (VERSION 1)
 
 # Imports
 import os
+import numpy as np
 import pandas as pd
+import multiprocessing as mp
 import sys
+import time
 from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from io import StringIO
 
 # Presto and changeo imports
-from changeo.Gene import parseAllele, gene_regex
+from changeo.Gene import gene_regex
+
+# Local imports
+from allele_cache import parseAlleleColumn, reportCache
+
+
+class StageTimer:
+    """
+    Records the wall time of sequential processing stages
+    """
+    def __init__(self, enabled=True):
+        """
+        Initializer
+
+        Arguments:
+          enabled (bool): if False, stages are not recorded and report is a no-op.
+        """
+        self.enabled = enabled
+        self.stages = []
+        self._last = time.perf_counter()
+
+    def stage(self, name):
+        """
+        Records the time elapsed since the previous stage
+
+        Arguments:
+          name (str): stage name.
+        """
+        if not self.enabled:  return None
+        now = time.perf_counter()
+        self.stages.append((name, now - self._last))
+        self._last = now
+
+    def report(self, handle=None):
+        """
+        Prints a table of stage timings
+
+        Arguments:
+          handle (file): output handle. Defaults to the current standard output.
+        """
+        if not self.enabled:  return None
+        if handle is None:  handle = sys.stdout
+        total = sum(t for __, t in self.stages)
+        for name, t in self.stages:
+            handle.write('%12s> %10.3f s\n' % (name.upper(), t))
+        handle.write('%12s> %10.3f s\n' % ('TOTAL', total))
+
+
+def getFields(format):
+    """
+    Returns the column names used for clustering
+
+    Arguments:
+      format (str): file format. one of 'changeo' or 'airr'.
+
+    Returns:
+      tuple: (cell_id, clone_id, v_call, j_call, junction_length, umi_count) column names.
+    """
+    if format == 'changeo':
+        return 'CELL', 'CLONE', 'V_CALL', 'J_CALL', 'JUNCTION_LENGTH', 'UMICOUNT'
+    elif format == 'airr':
+        return 'cell_id', 'clone_id', 'v_call', 'j_call', 'junction_length', 'umi_count'
+    else:
+        sys.exit("Invalid format %s" % format)
+
+
+def groupKeys(light_df, v_call, j_call, junction_length, clone_id):
+    """
+    Builds the V gene, J gene, junction length and heavy chain clone grouping key for each light chain
+
+    Arguments:
+      light_df (pandas.DataFrame): light chain data with heavy chain clone identifiers.
+      v_call (str): V call column name.
+      j_call (str): J call column name.
+      junction_length (str): junction length column name.
+      clone_id (str): clone identifier column name.
+
+    Returns:
+      pandas.Series: comma delimited grouping keys.
+    """
+    # gene names are parsed once per distinct call rather than once per row
+    v_gene = parseAlleleColumn(light_df[v_call], gene_regex)
+    j_gene = parseAlleleColumn(light_df[j_call], gene_regex)
+    junc_len = light_df[junction_length].astype('int').astype(str)
+
+    return v_gene.str.cat([j_gene, junc_len, light_df[clone_id]], sep=',')
+
+
+def resolveDoublets(heavy_df, cell_id, umi_count, doublets='drop'):
+    """
+    Filters cells with multiple heavy chains
+
+    Arguments:
+      heavy_df (pandas.DataFrame): heavy chain data.
+      cell_id (str): cell identifier column name.
+      umi_count (str): UMI count column name.
+      doublets (str): method for handling multiple heavy chains per cell. one of 'drop' or 'count'.
+                      'drop' removes all cells with multiple heavy chains. 'count' keeps the heavy chain
+                      with the highest UMI count, breaking ties by the first row, with cells ordered
+                      by first appearance.
+
+    Returns:
+      pandas.DataFrame: heavy chain data with a single row per cell.
+    """
+    if doublets == 'drop':
+        heavy_df = heavy_df.drop_duplicates(cell_id, keep=False)
+    elif doublets == 'count':
+        heavy_df = heavy_df.loc[heavy_df[cell_id].notna(), :].copy()
+        heavy_df[umi_count] = heavy_df[umi_count].astype('int')
+        # stable sort by cell order of appearance then descending count, keeping the first row for each cell
+        rank = pd.factorize(heavy_df[cell_id])[0]
+        order = np.lexsort((-heavy_df[umi_count].values, rank))
+        heavy_df = heavy_df.iloc[order].drop_duplicates(cell_id, keep='first')
+
+    return heavy_df
 
 
 def clusterLinkage(cell_series, group_series):
@@ -25,41 +144,57 @@ def clusterLinkage(cell_series, group_series):
     Returns:
       dict:  dictionary of {cell_id : cluster_id}.
     """
+    # disjoint-set forest over groups. 2 groups belong in same cluster if they share 1 cell (ie, for cells
+    # with multiple light chains). union by size with path compression is near-linear in the number of rows.
+    parent = {}
+    size = {}
+
+    def _find(group):
+        root = group
+        while parent[root] != root:
+            root = parent[root]
+        # compress path
+        while parent[group] != root:
+            parent[group], group = root, parent[group]
+        return root
 
-    # assign initial clusters
-    # initial_dict = {cluster1: [cell1], cluster2: [cell1]}
-    initial_dict = {}
+    def _union(a, b):
+        a, b = _find(a), _find(b)
+        if a == b:
+            return
+        if size[a] < size[b]:
+            a, b = b, a
+        parent[b] = a
+        size[a] += size[b]
+
+    # link each group to the first group observed for the same cell
+    # group_order preserves first appearance of each group, which determines cluster numbering
+    cell_group = {}
+    group_order = []
     for cell, group in zip(cell_series, group_series):
-        try:    
-            initial_dict[group].append(cell)
+        if group not in parent:
+            parent[group] = group
+            size[group] = 1
+            group_order.append(group)
+        try:
+            _union(cell_group[cell], group)
         except KeyError:
-            initial_dict[group] = [cell]
-               
-    # naive single linkage clustering (ON^2 best case, ON^3 worst case) ...ie for cells with multiple light chains
-    # cluster_dict = {cluster1: [cell1, cell2]}, 2 cells belong in same group if they share 1 light chain 
-    while True:
-        cluster_dict = {}
-        for i, group in enumerate(initial_dict.keys()):
-            cluster_dict[i] = initial_dict[group]
-            for cluster in cluster_dict:
-                # if initial_dict[group] and cluster_dict[cluster] share common cells, add initial_dict[group] to cluster
-                if cluster != i and any(cell in initial_dict[group] for cell in cluster_dict[cluster]):
-                    cluster_dict[cluster] = cluster_dict[cluster] + initial_dict[group]
-                    del cluster_dict[i]
-                    break
-        # break if clusters stop changing, otherwise restart 
-        if len(cluster_dict.keys()) == len(initial_dict.keys()):
-            break
-        else:
-            initial_dict = cluster_dict.copy()
-    
-    # invert cluster_dict for return
-    assign_dict = {cell:k for k,v in cluster_dict.items() for cell in set(v)}
-    
+            cell_group[cell] = group
+
+    # number clusters in order of their earliest group
+    cluster_id = {}
+    for group in group_order:
+        root = _find(group)
+        if root not in cluster_id:
+            cluster_id[root] = len(cluster_id)
+
+    # assign cells to clusters
+    assign_dict = {cell: cluster_id[_find(group)] for cell, group in cell_group.items()}
+
     return assign_dict
 
 
-def lightCluster(heavy_file, light_file, out_file, doublets='drop', format='airr'):
+def lightCluster(heavy_file, light_file, out_file, doublets='drop', format='airr', benchmark=False, verbose=False):
     """
     Split heavy chain clones based on light chains
 
@@ -69,58 +204,249 @@ def lightCluster(heavy_file, light_file, out_file, doublets='drop', format='airr
       out_file (str): heavy chain output file.
       doublets (str): method for handling multiple heavy chains per cell. one of 'drop' or 'count'.
       format (str): file format. one of 'changeo' or 'airr'.
+      benchmark (bool): if True print the run time of each stage to standard output.
+      verbose (bool): if True print allele parsing cache statistics to standard output.
+
+    Returns:
+      dict: counts of input heavy chain cells, cells paired with a light chain and clusters.
     """
     # Set column names
-    if format == 'changeo':
-        cell_id = 'CELL'
-        clone_id = 'CLONE'
-        v_call = 'V_CALL'
-        j_call = 'J_CALL'
-        junction_length = 'JUNCTION_LENGTH'
-        umi_count = 'UMICOUNT'
-    elif format == 'airr':
-        cell_id = 'cell_id'
-        clone_id = 'clone_id'
-        v_call = 'v_call'
-        j_call = 'j_call'
-        junction_length = 'junction_length'
-        umi_count = 'umi_count'
-    else:
-        sys.exit("Invalid format %s" % format)
+    cell_id, clone_id, v_call, j_call, junction_length, umi_count = getFields(format)
+
+    # Stage timer
+    timer = StageTimer(enabled=benchmark)
 
     # read in heavy and light DFs
     heavy_df = pd.read_csv(heavy_file, dtype='object', na_values=['', 'None', 'NA'], sep='\t')
     light_df = pd.read_csv(light_file, dtype='object', na_values=['', 'None', 'NA'], sep='\t')
+    heavy_cells = heavy_df[cell_id].nunique()
+    timer.stage('read')
 
     # Fix types
     heavy_df[junction_length] = heavy_df[junction_length].astype('int')
     light_df[junction_length] = light_df[junction_length].astype('int')
 
     # filter multiple heavy chains
-    if doublets == 'drop':
-        heavy_df = heavy_df.drop_duplicates(cell_id, keep=False)
-    elif doublets == 'count':
-        heavy_df[umi_count] = heavy_df[umi_count].astype('int')
-        heavy_df = heavy_df.groupby(cell_id, sort=False).apply(lambda x: x.nlargest(1, umi_count))
+    heavy_df = resolveDoublets(heavy_df, cell_id, umi_count, doublets=doublets)
+    timer.stage('doublets')
 
     # transfer clone IDs from heavy chain df to light chain df
-    clone_dict = {v[cell_id]:v[clone_id] for k, v in heavy_df[[clone_id, cell_id]].T.to_dict().items()}
-    light_df = light_df.loc[light_df[cell_id].apply(lambda x: x in clone_dict.keys()), ]
-    light_df[clone_id] = light_df.apply(lambda row: clone_dict[row[cell_id]], axis = 1)
+    clone_map = heavy_df.drop_duplicates(cell_id, keep='last').set_index(cell_id)[clone_id]
+    light_df = light_df.loc[light_df[cell_id].isin(clone_map.index), :].copy()
+    light_df[clone_id] = light_df[cell_id].map(clone_map)
+    timer.stage('transfer')
 
     # generate a "cluster_dict" of CELL:CLONE dictionary from light df  (TODO: use receptor object V/J gene names)
-    cluster_dict = clusterLinkage(light_df[cell_id],
-                                  light_df.apply(lambda row: 
-                                                 parseAllele(row[v_call], regex = gene_regex) + ',' + \
-                                                 parseAllele(row[j_call], regex = gene_regex) + ',' + \
-                                                 str(row[junction_length]) + ',' + row[clone_id], axis=1))
+    group_key = groupKeys(light_df, v_call, j_call, junction_length, clone_id)
+    cluster_dict = clusterLinkage(light_df[cell_id], group_key)
+    timer.stage('cluster')
 
     # add assignments to heavy_df
-    heavy_df = heavy_df.loc[heavy_df[cell_id].apply(lambda x: x in cluster_dict.keys()), :]
-    heavy_df[clone_id] = heavy_df[clone_id] + '_' + heavy_df.apply(lambda row: str(cluster_dict[row[cell_id]]), axis=1)
+    cluster_map = pd.Series(cluster_dict, dtype='object').astype(str)
+    heavy_df = heavy_df.loc[heavy_df[cell_id].isin(cluster_map.index), :].copy()
+    heavy_df[clone_id] = heavy_df[clone_id].str.cat(heavy_df[cell_id].map(cluster_map), sep='_')
+    timer.stage('assign')
 
     # write heavy chains
     heavy_df.to_csv(out_file, sep='\t', index=False)
+    timer.stage('write')
+    timer.report()
+    if verbose:  reportCache()
+
+    return {'heavy_cells': heavy_cells, 'paired_cells': len(cluster_dict), 'clusters': len(set(cluster_dict.values()))}
+
+
+def lightClusterStream(heavy_file, light_file, out_file, doublets='drop', format='airr', chunksize=100000,
+                       benchmark=False, verbose=False):
+    """
+    Split heavy chain clones based on light chains with bounded memory
+
+    Reads the input files in chunks, retaining only the per cell heavy chain selection and light chain grouping keys
+    in memory. Heavy chain rows are written in input order.
+
+    Arguments:
+      heavy_file (str): heavy chain input file.
+      light_file (str): light chain input file.
+      out_file (str): heavy chain output file.
+      doublets (str): method for handling multiple heavy chains per cell. one of 'drop' or 'count'.
+      format (str): file format. one of 'changeo' or 'airr'.
+      chunksize (int): number of rows to read at a time.
+      benchmark (bool): if True print the run time of each stage to standard output.
+      verbose (bool): if True print allele parsing cache statistics to standard output.
+
+    Returns:
+      dict: counts of input heavy chain cells, cells paired with a light chain and clusters.
+    """
+    # Set column names
+    cell_id, clone_id, v_call, j_call, junction_length, umi_count = getFields(format)
+    read_args = {'dtype': 'object', 'na_values': ['', 'None', 'NA'], 'sep': '\t', 'chunksize': chunksize}
+
+    # Stage timer
+    timer = StageTimer(enabled=benchmark)
+
+    # select one heavy chain row per cell
+    # heavy_dict = {cell: [row, clone, umi]}, count_dict = {cell: rows}
+    heavy_dict = {}
+    count_dict = {}
+    heavy_fields = [cell_id, clone_id] + ([umi_count] if doublets == 'count' else [])
+    for chunk in pd.read_csv(heavy_file, usecols=heavy_fields, **read_args):
+        chunk = chunk.loc[chunk[cell_id].notna(), :].copy()
+        if doublets == 'drop':
+            for cell, n in chunk[cell_id].value_counts(sort=False).items():
+                count_dict[cell] = count_dict.get(cell, 0) + n
+            first = chunk.drop_duplicates(cell_id, keep='first')
+            for row, cell, clone in zip(first.index, first[cell_id], first[clone_id]):
+                heavy_dict.setdefault(cell, [row, clone, None])
+        elif doublets == 'count':
+            # stable sort keeps the first row among tied UMI counts
+            chunk[umi_count] = chunk[umi_count].astype('int')
+            best = chunk.sort_values(umi_count, ascending=False, kind='mergesort').drop_duplicates(cell_id)
+            for row, cell, clone, umi in zip(best.index, best[cell_id], best[clone_id], best[umi_count]):
+                if cell not in heavy_dict or umi > heavy_dict[cell][2]:
+                    heavy_dict[cell] = [row, clone, umi]
+    heavy_cells = len(heavy_dict)
+    if doublets == 'drop':
+        heavy_dict = {k: v for k, v in heavy_dict.items() if count_dict[k] == 1}
+        del count_dict
+    clone_map = pd.Series({k: v[1] for k, v in heavy_dict.items()}, dtype='object')
+    timer.stage('doublets')
+
+    # collect light chain grouping keys for cells with a heavy chain
+    cell_list, key_list = [], []
+    light_fields = [cell_id, v_call, j_call, junction_length]
+    for chunk in pd.read_csv(light_file, usecols=light_fields, **read_args):
+        chunk = chunk.loc[chunk[cell_id].isin(clone_map.index), :].copy()
+        chunk[clone_id] = chunk[cell_id].map(clone_map)
+        cell_list.extend(chunk[cell_id])
+        key_list.extend(groupKeys(chunk, v_call, j_call, junction_length, clone_id))
+    timer.stage('transfer')
+
+    # cluster light chains
+    cluster_dict = clusterLinkage(cell_list, key_list)
+    del cell_list, key_list
+    timer.stage('cluster')
+
+    # row_map = {row: cluster}
+    row_map = pd.Series({v[0]: str(cluster_dict[k]) for k, v in heavy_dict.items() if k in cluster_dict},
+                        dtype='object')
+    stats = {'heavy_cells': heavy_cells, 'paired_cells': len(cluster_dict), 'clusters': len(set(cluster_dict.values()))}
+    del heavy_dict, clone_map, cluster_dict
+
+    # add assignments to heavy chains and write
+    header = True
+    for chunk in pd.read_csv(heavy_file, **read_args):
+        chunk = chunk.loc[chunk.index.isin(row_map.index), :].copy()
+        chunk[clone_id] = chunk[clone_id].str.cat(chunk.index.map(row_map), sep='_')
+        chunk.to_csv(out_file, sep='\t', index=False, header=header, mode='w' if header else 'a')
+        header = False
+    timer.stage('write')
+    timer.report()
+    if verbose:  reportCache()
+
+    return stats
+
+
+def readManifest(manifest_file):
+    """
+    Reads a batch manifest
+
+    Arguments:
+      manifest_file (str): tab delimited file with one heavy chain file, light chain file and output file per line.
+                           Blank lines and lines starting with # are ignored.
+
+    Returns:
+      list: list of (heavy_file, light_file, out_file) tuples.
+    """
+    samples = []
+    with open(manifest_file, 'r') as handle:
+        for i, line in enumerate(handle, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):  continue
+            fields = line.split('\t')
+            if len(fields) != 3:
+                sys.exit('Line %i of manifest %s does not contain 3 tab delimited fields.' % (i, manifest_file))
+            samples.append(tuple(fields))
+
+    return samples
+
+
+def runSample(sample):
+    """
+    Runs clustering for a single batch sample
+
+    Arguments:
+      sample (tuple): (heavy_file, light_file, out_file, stream, keyword arguments to the clustering function).
+
+    Returns:
+      dict: sample output file, run time, status, the counts returned by the clustering function
+            and the standard output of the clustering function.
+    """
+    heavy_file, light_file, out_file, stream, kwargs = sample
+    result = {'sample': out_file, 'heavy_cells': None, 'paired_cells': None, 'clusters': None}
+    start = time.perf_counter()
+    log = StringIO()
+    try:
+        with redirect_stdout(log):
+            if stream:
+                stats = lightClusterStream(heavy_file, light_file, out_file, **kwargs)
+            else:
+                kwargs = {k: v for k, v in kwargs.items() if k != 'chunksize'}
+                stats = lightCluster(heavy_file, light_file, out_file, **kwargs)
+        result.update(stats)
+        result['status'] = 'PASS'
+    except Exception as e:
+        result['status'] = 'FAIL: %s' % e
+    result['seconds'] = time.perf_counter() - start
+    result['log'] = log.getvalue()
+
+    return result
+
+
+def batchCluster(manifest_file, nproc=1, stream=False, **kwargs):
+    """
+    Runs light chain clustering for multiple samples in a process pool
+
+    Each worker process runs samples sequentially, so interpreter and module import costs are paid once per worker.
+    The benchmark and verbose output of each sample is collected and printed in manifest order, with each line
+    prefixed by the sample output file.
+
+    Arguments:
+      manifest_file (str): batch manifest file. See readManifest.
+      nproc (int): number of worker processes.
+      stream (bool): if True use lightClusterStream, otherwise use lightCluster.
+      **kwargs: additional arguments to the clustering function.
+
+    Returns:
+      list: list of per sample result dictionaries in manifest order.
+    """
+    samples = [(h, l, o, stream, kwargs) for h, l, o in readManifest(manifest_file)]
+    for heavy_file, light_file, __, __, __ in samples:
+        for f in [heavy_file, light_file]:
+            if not os.path.isfile(f):  sys.exit('File %s does not exist.' % f)
+
+    # Run samples
+    start = time.perf_counter()
+    if nproc > 1 and len(samples) > 1:
+        with mp.Pool(min(nproc, len(samples))) as pool:
+            results = pool.map(runSample, samples, chunksize=1)
+    else:
+        results = [runSample(x) for x in samples]
+    total = time.perf_counter() - start
+
+    # Report
+    for r in results:
+        sys.stdout.write(''.join('%s: %s\n' % (r['sample'], x) for x in r['log'].splitlines()))
+    sys.stdout.write('%s\t%s\t%s\t%s\t%s\t%s\n' % ('SAMPLE', 'HEAVY_CELLS', 'PAIRED_CELLS', 'CLUSTERS',
+                                                 'SECONDS', 'STATUS'))
+    for r in results:
+        sys.stdout.write('%s\t%s\t%s\t%s\t%.3f\t%s\n' % (r['sample'], r['heavy_cells'], r['paired_cells'],
+                                                     r['clusters'], r['seconds'], r['status']))
+    sys.stdout.write('TOTAL\t%s\t%s\t%s\t%.3f\t%i/%i PASS\n' % \
+                     (sum(r['heavy_cells'] or 0 for r in results), sum(r['paired_cells'] or 0 for r in results),
+                      sum(r['clusters'] or 0 for r in results), total,
+                      sum(r['status'] == 'PASS' for r in results), len(results)))
+
+    return results
 
 
 if __name__ == "__main__":
@@ -129,22 +455,55 @@ if __name__ == "__main__":
     """
     # Define arguments
     parser = ArgumentParser()
-    parser.add_argument('-d', dest='heavy_file', required=True,
+    parser.add_argument('-d', dest='heavy_file', default=None,
                         help='Cloned heavy chain Change-O or AIRR TSV file.')
-    parser.add_argument('-e', dest='light_file', required=True,
+    parser.add_argument('-e', dest='light_file', default=None,
                         help='Corresponding Light chain Change-O or AIRR TSV file.')
-    parser.add_argument('-o', dest='out_file', required=True,
+    parser.add_argument('-o', dest='out_file', default=None,
                         help='Output file name.')
+    parser.add_argument('--manifest', dest='manifest_file', default=None,
+                        help='Tab delimited file of heavy chain file, light chain file and output file triples, '
+                             'one sample per line. Replaces -d, -e and -o.')
+    parser.add_argument('--nproc', dest='nproc', type=int, default=1,
+                        help='Number of samples to process in parallel with --manifest.')
     parser.add_argument('--doublets', dest='doublets', default='drop', choices=('drop', 'count'),
                         help='Either drop cells with multiple heavy chains or keep the best one my UMI count.')
     parser.add_argument('--format', dest='format', default='changeo', choices=('changeo', 'airr'),
                         help='File format.')
+    parser.add_argument('--stream', dest='stream', action='store_true',
+                        help='Read and write the input files in chunks to bound memory usage. '
+                             'Heavy chain rows are written in input order.')
+    parser.add_argument('--chunksize', dest='chunksize', type=int, default=100000,
+                        help='Number of rows to read at a time in streaming mode.')
+    parser.add_argument('--benchmark', dest='benchmark', action='store_true',
+                        help='Report the run time of each processing stage.')
+    parser.add_argument('--verbose', dest='verbose', action='store_true',
+                        help='Report allele parsing cache statistics.')
 
     # Parse arguments and call main
     args = parser.parse_args()
+    args_dict = args.__dict__.copy()
+    manifest_file = args_dict.pop('manifest_file')
+    nproc = args_dict.pop('nproc')
+    stream = args_dict.pop('stream')
+
+    # Batch mode
+    if manifest_file is not None:
+        if any(args_dict.pop(x) is not None for x in ['heavy_file', 'light_file', 'out_file']):
+            parser.error('-d, -e and -o cannot be used with --manifest.')
+        results = batchCluster(manifest_file, nproc=nproc, stream=stream, **args_dict)
+        if any(r['status'] != 'PASS' for r in results):  sys.exit(1)
+        sys.exit()
 
     # Check that files exist
+    if any(args_dict[x] is None for x in ['heavy_file', 'light_file', 'out_file']):
+        parser.error('-d, -e and -o are required unless --manifest is specified.')
     for f in [args.heavy_file, args.light_file]:
         if not os.path.isfile(f):  sys.exit('File %s does not exist.' % f)
 
-    lightCluster(**args.__dict__)
+    # Call main
+    if stream:
+        lightClusterStream(**args_dict)
+    else:
+        del args_dict['chunksize']
+        lightCluster(**args_dict)
@@ -4,18 +4,128 @@ Join the 10X annotation table and Change-O table
 """
 
 # Imports
-import pandas as pd
+import csv
+import gzip
 import sys
+from argparse import ArgumentParser
 
-# Parse arguments
-changeo_file = sys.argv[1]
-annotation_file = sys.argv[2]
-out_file = sys.argv[3]
+# Local imports
+from fastq_io import isGzip
 
-# Merge annotations
-annfile = pd.read_csv(annotation_file).set_index('contig_id')
-annfile.columns = [column.upper() + '_10X' for column in annfile.columns]
+# Sequence identifier and 10X column suffix for each input format
+format_columns = {'changeo': ('SEQUENCE_ID', '_10X'),
+                  'airr': ('sequence_id', '_10x')}
 
-pd.read_csv(changeo_file, dtype = 'object', sep = '\t').set_index('SEQUENCE_ID')\
-.join(annfile, lsuffix='', rsuffix='_10X')\
-.to_csv(out_file, sep = '\t')
\ No newline at end of file
+
+def openTable(path, mode='r'):
+    """
+    Opens a plain or gzip compressed table in text mode
+
+    Arguments:
+      path (str): file path.
+      mode (str): one of 'r' or 'w'.
+
+    Returns:
+      file: text file handle.
+    """
+    if isGzip(path, mode + 'b'):
+        return gzip.open(path, mode + 't', newline='')
+    else:
+        return open(path, mode, newline='')
+
+
+def readAnnotations(annotation_file):
+    """
+    Indexes the 10X annotation table by contig identifier
+
+    Arguments:
+      annotation_file (str): 10X annotation CSV file, such as filtered_contig_annotations.csv.
+
+    Returns:
+      tuple: (list of annotation column names without contig_id,
+              dictionary of contig_id to a list of rows of annotation values).
+    """
+    with openTable(annotation_file) as handle:
+        reader = csv.reader(handle)
+        header = next(reader)
+        if 'contig_id' not in header:
+            sys.exit('Column contig_id not found in %s.' % annotation_file)
+        i = header.index('contig_id')
+        index = {}
+        for row in reader:
+            index.setdefault(row[i], []).append(row[:i] + row[i + 1:])
+
+    return header[:i] + header[i + 1:], index
+
+
+def mergeTables(db_file, annotation_file, out_file, db_format=None):
+    """
+    Joins 10X annotations to a Change-O or AIRR table, streaming the table row by row
+
+    The sequence identifier column is written first, followed by the remaining table columns and the
+    annotation columns suffixed with _10X (Change-O) or _10x (AIRR). Rows without annotations have empty
+    annotation fields and rows matching several annotations are repeated for each.
+
+    Arguments:
+      db_file (str): Change-O or AIRR tab-delimited file.
+      annotation_file (str): 10X annotation CSV file.
+      out_file (str): output tab-delimited file. Compressed with gzip if the name ends with .gz.
+      db_format (str): one of 'changeo' or 'airr'. If None, the format is detected from the header.
+
+    Returns:
+      tuple: (number of rows read, number of rows with annotations).
+    """
+    ann_fields, index = readAnnotations(annotation_file)
+    empty = [[''] * len(ann_fields)]
+
+    count, matched = 0, 0
+    with openTable(db_file) as in_handle, openTable(out_file, 'w') as out_handle:
+        reader = csv.reader(in_handle, dialect='excel-tab')
+        writer = csv.writer(out_handle, dialect='excel-tab', lineterminator='\n')
+        header = next(reader)
+
+        # Determine format
+        if db_format is None:
+            db_format = 'airr' if 'sequence_id' in header and 'SEQUENCE_ID' not in header else 'changeo'
+        id_field, suffix = format_columns[db_format]
+        if id_field not in header:
+            sys.exit('Column %s not found in %s.' % (id_field, db_file))
+        i = header.index(id_field)
+
+        # Write header with annotation columns renamed
+        ann_header = [x.upper() + suffix if db_format == 'changeo' else x.lower() + suffix for x in ann_fields]
+        ann_header = [x + suffix if x in header else x for x in ann_header]
+        writer.writerow([id_field] + header[:i] + header[i + 1:] + ann_header)
+
+        # Join rows
+        for row in reader:
+            count += 1
+            ann_rows = index.get(row[i])
+            if ann_rows is not None:
+                matched += 1
+            prefix = [row[i]] + row[:i] + row[i + 1:]
+            writer.writerows(prefix + x for x in (ann_rows or empty))
+
+    return count, matched
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and calls main
+    """
+    # Define arguments
+    parser = ArgumentParser()
+    parser.add_argument('db_file',
+                        help='Change-O or AIRR tab-delimited file. Gzip compressed files are detected automatically.')
+    parser.add_argument('annotation_file',
+                        help='10X annotation CSV file, such as filtered_contig_annotations.csv. '
+                             'Gzip compressed files are detected automatically.')
+    parser.add_argument('out_file',
+                        help='Output tab-delimited file. Compressed with gzip if the name ends with .gz.')
+    parser.add_argument('--format', dest='format', choices=sorted(format_columns), default=None,
+                        help='Format of the input table, which determines the sequence identifier column and the '
+                             'naming of the 10X columns. Detected from the header if not specified.')
+    args = parser.parse_args()
+
+    # Merge annotations
+    mergeTables(args.db_file, args.annotation_file, args.out_file, db_format=args.format)
@@ -2,15 +2,89 @@
 """
 Concatentate multiple fastq files
 """
-from sys import argv
-from Bio import SeqIO
+# Imports
+import io
+import sys
+from argparse import ArgumentParser
 
-out_file = argv[1]
-in_files = argv[2:]
+# Local imports
+from fastq_io import FastqFormatError, openFile, readFastqBlocks
 
-with open(out_file, 'w') as out_handle:
+
+def copyFastq(in_files, out_handle, nproc=1):
+    """
+    Concatenates FASTQ files by copying blocks of validated records
+
+    Separator lines are written as a bare +, as in the Biopython output.
+
+    Arguments:
+      in_files (list): input FASTQ file names. May be gzip compressed.
+      out_handle (file): binary output handle.
+      nproc (int): number of decompression threads.
+
+    Returns:
+      int: number of records written.
+    """
+    count = 0
+    for f in in_files:
+        with openFile(f, 'rb', nproc=nproc) as in_handle:
+            for block in readFastqBlocks(in_handle, name=f):
+                n = len(block) // 4
+                block[2::4] = [b'+\n'] * n
+                out_handle.writelines(block)
+                count += n
+
+    return count
+
+
+def parseFastq(in_files, out_handle, nproc=1):
+    """
+    Concatenates FASTQ files by parsing and rewriting each record with Biopython
+
+    Arguments:
+      in_files (list): input FASTQ file names. May be gzip compressed.
+      out_handle (file): binary output handle.
+      nproc (int): number of decompression threads.
+
+    Returns:
+      int: number of records written.
+    """
+    from Bio import SeqIO
+
+    count = 0
+    text_handle = io.TextIOWrapper(out_handle, write_through=True)
     for f in in_files:
-        records = SeqIO.parse(f, 'fastq')
-        SeqIO.write(records, out_handle, 'fastq')
+        with openFile(f, 'rb', nproc=nproc) as in_handle:
+            records = SeqIO.parse(io.TextIOWrapper(in_handle), 'fastq')
+            count += SeqIO.write(records, text_handle, 'fastq')
+    text_handle.detach()
+
+    return count
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and calls main
+    """
+    # Define arguments
+    parser = ArgumentParser()
+    parser.add_argument('out_file',
+                        help='Output FASTQ file. Written with gzip compression if the name ends in .gz.')
+    parser.add_argument('in_files', nargs='+',
+                        help='Input FASTQ files. Gzip compressed files are detected automatically.')
+    parser.add_argument('--parse', dest='parse', action='store_true',
+                        help='Parse and rewrite each record with Biopython instead of copying blocks of records. '
+                             'Required for multi-line FASTQ records.')
+    parser.add_argument('--nproc', dest='nproc', type=int, default=1,
+                        help='Number of pigz threads for gzip compression and decompression, if pigz is available.')
+    args = parser.parse_args()
 
-#print(out_file)
\ No newline at end of file
+    # Merge files
+    with openFile(args.out_file, 'wb', nproc=args.nproc) as out_handle:
+        try:
+            if args.parse:
+                parseFastq(args.in_files, out_handle, nproc=args.nproc)
+            else:
+                copyFastq(args.in_files, out_handle, nproc=args.nproc)
+        except FastqFormatError as e:
+            sys.exit('%s Use --parse for multi-line FASTQ files.' % e)
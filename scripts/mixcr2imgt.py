@@ -5,21 +5,17 @@ Add IMGT gaps to the V-region of MiXCR exported clones
 
 # Imports
 import csv
+import re
 import sys
 import pandas as pd
+from argparse import ArgumentParser
 from changeo.IO import readGermlines
-from changeo.Gene import allele_regex, gene_regex, parseAllele, gapV
+from changeo.Gene import gene_regex
 
-# Parse arguments
-clone_file = sys.argv[1]
-repo_file = sys.argv[2]
-out_file = sys.argv[3]
-
-# Load data
-repo_dict = readGermlines(repo_file)
-data = pd.read_table(clone_file, low_memory=False)
+# Local imports
+from allele_cache import parseAlleleColumn, reportCache
 
-# Extract MiXCR alignment reference points
+# MiXCR alignment reference points
 # From https://mixcr.readthedocs.io/en/latest/export.html
 anchor_regex = '^(?P<V5UTRBegin>-?[0-9]*):' \
                '(?P<L1Begin>-?[0-9]*):' \
@@ -43,37 +39,135 @@ anchor_regex = '^(?P<V5UTRBegin>-?[0-9]*):' \
                '(?P<FR4End>-?[0-9]*):' \
                '(?P<CBegin>-?[0-9]*):' \
                '(?P<CExon1End>-?[0-9]*)$'
-data = pd.concat([data, data.refPoints.str.extract(anchor_regex, expand=True).apply(pd.to_numeric)], axis=1)
 
-# Extract MiXCR V alignment positions
+# MiXCR V alignment positions
 valign_regex = '^(?P<targetFrom>[0-9]*)\|' \
                '(?P<targetTo>[0-9]*)\|' \
                '(?P<targetLength>[0-9]*)\|' \
                '(?P<queryFrom>[0-9]*)\|' \
                '(?P<queryTo>[0-9]*)\|'
-data = pd.concat([data, data.allVAlignments.str.extract(valign_regex, expand=True).apply(pd.to_numeric)], axis=1)
-
-# Open output file
-out_handle = open(out_file, 'w')
-writer = csv.DictWriter(out_handle,
-                        fieldnames=['SEQUENCE_IMGT', 'V_GERM_START_IMGT', 'V_GERM_LENGTH_IMGT', 'GERMLINE_IMGT_V_REGION'],
-                        delimiter='\t')
-writer.writeheader()
-
-for i, row in data.iterrows():
-    # Build dictionary of required fields
-    v_call = '%s*01' % parseAllele(row['allVHitsWithScore'], gene_regex)
-    db = {'SEQUENCE_ID': row['cloneId'],
-          'SEQUENCE_VDJ': row['clonalSequence'],
-          'V_GERM_START_VDJ': row['targetFrom'] + 1,
-          'V_GERM_LENGTH_VDJ': row['targetTo'] - row['targetFrom'],
-          'V_CALL': v_call}
-
-    # Create and write IMGT gapped sequence
-    seq = gapV(db, repo_dict)
-    if seq['V_GERM_LENGTH_IMGT']:
-        seq['GERMLINE_IMGT_V_REGION'] = repo_dict[v_call][:seq['V_GERM_LENGTH_IMGT']]
-    writer.writerow(seq)
-
-# Close open handles
-out_handle.close()
\ No newline at end of file
+
+# Input fields
+in_fields = ['clonalSequence', 'allVHitsWithScore', 'refPoints', 'allVAlignments']
+
+# Output fields
+out_fields = ['SEQUENCE_IMGT', 'V_GERM_START_IMGT', 'V_GERM_LENGTH_IMGT', 'GERMLINE_IMGT_V_REGION']
+
+
+def readClones(clone_file, chunksize=None):
+    """
+    Reads the fields required for gapping from a MiXCR exported clones file
+
+    Arguments:
+      clone_file (str): MiXCR exported clones file.
+      chunksize (int): number of rows per block. If None, read the whole file as a single block.
+
+    Returns:
+      iter: iterator of pandas.DataFrame blocks.
+    """
+    if chunksize is None:
+        return iter([pd.read_table(clone_file, usecols=in_fields, low_memory=False)])
+    else:
+        return pd.read_table(clone_file, usecols=in_fields, chunksize=chunksize)
+
+
+def parseClones(data):
+    """
+    Extracts MiXCR alignment reference points and V alignment positions
+
+    Arguments:
+      data (pandas.DataFrame): MiXCR clones.
+
+    Returns:
+      pandas.DataFrame: data with extracted reference point and V alignment position columns.
+    """
+    anchors = data.refPoints.str.extract(anchor_regex, expand=True).apply(pd.to_numeric)
+    valign = data.allVAlignments.str.extract(valign_regex, expand=True).apply(pd.to_numeric)
+
+    return pd.concat([data, anchors, valign], axis=1)
+
+
+def gapClones(data, repo_dict, missing=None):
+    """
+    Builds IMGT gapped V-region sequences for a batch of clones
+
+    Rows are processed in groups sharing a V allele, so each gapped germline is looked up and scanned for gaps once
+    per allele. Gaps are inserted following changeo.Gene.gapV.
+
+    Arguments:
+      data (pandas.DataFrame): MiXCR clones with extracted V alignment positions.
+      repo_dict (dict): dictionary of IMGT gapped germline sequences.
+      missing (set): alleles already reported as missing from repo_dict. Updated in place.
+
+    Returns:
+      list: output rows in the order of out_fields, in the same order as data.
+    """
+    # Assign first V gene call to each row
+    v_hits = data['allVHitsWithScore']
+    v_calls = parseAlleleColumn(v_hits, gene_regex).astype(str) + '*01'
+
+    # Required fields
+    seqs = data['clonalSequence'].tolist()
+    v_starts = (data['targetFrom'] + 1).tolist()
+    v_lengths = (data['targetTo'] - data['targetFrom']).tolist()
+
+    rows = [None] * len(data)
+    for v_call, index in pd.Series(range(len(data))).groupby(v_calls.values, sort=False):
+        # Gapped germline and gap positions for the allele
+        vgap = repo_dict.get(v_call, None)
+        if vgap is None:
+            if missing is None or v_call not in missing:
+                sys.stderr.write('WARNING: %s was not found in the germline repository. '
+                                 'IMGT-gapped sequence cannot be determined.\n' % v_call)
+            if missing is not None:  missing.add(v_call)
+            for i in index:
+                rows[i] = [None, None, None, None]
+            continue
+        gaps = [m.start() for m in re.finditer(r'\.', vgap)]
+
+        # Insert germline gaps into each sequence
+        for i in index:
+            v_germ_start, v_germ_length = int(v_starts[i]), int(v_lengths[i])
+            seq_imgt = '.' * (v_germ_start - 1) + seqs[i]
+            gapcount = v_germ_start - 1
+            for g in gaps:
+                # Break if gap begins after V region
+                if g >= v_germ_length + gapcount:
+                    break
+                seq_imgt = seq_imgt[:g] + '.' + seq_imgt[g:]
+                gapcount += 1
+            v_length_imgt = v_germ_length + gapcount
+            germ_imgt = vgap[:v_length_imgt] if v_length_imgt else None
+            rows[i] = [seq_imgt, 1, v_length_imgt, germ_imgt]
+
+    return rows
+
+
+# Parse arguments
+parser = ArgumentParser()
+parser.add_argument('clone_file', help='MiXCR exported clones file.')
+parser.add_argument('repo_file', help='IMGT gapped reference germline file.')
+parser.add_argument('out_file', help='Output file name.')
+parser.add_argument('--chunksize', dest='chunksize', type=int, default=None,
+                    help='Number of clones to read, gap and write at a time. '
+                         'By default, the whole file is read at once.')
+parser.add_argument('--verbose', dest='verbose', action='store_true',
+                    help='Report allele parsing cache statistics.')
+args = parser.parse_args()
+clone_file = args.clone_file
+repo_file = args.repo_file
+out_file = args.out_file
+
+# Load germlines once for all blocks
+repo_dict = readGermlines(repo_file)
+
+# Write IMGT gapped sequences
+missing = set()
+with open(out_file, 'w') as out_handle:
+    writer = csv.writer(out_handle, delimiter='\t')
+    writer.writerow(out_fields)
+    for data in readClones(clone_file, chunksize=args.chunksize):
+        writer.writerows(gapClones(parseClones(data), repo_dict, missing=missing))
+
+# Report cache statistics
+if args.verbose:  reportCache()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+K-mer index of the PhiX174 genome used to screen reads before blastn
+"""
+
+# Imports
+import sys
+from argparse import ArgumentParser
+
+# Local imports
+from fastq_io import readFasta
+
+# Default k-mer size. Smaller than the blastn megablast word size of 28, so every read with a
+# megablast seed on either strand of the genome shares at least one k-mer with the index.
+default_kmer_size = 25
+
+# Index file header
+index_header = '# phix_kmers k='
+
+# Reverse complement translation table
+complement = str.maketrans('ACGT', 'TGCA')
+
+# Translation table replacing ambiguous characters with k-mer breaks
+ambiguous = str.maketrans('NRYSWKMBDHV.-', ' ' * 13)
+
+
+def readKmers(seq, k):
+    """
+    Iterates over the k-mers of a sequence that contain only A, C, G and T
+
+    Arguments:
+      seq (str): uppercase nucleotide sequence.
+      k (int): k-mer size.
+
+    Returns:
+      iter: iterator of k-mer strings.
+    """
+    for part in seq.translate(ambiguous).split():
+        for i in range(len(part) - k + 1):
+            yield part[i:i + k]
+
+
+def buildIndex(ref_file, out_file, k=default_kmer_size):
+    """
+    Writes the k-mers of both strands of the reference sequences
+
+    Arguments:
+      ref_file (str): reference FASTA file.
+      out_file (str): output index file.
+      k (int): k-mer size.
+
+    Returns:
+      int: number of distinct k-mers.
+    """
+    kmers = set()
+    with open(ref_file, 'r') as handle:
+        for __, seq in readFasta(handle):
+            seq = seq.upper()
+            kmers.update(readKmers(seq, k))
+            kmers.update(readKmers(seq.translate(complement)[::-1], k))
+
+    with open(out_file, 'w') as handle:
+        handle.write('%s%i\n' % (index_header, k))
+        handle.write(''.join('%s\n' % x for x in sorted(kmers)))
+
+    return len(kmers)
+
+
+def loadIndex(index_file):
+    """
+    Reads an index written by buildIndex
+
+    Arguments:
+      index_file (str): index file.
+
+    Returns:
+      tuple: (k-mer size, set of k-mers).
+    """
+    with open(index_file, 'r') as handle:
+        header = handle.readline()
+        if not header.startswith(index_header):
+            sys.exit('%s is not a PhiX k-mer index.' % index_file)
+        k = int(header[len(index_header):])
+        kmers = set(line.rstrip() for line in handle)
+
+    return k, kmers
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and calls main
+    """
+    # Define arguments
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    parser_index = subparsers.add_parser('index', help='Build the k-mer index of a reference genome.')
+    parser_index.add_argument('-r', dest='ref_file', required=True, help='Reference FASTA file.')
+    parser_index.add_argument('-o', dest='out_file', required=True, help='Output index file.')
+    parser_index.add_argument('-k', dest='kmer_size', type=int, default=default_kmer_size,
+                              help='K-mer size.')
+    args = parser.parse_args()
+
+    # Build index
+    print(buildIndex(args.ref_file, args.out_file, k=args.kmer_size))
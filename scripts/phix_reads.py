@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Single pass read cleaning and PhiX read removal for preprocess-phix.sh
+"""
+
+# Imports
+import sys
+from argparse import ArgumentParser
+
+# Local imports
+from fastq_io import FastqFormatError, openFile, readFastqBlocks
+from phix_kmers import loadIndex, readKmers
+
+
+def cleanReads(in_file, out_file, index_file=None):
+    """
+    Writes the FASTA blastn queries for a FASTQ file
+
+    All-N reads, which blastn cannot align, are dropped. Headers are reduced to the read identifier,
+    which is the only part of the header used by blastn and filterReads. If an index is given,
+    only reads sharing a k-mer with it are written.
+
+    Arguments:
+      in_file (str): FASTQ read file.
+      out_file (str): output FASTA file.
+      index_file (str): k-mer index written by phix_kmers.py. May be None.
+
+    Returns:
+      tuple: (number of reads, number of all-N reads, number of reads written).
+    """
+    k, kmers = loadIndex(index_file) if index_file is not None else (None, None)
+    count, missing, written = 0, 0, 0
+    with openFile(in_file, 'rb') as in_handle, openFile(out_file, 'wb') as out_handle:
+        for block in readFastqBlocks(in_handle, name=in_file):
+            records = []
+            for header, seq in zip(block[0::4], block[1::4]):
+                seq = seq.rstrip()
+                if not seq.strip(b'N'):
+                    missing += 1
+                elif kmers is None or any(x in kmers for x in readKmers(seq.decode().upper(), k)):
+                    records.append(b'>%s\n%s\n' % (header[1:].split()[0], seq))
+            out_handle.write(b''.join(records))
+            count += len(block) // 4
+            written += len(records)
+
+    return count, missing, written
+
+
+def filterReads(in_file, hit_file, out_file):
+    """
+    Writes the reads without a blastn hit
+
+    Arguments:
+      in_file (str): FASTQ read file.
+      hit_file (str): blastn tabular output with the read identifier in the first column.
+      out_file (str): output FASTQ file.
+
+    Returns:
+      tuple: (number of reads, number of reads written).
+    """
+    with open(hit_file, 'rb') as handle:
+        hits = set(line.split(b'\t', 1)[0] for line in handle if line.strip())
+
+    count, written = 0, 0
+    with openFile(in_file, 'rb') as in_handle, openFile(out_file, 'wb') as out_handle:
+        for block in readFastqBlocks(in_handle, name=in_file):
+            records = [block[i:i + 4] for i in range(0, len(block), 4)
+                       if block[i][1:].split()[0] not in hits]
+            out_handle.write(b''.join(b''.join(x) for x in records))
+            count += len(block) // 4
+            written += len(records)
+
+    return count, written
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and calls main
+    """
+    # Define arguments
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    parser_clean = subparsers.add_parser('clean',
+                                         help='Drop all-N reads and write the remaining reads as FASTA.')
+    parser_clean.add_argument('-s', dest='in_file', required=True,
+                              help='FASTQ read file. Gzip compressed files are detected automatically.')
+    parser_clean.add_argument('-i', dest='index_file', default=None,
+                              help='K-mer index written by phix_kmers.py. If specified, only reads sharing '
+                                   'a k-mer with the index are written.')
+    parser_clean.add_argument('-o', dest='out_file', required=True, help='Output FASTA file.')
+    parser_filter = subparsers.add_parser('filter', help='Write the reads without a blastn hit.')
+    parser_filter.add_argument('-s', dest='in_file', required=True,
+                               help='FASTQ read file. Gzip compressed files are detected automatically.')
+    parser_filter.add_argument('-b', dest='hit_file', required=True,
+                               help='blastn tabular output with the read identifier in the first column.')
+    parser_filter.add_argument('-o', dest='out_file', required=True,
+                               help='Output FASTQ file. Compressed with gzip if the name ends with .gz.')
+    args = parser.parse_args()
+
+    # Clean or filter reads
+    try:
+        if args.command == 'clean':
+            result = cleanReads(args.in_file, args.out_file, index_file=args.index_file)
+        else:
+            result = filterReads(args.in_file, args.hit_file, args.out_file)
+    except FastqFormatError as e:
+        sys.exit(e)
+    print(' '.join('%i' % x for x in result))
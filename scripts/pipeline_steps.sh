@@ -0,0 +1,588 @@
+# Resumable step runner shared by the pipeline scripts
+#
+# Source this file from a pipeline with `source pipeline_steps.sh`. Bash searches PATH for the file.
+#
+# Each completed step writes a marker recording its name, the path, size and modification time
+# of its inputs, its parameters and the same fingerprint of its outputs. On a rerun, a step is
+# skipped if its marker matches the current inputs and parameters and its outputs are unchanged.
+# Steps without declared outputs always run. With --from-step, steps before the named step are
+# skipped and all later steps are run.
+#
+# Independent commands within a step, such as the read 1 and read 2 calls of a tool, can run
+# as concurrent tasks that share the processor budget. The start and end of each step and task
+# are written to timeline.tsv next to the marker directory.
+#
+# Each step that runs is profiled. The wall time, CPU time of child processes, peak resident
+# memory of the process tree (sampled each second), bytes read and written (Linux only) and the
+# number of records in its FASTQ, FASTA and TSV inputs and outputs are written to profile.tsv
+# and profile.json next to the marker directory, and summarized by finish_steps.
+#
+# Intermediate and log files are archived by archive_files with gzip, multithreaded pigz or
+# zstd, selected with --compress. With --compress-early, pipelines can compress intermediates
+# with compress_early as soon as the last step reading them has finished. Each file is then
+# compressed separately in the background and archive_files bundles the compressed files.
+# Released intermediates are recorded in released.tsv in the marker directory with their
+# fingerprint, which stands in for the missing file, so a rerun after a failure resumes at the
+# failed step. A step that runs again decompresses its released inputs first. If a released
+# input was removed rather than compressed, the run stops and names the step producing it,
+# which --from-step must start from.
+#
+# Usage:
+#   step_args "$@"; set -- "${STEP_ARGS[@]}"
+#   ...
+#   init_steps ${LOGDIR}/steps
+#   if begin_step "Step name" -i "input files" -p "parameters" -o "output files"; then
+#       commands
+#       check_error
+#       end_step
+#   fi
+#   if begin_step "Step name" ...; then
+#       begin_tasks 2 ${NPROC}
+#       run_task "R1" command --nproc ${TASK_NPROC} ...
+#       run_task "R2" command --nproc ${TASK_NPROC} ...
+#       wait_tasks
+#       check_error
+#       end_step
+#   fi
+#   ...
+#   finish_steps
+
+# Default step runner values
+STEP=0
+STEP_WIDTH=24
+STEP_VERSION=""
+FROM_STEP=""
+STEP_STARTED=true
+STEP_DIR=""
+STEP_TIMELINE=""
+STEP_PROFILE=""
+STEP_RELEASED=""
+STEP_SAMPLER=""
+declare -A STEP_RECORDS
+ARCHIVE_FORMAT="gzip"
+ARCHIVE_EARLY=false
+ARCHIVE_PIDS=()
+EARLY_FILES=()
+
+# Remove step runner arguments from the command line
+#
+# Arguments:
+#   $@ = Pipeline command line arguments.
+#
+# Sets FROM_STEP, ARCHIVE_FORMAT, ARCHIVE_EARLY and the array STEP_ARGS of remaining arguments.
+step_args() {
+    STEP_ARGS=()
+    while [ $# -gt 0 ]; do
+        case "$1" in
+        --from-step)
+            if [ $# -lt 2 ]; then
+                echo -e "Option --from-step requires an argument" >&2
+                exit 1
+            fi
+            FROM_STEP=$2
+            shift
+            ;;
+        --from-step=*)
+            FROM_STEP=${1#*=}
+            ;;
+        --compress)
+            if [ $# -lt 2 ]; then
+                echo -e "Option --compress requires an argument" >&2
+                exit 1
+            fi
+            ARCHIVE_FORMAT=$2
+            shift
+            ;;
+        --compress=*)
+            ARCHIVE_FORMAT=${1#*=}
+            ;;
+        --compress-early)
+            ARCHIVE_EARLY=true
+            ;;
+        *)
+            STEP_ARGS+=("$1")
+            ;;
+        esac
+        shift
+    done
+
+    # Check compression program
+    if [ "${ARCHIVE_FORMAT}" != "gzip" ] && [ "${ARCHIVE_FORMAT}" != "pigz" ] && \
+       [ "${ARCHIVE_FORMAT}" != "zstd" ]; then
+        echo -e "Option --compress must be one of gzip, pigz or zstd." >&2
+        exit 1
+    elif ! command -v ${ARCHIVE_FORMAT} > /dev/null; then
+        echo -e "Compression program '${ARCHIVE_FORMAT}' not found." >&2
+        exit 1
+    fi
+}
+
+# Print step runner usage
+print_step_usage() {
+    echo -e "  --from-step  Step number or name to restart from. Earlier steps are skipped and\n" \
+            "              all later steps are run. Without this option, steps whose inputs,\n" \
+            "              parameters and outputs are unchanged since the last run are skipped."
+    echo -e "  --compress   Compression program for archived intermediate and log files.\n" \
+            "              One of gzip (default), pigz or zstd. pigz and zstd use all processors."
+    echo -e "  --compress-early\n" \
+            "              Compress each intermediate file as soon as the steps reading it have\n" \
+            "              finished, instead of all files at the end."
+}
+
+# Initialize the step marker directory
+#
+# Arguments:
+#   $1 = Marker directory.
+init_steps() {
+    STEP_DIR=$1
+    STEP=0
+    mkdir -p ${STEP_DIR}
+    STEP_TIMELINE="$(dirname ${STEP_DIR})/timeline.tsv"
+    STEP_PROFILE="$(dirname ${STEP_DIR})/profile.tsv"
+    STEP_RELEASED="${STEP_DIR}/released.tsv"
+    echo -e "STEP\tNAME\tTASK\tNPROC\tSTART\tEND\tSECONDS\tSTATUS" > ${STEP_TIMELINE}
+    echo -e "STEP\tNAME\tWALL_SECONDS\tCPU_SECONDS\tPEAK_RSS_KB\tREAD_BYTES\tWRITE_BYTES\tINPUT_RECORDS\tOUTPUT_RECORDS" \
+        > ${STEP_PROFILE}
+    if [ -n "${FROM_STEP}" ]; then
+        STEP_STARTED=false
+    fi
+}
+
+# Print the path, size and modification time of files
+#
+# Arguments:
+#   $1 = Record type.
+#   $@ = Files.
+#
+# Released files are reported with the size and modification time recorded by step_release.
+step_fingerprint() {
+    local TAG=$1 F RELEASED
+    shift
+    for F in "$@"; do
+        if [ -e "$F" ]; then
+            echo -e "${TAG}\t${F}\t$(stat -c '%s %Y' "$F" 2> /dev/null || stat -f '%z %m' "$F")"
+        elif RELEASED=$(step_released "$F"); then
+            echo -e "${TAG}\t${F}\t$(echo "${RELEASED}" | cut -f 2)"
+        else
+            echo -e "${TAG}\t${F}\tmissing"
+        fi
+    done
+}
+
+# Record that an intermediate file is about to be compressed or removed
+#
+# Arguments:
+#   $1 = File.
+#   $2 = Compressed file replacing it. Omit if the file is removed.
+#
+# Steps producing or reading a released file stay up to date while it is missing.
+step_release() {
+    echo -e "$(step_fingerprint released "$1" | cut -f 2,3)\t$2" >> ${STEP_RELEASED}
+}
+
+# Print the latest release record of a missing file
+#
+# Arguments:
+#   $1 = File.
+#
+# Prints the file, its size and modification time and its compressed file, separated by tabs.
+# Returns non-zero if the file was not released.
+step_released() {
+    [ -n "${STEP_RELEASED}" ] && [ -f ${STEP_RELEASED} ] || return 1
+    awk -F '\t' -v f="$1" '$1 == f { r = $0 } END { if (r == "") exit 1; print r }' ${STEP_RELEASED}
+}
+
+# Restore the released inputs of the current step
+#
+# Compressed inputs are decompressed with their recorded modification time, so later steps still
+# see them as unchanged. Exits if an input was removed.
+step_restore() {
+    local F RELEASED MTIME ZIP PRODUCER
+    for F in ${STEP_INPUTS}; do
+        [ -e "$F" ] && continue
+        RELEASED=$(step_released "$F") || continue
+        ZIP=$(echo "${RELEASED}" | cut -f 3)
+        if [ -z "${ZIP}" ] || [ ! -f "${ZIP}" ]; then
+            PRODUCER=$(grep -l "^output"$'\t'"${F}"$'\t' ${STEP_DIR}/*.done 2> /dev/null | head -n 1)
+            PRODUCER=$(basename "${PRODUCER:-00}" | cut -d '-' -f 1 | sed 's/^0//')
+            echo -e "Input '${F}' of step ${STEP} was removed by an earlier run." \
+                    "Rerun with --from-step ${PRODUCER} to recreate it." >&2
+            exit 1
+        fi
+        case "${ZIP}" in
+        *.zst)  zstd -q -d -c "${ZIP}" > "$F" ;;
+        *)      gzip -d -c "${ZIP}" > "$F" ;;
+        esac
+        MTIME=$(echo "${RELEASED}" | cut -f 2 | cut -d ' ' -f 2)
+        touch -d @${MTIME} "$F" 2> /dev/null || touch -t $(date -r ${MTIME} +%Y%m%d%H%M.%S) "$F"
+        rm -f "${ZIP}"
+    done
+}
+
+# Print the number of records in FASTQ, FASTA and TSV files
+#
+# Arguments:
+#   $@ = Files. Other file types are ignored.
+#
+# Prints NA if no file could be counted. Counts are cached by path, size and modification time.
+step_records() {
+    local F KEY N TOTAL=0 COUNTED=false
+    for F in "$@"; do
+        [ -f "$F" ] || continue
+        KEY=$(step_fingerprint file "$F")
+        N=${STEP_RECORDS[$KEY]}
+        if [ -z "$N" ]; then
+            case "${F,,}" in
+            *.fastq|*.fq)       N=$(( $(wc -l < "$F") / 4 )) ;;
+            *.fasta|*.fa|*.fna) N=$(grep -c '^>' "$F") ;;
+            *.tsv|*.tab)        N=$(( $(wc -l < "$F") - 1 )) ;;
+            *)                  continue ;;
+            esac
+            STEP_RECORDS[$KEY]=$N
+        fi
+        TOTAL=$((TOTAL + N))
+        COUNTED=true
+    done
+    if ${COUNTED}; then echo ${TOTAL}; else echo "NA"; fi
+}
+
+# Print the CPU seconds used by terminated child processes of the pipeline
+#
+# Arguments:
+#   $1 = Output of the times builtin. It must run in the pipeline shell, not in a subshell.
+step_cputime() {
+    awk 'NR == 2 { t = 0
+                   for (i = 1; i <= 2; i++) { split($i, x, /[ms]/); t += x[1] * 60 + x[2] }
+                   printf "%.2f\n", t }' $1
+}
+
+# Print the bytes read and written by the pipeline and its terminated child processes
+#
+# Prints NA NA where /proc is not available.
+step_io() {
+    if [ -r /proc/$$/io ]; then
+        awk '$1 == "rchar:" { r = $2 } $1 == "wchar:" { w = $2 } END { print r, w }' /proc/$$/io
+    else
+        echo "NA NA"
+    fi
+}
+
+# Record the peak resident memory of the pipeline process tree in a file until the pipeline exits
+#
+# Arguments:
+#   $1 = Output file.
+step_sampler() {
+    local SELF=${BASHPID} RSS PEAK=0
+    while kill -0 $$ 2> /dev/null; do
+        RSS=$(ps -e -o pid= -o ppid= -o rss= 2> /dev/null | \
+              awk -v root=$$ -v self=${SELF} '
+                  { parent[$1] = $2; rss[$1] = $3 }
+                  END { for (p in rss) {
+                            q = p
+                            while (q != root && q != self && q in parent && q > 1) q = parent[q]
+                            if (q == root && p != root) total += rss[p]
+                        }
+                        print total + 0 }')
+        if [ "${RSS:-0}" -gt ${PEAK} ]; then
+            PEAK=${RSS}
+            echo ${PEAK} > $1
+        fi
+        sleep 1
+    done
+}
+
+# Start profiling the current step
+step_profile_start() {
+    STEP_INPUT_RECORDS=$(step_records ${STEP_INPUTS})
+    # Stop the sampler of a step that was not ended
+    [ -n "${STEP_SAMPLER}" ] && kill ${STEP_SAMPLER} 2> /dev/null
+    echo 0 > ${STEP_DIR}/.rss
+    step_sampler ${STEP_DIR}/.rss &
+    STEP_SAMPLER=$!
+    # Remove the sampler from the job table so wait and jobs ignore it
+    disown ${STEP_SAMPLER}
+    STEP_PROFILE_START=${EPOCHREALTIME:-$(date +%s)}
+    times > ${STEP_DIR}/.times
+    STEP_PROFILE_CPU=$(step_cputime ${STEP_DIR}/.times)
+    STEP_PROFILE_IO=$(step_io)
+}
+
+# Stop profiling the current step and append its record to the profile
+step_profile_end() {
+    local END=${EPOCHREALTIME:-$(date +%s)} CPU IO RSS
+    times > ${STEP_DIR}/.times
+    CPU=$(step_cputime ${STEP_DIR}/.times)
+    IO=$(step_io)
+    kill ${STEP_SAMPLER} 2> /dev/null
+    STEP_SAMPLER=""
+    RSS=$(cat ${STEP_DIR}/.rss)
+    rm -f ${STEP_DIR}/.rss ${STEP_DIR}/.times
+    awk -v step=${STEP} -v name="${STEP_NAME}" -v start=${STEP_PROFILE_START} -v end=${END} \
+        -v cpu_start=${STEP_PROFILE_CPU} -v cpu_end=${CPU} -v rss=${RSS} \
+        -v io_start="${STEP_PROFILE_IO}" -v io_end="${IO}" \
+        -v n_in=${STEP_INPUT_RECORDS} -v n_out=$(step_records ${STEP_OUTPUTS}) '
+        BEGIN { split(io_start, a, " "); split(io_end, b, " ")
+                io = (a[1] == "NA") ? "NA\tNA" : sprintf("%.0f\t%.0f", b[1] - a[1], b[2] - a[2])
+                printf "%d\t%s\t%.2f\t%.2f\t%.0f\t%s\t%s\t%s\n",
+                       step, name, end - start, cpu_end - cpu_start, rss, io, n_in, n_out }' \
+        >> ${STEP_PROFILE}
+}
+
+# Start a step
+#
+# Arguments:
+#   $1 = Step name.
+#   -i = Input files.
+#   -p = Parameters.
+#   -o = Output files. Steps without outputs always run.
+#
+# Returns 0 if the step should run and 1 if it should be skipped.
+begin_step() {
+    local NAME=$1 PARAMS="" OPT OPTIND OPTARG
+    shift
+    STEP_INPUTS=""
+    STEP_OUTPUTS=""
+    while getopts "i:p:o:" OPT; do
+        case "$OPT" in
+        i)  STEP_INPUTS=$OPTARG ;;
+        p)  PARAMS=$OPTARG ;;
+        o)  STEP_OUTPUTS=$OPTARG ;;
+        esac
+    done
+
+    # Define marker and signature
+    STEP=$((STEP + 1))
+    STEP_NAME=$NAME
+    STEP_MARKER="${STEP_DIR}/$(printf '%02d' ${STEP})-${NAME//[^A-Za-z0-9]/_}.done"
+    STEP_SIGNATURE=$(echo -e "step\t${NAME}"
+                     echo -e "version\t${STEP_VERSION}"
+                     echo -e "param\t${PARAMS}"
+                     step_fingerprint input ${STEP_INPUTS})
+
+    # Skip steps before --from-step
+    if ! ${STEP_STARTED}; then
+        if [ "${FROM_STEP}" == "${STEP}" ] || [ "${FROM_STEP}" == "${NAME}" ]; then
+            STEP_STARTED=true
+        else
+            printf "  %2d: %-*s %s\n" ${STEP} ${STEP_WIDTH} "${NAME}" "skipped"
+            return 1
+        fi
+    # Skip up to date steps
+    elif [ -z "${FROM_STEP}" ] && [ -n "${STEP_OUTPUTS}" ] && [ -f ${STEP_MARKER} ] && \
+         [ "$(grep -v '^output' ${STEP_MARKER})" == "${STEP_SIGNATURE}" ] && \
+         [ "$(grep '^output' ${STEP_MARKER})" == "$(step_fingerprint output ${STEP_OUTPUTS})" ]; then
+        printf "  %2d: %-*s %s\n" ${STEP} ${STEP_WIDTH} "${NAME}" "up to date"
+        return 1
+    fi
+
+    step_restore
+    rm -f ${STEP_MARKER}
+    STEP_START=$(date +%s)
+    printf "  %2d: %-*s $(date +'%H:%M %D')\n" ${STEP} ${STEP_WIDTH} "${NAME}"
+    step_profile_start
+    return 0
+}
+
+# Append a record to the timeline
+#
+# Arguments:
+#   $1 = Task name.
+#   $2 = Number of processors.
+#   $3 = Start time in seconds since the epoch.
+#   $4 = Exit status.
+step_timeline() {
+    local END=$(date +%s)
+    echo -e "${STEP}\t${STEP_NAME}\t$1\t$2\t$3\t${END}\t$((END - $3))\t$4" >> ${STEP_TIMELINE}
+}
+
+# Prepare to run concurrent tasks within a step
+#
+# Arguments:
+#   $1 = Number of tasks.
+#   $2 = Number of processors to divide between the tasks.
+#
+# Sets TASK_NPROC to the number of processors for each task. At most $2 tasks run at once.
+begin_tasks() {
+    TASK_SLOTS=$(( $1 < $2 ? $1 : $2 ))
+    TASK_NPROC=$(( $2 / TASK_SLOTS ))
+    TASK_FILES=()
+}
+
+# Run a command as a background task of the current step
+#
+# Arguments:
+#   $1 = Task name.
+#   $@ = Command. Standard output and error are collected by wait_tasks.
+run_task() {
+    local NAME=$1
+    local TASK_FILE="${STEP_DIR}/$(printf '%02d' ${STEP})-${NAME//[^A-Za-z0-9]/_}"
+    shift
+    while [ $(jobs -rp | wc -l) -ge ${TASK_SLOTS} ]; do
+        sleep 0.1
+    done
+    TASK_FILES+=(${TASK_FILE})
+    (
+        START=$(date +%s)
+        "$@" > ${TASK_FILE}.out 2> ${TASK_FILE}.err
+        STATUS=$?
+        step_timeline "${NAME}" ${TASK_NPROC} ${START} ${STATUS}
+        exit ${STATUS}
+    ) &
+}
+
+# Wait for the tasks of the current step
+#
+# Appends task output to PIPELINE_LOG in task order and replaces ERROR_LOG with the task errors.
+# Returns non-zero if any task failed.
+wait_tasks() {
+    local PID STATUS=0
+    for PID in $(jobs -p); do
+        wait ${PID} || STATUS=1
+    done
+    cat ${TASK_FILES[@]/%/.out} >> ${PIPELINE_LOG}
+    cat ${TASK_FILES[@]/%/.err} > ${ERROR_LOG}
+    rm -f ${TASK_FILES[@]/%/.out} ${TASK_FILES[@]/%/.err}
+    return ${STATUS}
+}
+
+# Record the completion of a step started with begin_step
+#
+# Nothing is recorded if any declared output is missing.
+end_step() {
+    local F
+    step_timeline "-" "${NPROC}" ${STEP_START} 0
+    step_profile_end
+    for F in ${STEP_OUTPUTS}; do
+        [ -e "$F" ] || return 0
+    done
+    if [ -n "${STEP_OUTPUTS}" ]; then
+        { echo "${STEP_SIGNATURE}"; step_fingerprint output ${STEP_OUTPUTS}; } > ${STEP_MARKER}.tmp
+        mv ${STEP_MARKER}.tmp ${STEP_MARKER}
+    fi
+}
+
+# Compress a file in place
+#
+# Arguments:
+#   $1 = File.
+#   $2 = Number of threads for pigz and zstd.
+#
+# The original file is kept if DELETE_FILES is false.
+compress_file() {
+    local KEEP=false
+    [ "${DELETE_FILES:-true}" == "false" ] && KEEP=true
+    case ${ARCHIVE_FORMAT} in
+    gzip)  if ${KEEP}; then gzip -f -k "$1"; else gzip -f "$1"; fi ;;
+    pigz)  if ${KEEP}; then pigz -f -k -p $2 "$1"; else pigz -f -p $2 "$1"; fi ;;
+    zstd)  if ${KEEP}; then zstd -q -f -T$2 "$1"; else zstd -q -f --rm -T$2 "$1"; fi ;;
+    esac
+}
+
+# Print the file extension of the compression program
+compress_ext() {
+    if [ "${ARCHIVE_FORMAT}" == "zstd" ]; then echo "zst"; else echo "gz"; fi
+}
+
+# Start compressing intermediate files in the background if --compress-early was given
+#
+# Arguments:
+#   $@ = Files. Absolute paths, such as pipeline inputs, and missing files are ignored.
+#
+# Adds the compressed file names to EARLY_FILES, including files compressed by an earlier run.
+# Does nothing if ZIP_FILES is false.
+compress_early() {
+    local F
+    if ! ${ARCHIVE_EARLY} || [ "${ZIP_FILES:-true}" == "false" ]; then
+        return 0
+    fi
+    for F in "$@"; do
+        if [[ "$F" != /* ]] && [ ! -e "$F" ] && [ -f "${F}.$(compress_ext)" ]; then
+            EARLY_FILES+=("${F}.$(compress_ext)")
+        elif [[ "$F" != /* ]] && [ -f "$F" ]; then
+            step_release "$F" "${F}.$(compress_ext)"
+            compress_file "$F" 1 &
+            ARCHIVE_PIDS+=($!)
+            # Remove from the job table so wait_tasks and wait ignore the compression
+            disown $!
+            EARLY_FILES+=("${F}.$(compress_ext)")
+        fi
+    done
+}
+
+# Archive files with the compression program selected by --compress
+#
+# Arguments:
+#   $1 = Archive name without extension.
+#   $@ = Files. Files already compressed by compress_early are added without recompression.
+#
+# Without --compress-early, writes NAME.tar.gz or NAME.tar.zst. With --compress-early, compresses
+# the remaining files in parallel, writes NAME.tar and removes the compressed files.
+archive_files() {
+    local NAME=$1 EXT=$(compress_ext) F PID FILES=()
+    shift
+    [ $# -eq 0 ] && return 0
+
+    if ! ${ARCHIVE_EARLY}; then
+        case ${ARCHIVE_FORMAT} in
+        gzip)  tar -zcf ${NAME}.tar.gz "$@" ;;
+        pigz)  tar -cf - "$@" | pigz -p ${NPROC} > ${NAME}.tar.gz ;;
+        zstd)  tar -cf - "$@" | zstd -q -T${NPROC} > ${NAME}.tar.zst ;;
+        esac
+        return
+    fi
+
+    # Compress remaining files in parallel
+    for F in "$@"; do
+        if [[ "$F" == *.${EXT} ]]; then
+            FILES+=("$F")
+            continue
+        fi
+        while [ $(jobs -rp | wc -l) -ge ${NPROC} ]; do
+            sleep 0.1
+        done
+        compress_file "$F" 1 &
+        FILES+=("${F}.${EXT}")
+    done
+    wait
+
+    # Wait for early compression
+    for PID in ${ARCHIVE_PIDS[@]}; do
+        while kill -0 ${PID} 2> /dev/null; do
+            sleep 0.1
+        done
+    done
+    tar -cf ${NAME}.tar "${FILES[@]}" && rm -f "${FILES[@]}"
+}
+
+# Exit if --from-step did not match any step, then write and print the profile summary
+finish_steps() {
+    if ! ${STEP_STARTED}; then
+        echo -e "Step '${FROM_STEP}' passed to --from-step does not exist." >&2
+        exit 1
+    fi
+
+    # Write profile as JSON
+    awk -F '\t' '
+        NR == 1 { for (i = 1; i <= NF; i++) key[i] = tolower($i); next }
+        { row = ""
+          for (i = 1; i <= NF; i++) {
+              if (i == 2) value = "\"" $i "\""
+              else if ($i == "NA") value = "null"
+              else value = $i
+              row = row (i > 1 ? ", " : "") "\"" key[i] "\": " value
+          }
+          rows[++n] = "  {" row "}" }
+        END { print "["; for (i = 1; i <= n; i++) print rows[i] (i < n ? "," : ""); print "]" }' \
+        ${STEP_PROFILE} > ${STEP_PROFILE%.tsv}.json
+
+    # Print summary
+    if [ $(wc -l < ${STEP_PROFILE}) -gt 1 ]; then
+        echo -e "\nPROFILE"
+        awk -F '\t' -v width=${STEP_WIDTH} '
+            function mb(x) { return (x == "NA") ? "NA" : sprintf("%.1f", x / 1048576) }
+            NR == 1 { printf "  %2s  %-*s %9s %9s %9s %9s %9s %11s %11s\n", "", width, "",
+                             "WALL(s)", "CPU(s)", "RSS(MB)", "READ(MB)", "WRITE(MB)", "IN", "OUT"; next }
+            { printf "  %2d: %-*s %9.1f %9.1f %9s %9s %9s %11s %11s\n",
+                     $1, width, $2, $3, $4, mb($5 * 1024), mb($6), mb($7), $8, $9 }' ${STEP_PROFILE}
+    fi
+}
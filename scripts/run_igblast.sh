@@ -12,12 +12,18 @@
 #   -b = IGDATA directory, which contains the IgBLAST database, optional_file
 #        and auxillary_data directories. Defaults to /usr/local/share/igblast.
 #   -n = Number of IgBLAST threads. Defaults to 1.
+#   -k = Number of shards to split the input into and align with concurrent IgBLAST processes.
+#        Threads (-n) are divided among the shards. Defaults to 1.
+#   -m = Directory of the per-sequence result store. If specified, only sequences without stored
+#        results for the germline database and IgBLAST version are aligned.
 #   -h = Display help.
 
 # Default argument values
 IGDATA="/usr/local/share/igblast"
 OUTDIR="."
 NPROC=1
+SHARDS=1
+MEMO_SET=false
 
 # Print usage
 usage () {
@@ -30,6 +36,10 @@ usage () {
             "     optional_file and auxillary_data directories.\n" \
             "     Defaults to /usr/local/share/igblast."
     echo -e "  -n  Number of IgBLAST threads. Defaults to 1."
+    echo -e "  -k  Number of shards to split the input into and align with concurrent\n" \
+            "     IgBLAST processes. Threads (-n) are divided among the shards. Defaults to 1."
+    echo -e "  -m  Directory of the per-sequence result store. If specified, only sequences\n" \
+            "     without stored results for the germline database and IgBLAST version are aligned."
     echo -e "  -h  This message."
 }
 
@@ -40,7 +50,7 @@ SPECIES_SET=false
 RECEPTOR_SET=false
 
 # Get commandline arguments
-while getopts "s:o:g:t:b:n:h" OPT; do
+while getopts "s:o:g:t:b:n:k:m:h" OPT; do
     case "$OPT" in
     s)  READFILE=$(realpath $OPTARG)
         READFILE_SET=true
@@ -59,6 +69,11 @@ while getopts "s:o:g:t:b:n:h" OPT; do
         ;;
     n)  NPROC=$OPTARG
         ;;
+    k)  SHARDS=$OPTARG
+        ;;
+    m)  MEMO_DIR=$OPTARG
+        MEMO_SET=true
+        ;;
     h)  usage
         exit
         ;;
@@ -120,16 +135,102 @@ IGBLAST_CMD="igblastn \
 OUTFILE=$(basename ${READFILE})
 OUTFILE="${OUTDIR}/${OUTFILE%.fasta}.fmt7"
 IGBLAST_VER=$(${IGBLAST_CMD} -version | grep 'Package' |sed s/'Package: '//)
-IGBLAST_RUN="${IGBLAST_CMD} -query ${READFILE} -out ${OUTFILE} -num_threads ${NPROC}"
+
+# Remove temporary directories on exit, including exits after a failed shard or store update
+MEMO_TMP=""
+SHARD_DIR=""
+trap 'rm -rf ${MEMO_TMP} ${SHARD_DIR}' EXIT
+
+# Set queries to align, excluding sequences with stored results
+QUERY_FILE=${READFILE}
+QUERY_OUTFILE=${OUTFILE}
+if ${MEMO_SET}; then
+    mkdir -p ${MEMO_DIR}
+    REF_KEY=$(igblast_cache.sh key -b ${IGDATA} -g ${SPECIES} -t ${RECEPTOR} -v "${IGBLAST_VER}" \
+              -x "run_igblast.sh") || exit 1
+    MEMO_FILE="${MEMO_DIR}/${REF_KEY}.sqlite"
+    MEMO_TMP=$(mktemp -d "${OUTDIR}/.igblast_memo.XXXXXX")
+    QUERY_FILE="${MEMO_TMP}/unseen.fasta"
+    QUERY_OUTFILE="${MEMO_TMP}/unseen.fmt7"
+    MEMO_COUNTS=$(igblast_memo.py split -s ${READFILE} -d ${MEMO_FILE} -o ${QUERY_FILE}) || exit 1
+    read QUERY_COUNT UNSEEN_COUNT <<< "${MEMO_COUNTS}"
+fi
+IGBLAST_RUN="${IGBLAST_CMD} -query ${QUERY_FILE} -out ${QUERY_OUTFILE} -num_threads ${NPROC}"
 
 # Align V(D)J segments using IgBLAST
 echo -e "   START> igblastn"
 echo -e " VERSION> ${IGBLAST_VER}"
 echo -e "  IGDATA> ${IGDATA}"
 echo -e "  GERMDB> ${SPECIES}_${RECEPTOR}"
-echo -e "    FILE> $(basename ${READFILE})\n"
-echo -e "PROGRESS> [Running]"
-eval $IGBLAST_RUN
+echo -e "    FILE> $(basename ${READFILE})"
+if ${MEMO_SET}; then
+    echo -e "  STORED> $(( QUERY_COUNT - UNSEEN_COUNT ))"
+    echo -e "   ALIGN> ${UNSEEN_COUNT}"
+fi
+echo -e "\nPROGRESS> [Running]"
+if ${MEMO_SET} && [ ${UNSEEN_COUNT} -eq 0 ]; then
+    # All sequences have stored results
+    rm -f ${QUERY_FILE}
+elif ! grep -q '^>' ${QUERY_FILE}; then
+    # No queries to align
+    echo "# BLAST processed 0 queries" > ${QUERY_OUTFILE}
+elif [ ${SHARDS} -le 1 ]; then
+    eval $IGBLAST_RUN || exit 1
+else
+    # Split input into contiguous shards with similar total sequence length
+    SHARD_DIR=$(mktemp -d "${OUTDIR}/.igblast_shards.XXXXXX")
+    awk -v k=${SHARDS} -v dir=${SHARD_DIR} '
+        NR == FNR { if ($0 !~ /^>/) total += length($0); next }
+        /^>/ { shard = total > 0 ? int(done * k / total) + 1 : 1
+               if (shard > k) shard = k
+               out = sprintf("%s/shard_%06d.fasta", dir, shard) }
+        { if ($0 !~ /^>/) done += length($0)
+          if (out) print > out }' ${QUERY_FILE} ${QUERY_FILE}
+
+    # Run IgBLAST on each shard
+    THREADS=$(( NPROC / SHARDS > 0 ? NPROC / SHARDS : 1 ))
+    PIDS=()
+    for F in ${SHARD_DIR}/shard_*.fasta; do
+        eval "${IGBLAST_CMD} -query ${F} -out ${F%.fasta}.fmt7 -num_threads ${THREADS}" &
+        PIDS+=($!)
+    done
+    SHARD_FAILED=false
+    for P in ${PIDS[@]}; do
+        wait $P || SHARD_FAILED=true
+    done
+    if $SHARD_FAILED; then
+        rm -rf ${SHARD_DIR}
+        echo "IgBLAST failed on one or more shards" >&2
+        exit 1
+    fi
+
+    # Merge outputs in input order with a single query count footer
+    awk '/^# BLAST processed [0-9]+ queries/ { n += $4; next }
+         { print }
+         END { print "# BLAST processed " n " queries" }' ${SHARD_DIR}/shard_*.fmt7 > ${SHARD_DIR}/merged.fmt7
+
+    # Check that every query appears exactly once and in input order
+    if ! cmp -s <(awk '/^>/ { print $1 }' ${QUERY_FILE} | cut -c 2-) \
+                <(awk '/^# Query: / { print $3 }' ${SHARD_DIR}/merged.fmt7); then
+        rm -rf ${SHARD_DIR}
+        echo "Merged IgBLAST output does not contain each query exactly once in input order" >&2
+        exit 1
+    fi
+    mv ${SHARD_DIR}/merged.fmt7 ${QUERY_OUTFILE}
+    rm -rf ${SHARD_DIR}
+fi
+
+# Store new results and combine with stored results in input order
+if ${MEMO_SET}; then
+    if [ -f ${QUERY_OUTFILE} ]; then
+        igblast_memo.py merge -s ${READFILE} -d ${MEMO_FILE} -i ${QUERY_OUTFILE} -o ${OUTFILE}
+    else
+        igblast_memo.py merge -s ${READFILE} -d ${MEMO_FILE} -o ${OUTFILE}
+    fi
+    MEMO_STATUS=$?
+    rm -rf ${MEMO_TMP}
+    [ ${MEMO_STATUS} -eq 0 ] || exit 1
+fi
 echo -e "PROGRESS> [Done   ]\n"
 echo -e "  OUTPUT> $(basename ${OUTFILE})"
 echo -e "     END> igblastn\n"
\ No newline at end of file
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Benchmark heavy chain doublet resolution in light_cluster.py
+
+Compares the groupby-apply selection of light_cluster.py VERSION 1 against resolveDoublets
+on synthetic data and checks that both select the same rows.
+"""
+
+# Imports
+import importlib.util
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from argparse import ArgumentParser
+
+# Load script as a module
+script_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'scripts')
+script_path = os.path.join(script_dir, 'light_cluster.py')
+sys.path.insert(0, script_dir)
+spec = importlib.util.spec_from_file_location('light_cluster', script_path)
+light_cluster = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(light_cluster)
+
+
+def simulateHeavy(n_cells, doublet_rate=0.1, seed=42):
+    """
+    Simulates a heavy chain table with cell doublets and tied UMI counts
+
+    Arguments:
+      n_cells (int): number of cells.
+      doublet_rate (float): fraction of cells with additional heavy chains.
+      seed (int): random seed.
+
+    Returns:
+      pandas.DataFrame: heavy chain data with object columns.
+    """
+    rng = np.random.default_rng(seed)
+    extra = rng.choice(n_cells, size=int(n_cells * doublet_rate))
+    cells = np.concatenate([np.arange(n_cells), extra])
+    rng.shuffle(cells)
+    n_rows = len(cells)
+
+    return pd.DataFrame({'cell_id': pd.Series(cells).map('cell%i'.__mod__).astype('object'),
+                         'clone_id': pd.Series(np.arange(n_rows)).astype(str).astype('object'),
+                         'umi_count': pd.Series(rng.integers(1, 5, size=n_rows)).astype(str).astype('object')})
+
+
+def naiveDoublets(heavy_df, cell_id, umi_count):
+    """
+    Reference doublet resolution from light_cluster.py VERSION 1
+    """
+    heavy_df[umi_count] = heavy_df[umi_count].astype('int')
+    return heavy_df.groupby(cell_id, sort=False).apply(lambda x: x.nlargest(1, umi_count))
+
+
+def timeCall(func, *args, **kwargs):
+    """
+    Returns the result and run time of a function call
+    """
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and runs the benchmark
+    """
+    parser = ArgumentParser()
+    parser.add_argument('-n', dest='sizes', nargs='+', type=int, default=[10**4, 10**5, 10**6],
+                        help='Numbers of cells to simulate.')
+    parser.add_argument('--skip-naive', dest='skip_naive', action='store_true',
+                        help='Only time resolveDoublets.')
+    args = parser.parse_args()
+
+    print('%10s %10s %12s %12s %8s %s' % ('CELLS', 'ROWS', 'NAIVE', 'RESOLVE', 'SPEEDUP', 'MATCH'))
+    for n in args.sizes:
+        heavy_df = simulateHeavy(n)
+        new_df, new_time = timeCall(light_cluster.resolveDoublets, heavy_df.copy(), 'cell_id', 'umi_count',
+                                    doublets='count')
+        if args.skip_naive:
+            print('%10i %10i %12s %12.3f %8s %s' % (n, len(heavy_df), 'NA', new_time, 'NA', 'NA'))
+            continue
+        old_df, old_time = timeCall(naiveDoublets, heavy_df.copy(), 'cell_id', 'umi_count')
+        match = list(old_df['clone_id']) == list(new_df['clone_id'])
+        print('%10i %10i %12.3f %12.3f %8.1f %s' % (n, len(heavy_df), old_time, new_time, old_time / new_time, match))
@@ -0,0 +1,125 @@
+"""
+Unit tests for light_cluster.py
+"""
+
+# Imports
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+import unittest
+import pandas as pd
+
+# Load script as a module
+script_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'scripts')
+script_path = os.path.join(script_dir, 'light_cluster.py')
+sys.path.insert(0, script_dir)
+spec = importlib.util.spec_from_file_location('light_cluster', script_path)
+light_cluster = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(light_cluster)
+
+
+def naiveLinkage(cell_series, group_series):
+    """
+    Reference implementation of single linkage clustering from light_cluster.py VERSION 1
+    """
+    initial_dict = {}
+    for cell, group in zip(cell_series, group_series):
+        try:
+            initial_dict[group].append(cell)
+        except KeyError:
+            initial_dict[group] = [cell]
+
+    while True:
+        cluster_dict = {}
+        for i, group in enumerate(initial_dict.keys()):
+            cluster_dict[i] = initial_dict[group]
+            for cluster in cluster_dict:
+                if cluster != i and any(cell in initial_dict[group] for cell in cluster_dict[cluster]):
+                    cluster_dict[cluster] = cluster_dict[cluster] + initial_dict[group]
+                    del cluster_dict[i]
+                    break
+        if len(cluster_dict.keys()) == len(initial_dict.keys()):
+            break
+        else:
+            initial_dict = cluster_dict.copy()
+
+    return {cell:k for k,v in cluster_dict.items() for cell in set(v)}
+
+
+class TestClusterLinkage(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(42)
+
+    def test_simple(self):
+        cells = ['c1', 'c2', 'c3', 'c3', 'c4', 'c5']
+        groups = ['g1', 'g2', 'g1', 'g3', 'g3', 'g4']
+        result = light_cluster.clusterLinkage(cells, groups)
+        self.assertEqual(result, {'c1': 0, 'c3': 0, 'c4': 0, 'c2': 1, 'c5': 2})
+        self.assertEqual(result, naiveLinkage(cells, groups))
+
+    def test_chain(self):
+        # Groups linked only transitively, in an order that requires several naive passes
+        cells = ['c1', 'c2', 'c3', 'c4', 'c1', 'c2', 'c4']
+        groups = ['g1', 'g2', 'g3', 'g4', 'g4', 'g3', 'g2']
+        result = light_cluster.clusterLinkage(cells, groups)
+        self.assertEqual(set(result.values()), {0})
+        self.assertEqual(result, naiveLinkage(cells, groups))
+
+    def test_random(self):
+        for __ in range(200):
+            n_cells = self.rng.randint(1, 60)
+            n_groups = self.rng.randint(1, 40)
+            cells, groups = [], []
+            for c in range(n_cells):
+                # Most cells have one light chain, some have two or three
+                for __ in range(self.rng.choice([1, 1, 1, 2, 3])):
+                    cells.append('cell%i' % c)
+                    groups.append('group%i' % self.rng.randrange(n_groups))
+            # Shuffle row order
+            rows = list(zip(cells, groups))
+            self.rng.shuffle(rows)
+            cells, groups = [x[0] for x in rows], [x[1] for x in rows]
+            self.assertEqual(light_cluster.clusterLinkage(cells, groups),
+                             naiveLinkage(cells, groups))
+
+
+class TestResolveDoublets(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(42)
+
+    def test_count(self):
+        for __ in range(50):
+            n_rows = self.rng.randint(1, 200)
+            # Few distinct UMI counts to force ties
+            cells = ['cell%i' % self.rng.randrange(n_rows // 2 + 1) for __ in range(n_rows)]
+            heavy_df = pd.DataFrame({'cell_id': cells,
+                                     'clone_id': [str(i) for i in range(n_rows)],
+                                     'umi_count': [str(self.rng.randint(1, 3)) for __ in range(n_rows)]})
+            # Reference groupby-apply from light_cluster.py VERSION 1
+            expected = heavy_df.copy()
+            expected['umi_count'] = expected['umi_count'].astype('int')
+            expected = expected.groupby('cell_id', sort=False).apply(lambda x: x.nlargest(1, 'umi_count'))
+            result = light_cluster.resolveDoublets(heavy_df.copy(), 'cell_id', 'umi_count', doublets='count')
+            self.assertEqual(list(result['clone_id']), list(expected['clone_id']))
+
+    def test_drop(self):
+        heavy_df = pd.DataFrame({'cell_id': ['c1', 'c2', 'c1', 'c3'],
+                                 'clone_id': ['1', '2', '3', '4'],
+                                 'umi_count': ['1', '1', '1', '1']})
+        result = light_cluster.resolveDoublets(heavy_df, 'cell_id', 'umi_count', doublets='drop')
+        self.assertEqual(list(result['clone_id']), ['2', '4'])
+
+
+class TestBatchCluster(unittest.TestCase):
+    def test_empty(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.tsv') as handle:
+            handle.write('# heavy\tlight\tout\n')
+            handle.flush()
+            results = light_cluster.batchCluster(handle.name, nproc=4)
+        self.assertEqual(results, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
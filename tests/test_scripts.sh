@@ -0,0 +1,242 @@
+#!/usr/bin/env bats
+
+# Run parametes
+DATE=$(date +"%Y.%m.%d")
+SCRIPT_DIR=$(realpath ../scripts)
+RUN_DIR="run/scripts-${DATE}"
+
+# Create output parent
+mkdir -p ${RUN_DIR}/bin ${RUN_DIR}/console ${RUN_DIR}/output
+RUN_DIR=$(realpath ${RUN_DIR})
+export PATH="${RUN_DIR}/bin:${SCRIPT_DIR}:${PATH}"
+
+# Write a stub igblastn that reports one hit per query
+# Setting STUB_DROP drops the query with that ID from the output. Setting STUB_FAIL makes alignment fail.
+cat > ${RUN_DIR}/bin/igblastn << 'EOF'
+#!/usr/bin/env bash
+while [ $# -gt 0 ]; do
+    case "$1" in
+    -version) echo -e "igblastn: 1.14.0\nPackage: igblast 1.14.0, build stub"; exit ;;
+    -query) QUERY=$2; shift ;;
+    -out) OUT=$2; shift ;;
+    esac
+    shift
+done
+[ -n "${STUB_FAIL}" ] && exit 1
+awk -v drop="${STUB_DROP}" '
+    /^>/ { id = substr($1, 2); if (id == drop) next; n++
+           print "# IGBLASTN 2.2.29+\n# Query: " substr($0, 2) "\n# Database: stub\n# 1 hits found"
+           print "V\t" id "\tIGHV1-2*02\t100.00"; next }
+    END { print "# BLAST processed " n " queries" }' ${QUERY} > ${OUT}
+EOF
+chmod +x ${RUN_DIR}/bin/igblastn
+
+# Write a FASTA file of queries with varying lengths
+# $1 : output file
+# $2 : number of sequences
+simulate_fasta() {
+    awk -v n=$2 'BEGIN { for (i = 1; i <= n; i++) {
+        print ">seq" i " count=" i
+        s = ""; for (j = 0; j < 50 + (i * 37) % 400; j++) s = s substr("ACGT", j % 4 + 1, 1)
+        print substr(s, 1, 60); if (length(s) > 60) print substr(s, 61) } }' > $1
+}
+
+
+@test "run_igblast-shards" {
+    TEST="${BATS_TEST_NUMBER}-${BATS_TEST_DESCRIPTION}"
+    CONSOLE="${RUN_DIR}/console/${TEST}.out"
+    READS="${RUN_DIR}/output/${TEST}.fasta"
+    simulate_fasta $READS 250
+
+    run run_igblast.sh -s $READS -o ${RUN_DIR}/output/${TEST}-single -b ${RUN_DIR}
+    echo "$output" > $CONSOLE
+    [ "$status" -eq 0 ]
+
+    run run_igblast.sh -s $READS -o ${RUN_DIR}/output/${TEST}-sharded -b ${RUN_DIR} -n 8 -k 8
+    echo "$output" >> $CONSOLE
+    [ "$status" -eq 0 ]
+    cmp ${RUN_DIR}/output/${TEST}-single/${TEST}.fmt7 ${RUN_DIR}/output/${TEST}-sharded/${TEST}.fmt7
+}
+
+@test "run_igblast-shards-exceed-queries" {
+    TEST="${BATS_TEST_NUMBER}-${BATS_TEST_DESCRIPTION}"
+    CONSOLE="${RUN_DIR}/console/${TEST}.out"
+    READS="${RUN_DIR}/output/${TEST}.fasta"
+    simulate_fasta $READS 3
+
+    run run_igblast.sh -s $READS -o ${RUN_DIR}/output/${TEST} -b ${RUN_DIR} -k 16
+    echo "$output" > $CONSOLE
+    [ "$status" -eq 0 ]
+    [ $(grep -c "^# Query: " ${RUN_DIR}/output/${TEST}/${TEST}.fmt7) -eq 3 ]
+    tail -n 1 ${RUN_DIR}/output/${TEST}/${TEST}.fmt7 | grep -qx "# BLAST processed 3 queries"
+}
+
+@test "run_igblast-shards-missing-query" {
+    TEST="${BATS_TEST_NUMBER}-${BATS_TEST_DESCRIPTION}"
+    CONSOLE="${RUN_DIR}/console/${TEST}.out"
+    READS="${RUN_DIR}/output/${TEST}.fasta"
+    simulate_fasta $READS 100
+
+    STUB_DROP=seq42 run run_igblast.sh -s $READS -o ${RUN_DIR}/output/${TEST} -b ${RUN_DIR} -k 4
+    echo "$output" > $CONSOLE
+    [ "$status" -ne 0 ]
+    [ ! -f ${RUN_DIR}/output/${TEST}/${TEST}.fmt7 ]
+
+    # Temporary directories are removed after a failed run with a result store
+    STUB_FAIL=true run run_igblast.sh -s $READS -o ${RUN_DIR}/output/${TEST} -b ${RUN_DIR} -k 4 \
+        -m ${RUN_DIR}/output/${TEST}-store
+    echo "$output" >> $CONSOLE
+    [ "$status" -ne 0 ]
+    [ -z "$(ls -A ${RUN_DIR}/output/${TEST})" ]
+}
+
+@test "run_igblast-empty-or-failed" {
+    TEST="${BATS_TEST_NUMBER}-${BATS_TEST_DESCRIPTION}"
+    CONSOLE="${RUN_DIR}/console/${TEST}.out"
+    READS="${RUN_DIR}/output/${TEST}.fasta"
+    : > $READS
+
+    run run_igblast.sh -s $READS -o ${RUN_DIR}/output/${TEST} -b ${RUN_DIR} -k 4
+    echo "$output" > $CONSOLE
+    [ "$status" -eq 0 ]
+    [ "$(cat ${RUN_DIR}/output/${TEST}/${TEST}.fmt7)" == "# BLAST processed 0 queries" ]
+
+    simulate_fasta $READS 10
+    STUB_FAIL=true run run_igblast.sh -s $READS -o ${RUN_DIR}/output/${TEST} -b ${RUN_DIR}
+    echo "$output" >> $CONSOLE
+    [ "$status" -ne 0 ]
+}
+
+@test "run_igblast-memo" {
+    TEST="${BATS_TEST_NUMBER}-${BATS_TEST_DESCRIPTION}"
+    CONSOLE="${RUN_DIR}/console/${TEST}.out"
+    READS_1="${RUN_DIR}/output/${TEST}-1.fasta"
+    READS_2="${RUN_DIR}/output/${TEST}-2.fasta"
+    STORE="${RUN_DIR}/output/${TEST}-store"
+    simulate_fasta $READS_1 200
+    simulate_fasta $READS_2 300
+    mkdir -p ${RUN_DIR}/database ${RUN_DIR}/optional_file
+    touch ${RUN_DIR}/database/imgt_human_ig_v.nsq ${RUN_DIR}/optional_file/human_gl.aux
+
+    for READS in $READS_1 $READS_2; do
+        run run_igblast.sh -s $READS -o ${RUN_DIR}/output/${TEST}-plain -b ${RUN_DIR}
+        echo "$output" >> $CONSOLE
+        [ "$status" -eq 0 ]
+        run run_igblast.sh -s $READS -o ${RUN_DIR}/output/${TEST}-memo -b ${RUN_DIR} -m $STORE -k 2
+        echo "$output" >> $CONSOLE
+        [ "$status" -eq 0 ]
+    done
+    echo "$output" | grep -q "STORED> 200"
+    cmp ${RUN_DIR}/output/${TEST}-plain/${TEST}-1.fmt7 ${RUN_DIR}/output/${TEST}-memo/${TEST}-1.fmt7
+    cmp ${RUN_DIR}/output/${TEST}-plain/${TEST}-2.fmt7 ${RUN_DIR}/output/${TEST}-memo/${TEST}-2.fmt7
+}
+
+@test "igblast_memo-truncated" {
+    TEST="${BATS_TEST_NUMBER}-${BATS_TEST_DESCRIPTION}"
+    CONSOLE="${RUN_DIR}/console/${TEST}.out"
+    READS="${RUN_DIR}/output/${TEST}.fasta"
+    STORE="${RUN_DIR}/output/${TEST}.sqlite"
+    UNSEEN="${RUN_DIR}/output/${TEST}-unseen"
+    simulate_fasta $READS 20
+
+    # Output of a run interrupted during the last query, without the query count footer
+    run igblast_memo.py split -s $READS -d $STORE -o ${UNSEEN}.fasta
+    echo "$output" > $CONSOLE
+    [ "$output" == "20 20" ]
+    igblastn -query ${UNSEEN}.fasta -out ${UNSEEN}.fmt7
+    grep -v "^# BLAST processed" ${UNSEEN}.fmt7 | sed '$d' > ${UNSEEN}-truncated.fmt7
+
+    run igblast_memo.py merge -s $READS -d $STORE -i ${UNSEEN}-truncated.fmt7 -o ${RUN_DIR}/output/${TEST}.fmt7
+    echo "$output" >> $CONSOLE
+    [ "$status" -ne 0 ]
+
+    # The truncated last query is not stored
+    run igblast_memo.py split -s $READS -d $STORE -o ${UNSEEN}.fasta
+    echo "$output" >> $CONSOLE
+    [ "$output" == "20 1" ]
+}
+
+@test "phix_reads-clean-filter" {
+    TEST="${BATS_TEST_NUMBER}-${BATS_TEST_DESCRIPTION}"
+    CONSOLE="${RUN_DIR}/console/${TEST}.out"
+    PHIX="${RUN_DIR}/output/${TEST}-phix.fna"
+    READS="${RUN_DIR}/output/${TEST}.fastq"
+    awk 'BEGIN { srand(1); print ">phix"; for (i = 0; i < 600; i++) printf "%s", substr("ACGT", int(rand() * 4) + 1, 1)
+                 print "" }' > $PHIX
+    awk 'NR == 2 { g = $0; srand(2)
+                   for (i = 1; i <= 40; i++) {
+                       if (i % 4 == 0) { s = substr(g, i * 10, 100); n = "phix" i }
+                       else { s = ""; for (j = 0; j < 100; j++) s = s substr("ACGT", int(rand() * 4) + 1, 1); n = "read" i }
+                       if (i == 5) s = "NNNNNNNNNN"
+                       q = s; gsub(/./, "I", q); print "@" n " 1:N:0:1\n" s "\n+\n" q } }' $PHIX > $READS
+
+    run phix_kmers.py index -r $PHIX -o ${RUN_DIR}/output/${TEST}.kmers
+    echo "$output" > $CONSOLE
+    [ "$status" -eq 0 ]
+
+    run phix_reads.py clean -s $READS -i ${RUN_DIR}/output/${TEST}.kmers -o ${RUN_DIR}/output/${TEST}.fasta
+    echo "$output" >> $CONSOLE
+    [ "$status" -eq 0 ]
+    [ "$output" == "40 1 10" ]
+    [ $(grep -c "^>phix" ${RUN_DIR}/output/${TEST}.fasta) -eq 10 ]
+
+    grep "^>" ${RUN_DIR}/output/${TEST}.fasta | sed 's/^>\(.*\)/\1\tphix\t100.00/' > ${RUN_DIR}/output/${TEST}.fmt6
+    run phix_reads.py filter -s $READS -b ${RUN_DIR}/output/${TEST}.fmt6 -o ${RUN_DIR}/output/${TEST}-selected.fastq
+    echo "$output" >> $CONSOLE
+    [ "$status" -eq 0 ]
+    [ "$output" == "40 30" ]
+    ! grep -q "^@phix" ${RUN_DIR}/output/${TEST}-selected.fastq
+}
+
+@test "versions-batch" {
+    command -v hg > /dev/null || skip "hg not installed"
+    TEST="${BATS_TEST_NUMBER}-${BATS_TEST_DESCRIPTION}"
+    CONSOLE="${RUN_DIR}/console/${TEST}.out"
+    REPO_DIR="${RUN_DIR}/output/${TEST}"
+    VERSION_FILE="${REPO_DIR}/Version.yaml"
+    VERSIONS="$(realpath ../docker/immcantation-base/tools/versions.py)"
+    rm -rf $REPO_DIR
+    mkdir -p $REPO_DIR
+    echo -e "immcantation:\n  version: 1.0.0\n  date: 2020.01.01\nrelease:\n  presto: 0.5.13\n  changeo: 0.4.6" \
+        "\nsoftware:\n  muscle: 3.8.425" > $VERSION_FILE
+    for PACKAGE in presto changeo; do
+        hg init ${REPO_DIR}/${PACKAGE}
+        for V in 0.4.6 0.5.13 1.0.0; do
+            echo $V > ${REPO_DIR}/${PACKAGE}/VERSION
+            hg -R ${REPO_DIR}/${PACKAGE} commit -q -A -u test -m "Release ${V}"
+            hg -R ${REPO_DIR}/${PACKAGE} tag -u test "v${V}"
+        done
+    done
+
+    run python3 $VERSIONS batch -d $REPO_DIR -f $VERSION_FILE --update
+    echo "$output" > $CONSOLE
+    [ "$status" -eq 0 ]
+    echo "$output" | grep -q "^immcantation .* no repository$"
+    [ "$(hg -R ${REPO_DIR}/presto log -r . --template '{desc}')" == "Release 0.5.13" ]
+    [ "$(hg -R ${REPO_DIR}/changeo log -r . --template '{desc}')" == "Release 0.4.6" ]
+
+    run python3 $VERSIONS batch -d $REPO_DIR -f $VERSION_FILE -n presto immcantation
+    echo "$output" >> $CONSOLE
+    [ "$status" -ne 0 ]
+}
+
+@test "versions-probe-muscle" {
+    TEST="${BATS_TEST_NUMBER}-${BATS_TEST_DESCRIPTION}"
+    CONSOLE="${RUN_DIR}/console/${TEST}.out"
+    TOOLS_DIR="$(realpath ../docker/immcantation-base/tools)"
+    mkdir -p ${RUN_DIR}/bin/muscle-plain ${RUN_DIR}/bin/muscle-banner
+    BANNER="MUSCLE v3.8.425 by Robert C. Edgar"
+    echo -e "#!/usr/bin/env bash\necho '${BANNER}'" > ${RUN_DIR}/bin/muscle-plain/muscle
+    echo -e "#!/usr/bin/env bash\necho\necho '${BANNER}'\necho\necho 'http://www.drive5.com/muscle'" \
+        > ${RUN_DIR}/bin/muscle-banner/muscle
+    chmod +x ${RUN_DIR}/bin/muscle-plain/muscle ${RUN_DIR}/bin/muscle-banner/muscle
+    PROBE="import sys; sys.path.insert(0, '${TOOLS_DIR}'); from versions import probeCommand, version_probes
+print(probeCommand(*version_probes['muscle'][1:]))"
+
+    for LAYOUT in plain banner; do
+        PATH="${RUN_DIR}/bin/muscle-${LAYOUT}:${PATH}" run python3 -c "$PROBE"
+        echo "$output" >> $CONSOLE
+        [ "$status" -eq 0 ]
+        [ "$output" == "3.8.425" ]
+    done
+}